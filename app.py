@@ -1,59 +1,199 @@
 # -*- coding:utf-8 -*-
-from asyncio import gather, sleep
+from asyncio import gather, sleep, to_thread
+from functools import partial
+from math import isfinite
+from os import getpid
+from time import strftime, time_ns
+from typing import Any, Awaitable, Callable, Optional
 
 from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.webhooks import (
-    FollowEvent,
-    JoinEvent,
-    MemberJoinedEvent,
-    MessageEvent,
-    PostbackEvent,
-    StickerMessageContent,
-    TextMessageContent,
-)
+from linebot.v3.webhooks import Event, UserSource
 from sanic import (
+    BadRequest,
     HTTPResponse,
+    NotFound,
     Request,
     Sanic,
     ServiceUnavailable,
     Unauthorized,
     empty,
+    json,
     redirect,
+    text,
 )
+from sanic.log import logger
 
 from ntpu_linebot import (
+    CRAWLS,
+    EVENT_QUEUE,
+    EVENT_SHED,
+    JOBS,
     LINE_API_UTIL,
+    LOADING_SAVED,
+    LOG_PIPELINE,
+    MEMORY_REPORT,
+    METRICS,
+    PRELOAD,
+    PROCESS_RSS,
+    PROFILER,
+    READINESS,
     STICKER,
-    handle_follow_join_event,
-    handle_postback_event,
-    handle_sticker_message,
-    handle_text_message,
+    TRACER,
+    WEBHOOK_EVENT_FILTER,
+    Span,
+    admin_job,
+    authorize_admin,
+    cache_stats,
+    handle_busy_event,
+    handle_event,
+    is_crawler,
+    is_local_event,
+    is_supported_payload,
+    load_datasets,
+    mark_phase,
     ntpu_contact,
     ntpu_course,
     ntpu_id,
+    preload,
+    process_memory,
+    process_rss,
+    save_datasets,
+    to_collapsed,
+    to_speedscope,
+    user_agent_pool,
+    watch_datasets,
 )
 
 app = Sanic(__name__)
 
+if PRELOAD:
+    # The workers share the datasets loaded by the main process, so they must be forked from it
+    Sanic.start_method = "fork"
+
+__MAX_WARM_UP_DELAY = 60
+
+
+def feature_checks(sanic: Sanic) -> dict[str, Callable[[], Awaitable[bool]]]:
+    """
+    Get the check bringing up each feature, by feature name.
+
+    Args:
+        sanic (Sanic): The Sanic application instance.
+
+    Returns:
+        dict[str, Callable[[], Awaitable[bool]]]: The checks, True if the feature is available.
+    """
+
+    return {
+        "sticker": STICKER.load_stickers,
+        "id": partial(ntpu_id.healthz, sanic),
+        "contact": partial(ntpu_contact.healthz, sanic),
+        "course": partial(ntpu_course.healthz, sanic),
+    }
+
+
+async def warm_up(sanic: Sanic) -> None:
+    """
+    Bring up the features in the background,
+    retrying the unavailable ones with a growing delay.
+
+    Args:
+        sanic (Sanic): The Sanic application instance.
+    """
+
+    # Build the user agents off the event loop, before the first upstream request needs them
+    await to_thread(user_agent_pool)
+
+    checks = feature_checks(sanic)
+    delay = 1
+
+    while pending := [f for f in checks if not READINESS.is_ready(f)]:
+        results = await gather(
+            *(checks[feature]() for feature in pending),
+            return_exceptions=True,
+        )
+
+        for feature, result in zip(pending, results):
+            READINESS.set(feature, result is True)
+
+        if not all(READINESS.is_ready(feature) for feature in pending):
+            await sleep(delay)
+            delay = min(delay * 2, __MAX_WARM_UP_DELAY)
+
+    mark_phase("warm")
+
+
+@app.main_process_start
+async def main_process_start(_: Sanic):
+    """Async function called in the main process before the workers start, preloading the datasets."""
+
+    if PRELOAD:
+        logger.info("Preloaded %d dataset entries", preload())
+
 
 @app.before_server_start
 async def before_server_start(sanic: Sanic):
     """
     Async function called before the server starts.
+    Only local state is loaded, the features come up in the background.
 
     Args:
         sanic (Sanic): The Sanic application instance.
     """
 
-    while not all(
-        await gather(
-            STICKER.load_stickers(),
-            ntpu_id.healthz(sanic),
-            ntpu_contact.healthz(sanic),
-            ntpu_course.healthz(sanic),
+    mark_phase("imported")
+    LOG_PIPELINE.start()
+    if not PRELOAD:
+        load_datasets()
+
+    WEBHOOK_EVENT_FILTER.load()
+    ntpu_course.COURSE_SUBSCRIPTIONS.load()
+
+    # Cached stickers are used until the sticker sites respond
+    STICKER.load_cache()
+    for feature in feature_checks(sanic):
+        READINESS.set(feature, False)
+
+    sanic.add_task(warm_up(sanic), name="warm_up")
+
+
+@app.after_server_start
+async def after_server_start(sanic: Sanic):
+    """Async function called after the server starts, starting the event workers and the outbox."""
+
+    EVENT_QUEUE.start()
+    LINE_API_UTIL.start_outbox()
+    TRACER.start_exporter()
+    MEMORY_REPORT.start_sampler()
+    if not is_crawler():
+        # The datasets saved by the crawling worker are picked up as they are saved
+        sanic.add_task(watch_datasets(), name="watch_datasets")
+
+    mark_phase("serving")
+
+    if memory := process_memory():
+        logger.info(
+            "Worker memory: %d bytes shared, %d bytes private",
+            memory["shared"],
+            memory["private"],
         )
-    ):
-        await sleep(1)
+
+
+@app.before_server_stop
+async def before_server_stop(_: Sanic):
+    """Async function called before the server stops, draining the queued events."""
+
+    await EVENT_QUEUE.drain()
+    await LINE_API_UTIL.stop_outbox()
+    await LINE_API_UTIL.close()
+    await TRACER.stop_exporter()
+    await MEMORY_REPORT.stop_sampler()
+    await JOBS.stop()
+    WEBHOOK_EVENT_FILTER.save()
+    if is_crawler():
+        save_datasets()
+
+    LOG_PIPELINE.stop()
 
 
 @app.route("/", methods=["HEAD", "GET"])
@@ -70,6 +210,210 @@ async def healthz(_: Request) -> HTTPResponse:
     return empty()
 
 
+@app.route("/readyz", methods=["GET"])
+async def readyz(_: Request) -> HTTPResponse:
+    """Shows whether each feature is available, without checking the upstreams."""
+
+    return json(READINESS.status())
+
+
+@app.route("/metrics", methods=["GET"])
+async def metrics(_: Request) -> HTTPResponse:
+    """Exposes the metrics in the Prometheus text format."""
+
+    PROCESS_RSS.set("current", value=process_rss())
+    process_memory()
+
+    return text(METRICS.render(), content_type="text/plain; version=0.0.4")
+
+
+@app.route("/debug/crawls", methods=["GET"])
+async def debug_crawls(request: Request) -> HTTPResponse:
+    """
+    Shows the progress of the current or last run of each crawler, for admins.
+    Only the crawling worker runs the crawlers.
+
+    Args:
+        request (Request): The request object.
+
+    Returns:
+        HTTPResponse: The progress of each crawler as JSON.
+    """
+
+    authorize_admin(request)
+
+    return json(CRAWLS.status())
+
+
+@app.route("/debug/memory", methods=["GET"])
+async def debug_memory(request: Request) -> HTTPResponse:
+    """
+    Reports the memory used by the datasets and caches of this worker, for admins.
+
+    With `?top=N`, allocations are traced and the N source lines allocating the most memory are added,
+    with the ones that grew the most since the previous call. `?stop=true` stops tracing.
+
+    Args:
+        request (Request): The request object.
+
+    Returns:
+        HTTPResponse: The memory report as JSON.
+
+    Raises:
+        BadRequest: If top is not an integer from 1 to 100.
+    """
+
+    authorize_admin(request)
+
+    if request.args.get("stop") == "true":
+        MEMORY_REPORT.stop_tracing()
+
+    allocations = None
+    if top := request.args.get("top"):
+        try:
+            allocations = MEMORY_REPORT.allocations(int(top))
+
+        except ValueError as exc:
+            raise BadRequest("Invalid top") from exc
+
+    return json(MEMORY_REPORT.report() | {"allocations": allocations})
+
+
+@app.route("/debug/profile", methods=["GET"])
+async def debug_profile(request: Request) -> HTTPResponse:
+    """
+    Profiles this worker for a few seconds with a sampling profiler, for admins.
+
+    `?seconds=N` sets the duration, 10 seconds by default. `?format=speedscope` downloads
+    a file for https://www.speedscope.app, otherwise the stacks are downloaded in the collapsed format
+    of flamegraph.pl.
+
+    Args:
+        request (Request): The request object.
+
+    Returns:
+        HTTPResponse: The profile as a file.
+
+    Raises:
+        BadRequest: If seconds is not a positive number or the format is unknown.
+        ServiceUnavailable: If the worker is already being profiled.
+    """
+
+    authorize_admin(request)
+
+    try:
+        seconds = float(request.args.get("seconds", "10"))
+
+    except ValueError as exc:
+        raise BadRequest("Invalid seconds") from exc
+
+    # nan and inf are parsed as floats too
+    if not isfinite(seconds) or seconds <= 0:
+        raise BadRequest("Invalid seconds")
+
+    profile_format = request.args.get("format", "collapsed")
+    if profile_format not in ("collapsed", "speedscope"):
+        raise BadRequest("Invalid format")
+
+    try:
+        stacks = await PROFILER.profile(seconds)
+
+    except RuntimeError as exc:
+        raise ServiceUnavailable("Already profiling") from exc
+
+    name = f"profile-{getpid()}-{strftime('%Y%m%d%H%M%S')}"
+    if profile_format == "speedscope":
+        return json(
+            to_speedscope(stacks, name),
+            headers={
+                "Content-Disposition": f'attachment; filename="{name}.speedscope.json"'
+            },
+        )
+
+    return text(
+        to_collapsed(stacks),
+        headers={"Content-Disposition": f'attachment; filename="{name}.txt"'},
+    )
+
+
+@app.route("/admin/caches", methods=["GET"])
+async def admin_caches(request: Request) -> HTTPResponse:
+    """
+    Shows the size and the lookups of each dataset and cache of this worker, for admins.
+
+    Args:
+        request (Request): The request object.
+
+    Returns:
+        HTTPResponse: The statistics of each dataset and cache as JSON.
+    """
+
+    authorize_admin(request)
+
+    return json(cache_stats())
+
+
+@app.route("/admin/jobs", methods=["GET", "POST"])
+async def admin_jobs(request: Request) -> HTTPResponse:
+    """
+    Lists the admin jobs of this worker, or queues one in the background with a POST.
+
+    The JSON body of a POST has the `action` ("invalidate", "refresh" or "prewarm")
+    and its parameters, see `admin_job`. The queued job is polled at /admin/jobs/<job_id>.
+
+    Args:
+        request (Request): The request object.
+
+    Returns:
+        HTTPResponse: The jobs, or the queued job with status 202.
+
+    Raises:
+        BadRequest: If the body is not a JSON object or the action is invalid.
+    """
+
+    authorize_admin(request)
+
+    if request.method == "GET":
+        return json(JOBS.status())
+
+    if not isinstance(request.json, dict):
+        raise BadRequest("The body must be a JSON object")
+
+    params = dict(request.json)
+    action = params.pop("action", None)
+    try:
+        run = admin_job(action, params)
+
+    except ValueError as exc:
+        raise BadRequest(str(exc)) from exc
+
+    return json(JOBS.submit(action, params, run).status(), status=202)
+
+
+@app.route("/admin/jobs/<job_id>", methods=["GET"])
+async def admin_job_status(request: Request, job_id: str) -> HTTPResponse:
+    """
+    Shows the state of an admin job of this worker.
+
+    Args:
+        request (Request): The request object.
+        job_id (str): The ID of the job.
+
+    Returns:
+        HTTPResponse: The state of the job as JSON.
+
+    Raises:
+        NotFound: If the job is unknown to this worker.
+    """
+
+    authorize_admin(request)
+
+    if (job := JOBS.get(job_id)) is None:
+        raise NotFound("Unknown job")
+
+    return json(job.status())
+
+
 @app.route("/healthy", methods=["HEAD", "GET"])
 async def healthy(request: Request) -> HTTPResponse:
     """
@@ -94,11 +438,71 @@ async def healthy(request: Request) -> HTTPResponse:
     return empty()
 
 
+async def check_services(sanic: Sanic) -> None:
+    """
+    Check the health of all services, renewing their base URLs if needed.
+
+    Args:
+        sanic (Sanic): The Sanic application instance.
+    """
+
+    features = ["id", "contact", "course"]
+    checks = feature_checks(sanic)
+
+    for feature, ready in zip(
+        features,
+        await gather(*(checks[feature]() for feature in features)),
+    ):
+        READINESS.set(feature, ready)
+
+
+async def process_event(
+    payload: dict[str, Any],
+    loaded_user_ids: set[str],
+    root: Optional[Span] = None,
+) -> None:
+    """
+    Build the event from its payload and handle it,
+    showing the loading animation if the reply may be slow.
+
+    Args:
+        payload (dict[str, Any]): The decoded JSON of the webhook event.
+        loaded_user_ids (set[str]): The users that already got a loading animation in this webhook.
+        root (Optional[Span]): The root span of the event, if it is traced. Defaults to None.
+    """
+
+    with TRACER.activate(root):
+        with TRACER.span("event.build"):
+            event = Event.from_dict(payload)
+
+        # Loading animations can only be shown in one-on-one chats
+        if not isinstance(event.source, UserSource):
+            await handle_event(event)
+            return
+
+        with TRACER.span("event.classify"):
+            is_local = is_local_event(event)
+
+        if is_local:
+            LOADING_SAVED.inc("local")
+            await handle_event(event)
+
+        else:
+            await LINE_API_UTIL.loading_until_done(
+                handle_event(event),
+                event.source.user_id,
+                loaded_user_ids,
+            )
+
+
 @app.route("/callback", methods=["POST"])
 async def callback(request: Request) -> HTTPResponse:
     """
     Handle LINE Bot webhook events.
 
+    The events are put in the event queue, so the response is sent
+    as soon as the signature is verified.
+
     Args:
         request (Request): The request object representing the incoming webhook request.
 
@@ -106,44 +510,63 @@ async def callback(request: Request) -> HTTPResponse:
         HTTPResponse: The response object indicating the success of the callback function.
 
     Raises:
-        ServiceUnavailable: If any of the services (ID, Contact, Course) are unavailable.
         Unauthorized: If the request signature is invalid.
+        BadRequest: If the request body is not valid JSON.
     """
 
-    if not all(
-        await gather(
-            *[
-                ntpu_id.healthz(request.app),
-                ntpu_contact.healthz(request.app),
-                ntpu_course.healthz(request.app),
-            ]
-        )
-    ):
-        raise ServiceUnavailable("Service Unavailable")
-
+    received_at = time_ns()
     try:
-        events = LINE_API_UTIL.parser.parse(
-            request.body.decode(),
+        payloads = LINE_API_UTIL.parse_payloads(
+            request.body,
             request.headers.get("X-Line-Signature"),
         )
 
-        for event in events:
-            await LINE_API_UTIL.loading_message(event.source.user_id)
+    except InvalidSignatureError as exc:
+        raise Unauthorized("Invalid signature") from exc
+
+    except ValueError as exc:
+        raise BadRequest("Invalid body") from exc
 
-            if isinstance(event, MessageEvent):
-                if isinstance(event.message, TextMessageContent):
-                    request.app.add_task(handle_text_message(event))
+    parsed_at = time_ns()
+    loaded_user_ids = set[str]()
 
-                elif isinstance(event.message, StickerMessageContent):
-                    request.app.add_task(handle_sticker_message(event))
+    for payload in payloads:
+        if not is_supported_payload(payload) or WEBHOOK_EVENT_FILTER.is_duplicate(
+            payload.get("webhookEventId", ""),
+            payload.get("deliveryContext", {}).get("isRedelivery", False),
+        ):
+            continue
 
-            elif isinstance(event, PostbackEvent):
-                request.app.add_task(handle_postback_event(event))
+        root = TRACER.start_trace(
+            "webhook.event",
+            received_at,
+            event_type=payload.get("type", ""),
+            webhook_event_id=payload.get("webhookEventId", ""),
+        )
+        TRACER.record(root, "callback.parse_payloads", received_at, parsed_at)
 
-            elif isinstance(event, (FollowEvent, JoinEvent, MemberJoinedEvent)):
-                request.app.add_task(handle_follow_join_event(event))
+        # The event models are built by the workers, off the response path
+        if EVENT_QUEUE.put(partial(process_event, payload, loaded_user_ids, root)):
+            continue
 
-        return empty()
+        try:
+            event = Event.from_dict(payload)
 
-    except InvalidSignatureError as exc:
-        raise Unauthorized("Invalid signature") from exc
+        except ValueError:
+            continue
+
+        # Shed the load: answer local events directly, ask the others to retry later
+        if is_local_event(event):
+            EVENT_SHED.inc("local")
+            request.app.add_task(handle_event(event))
+
+        else:
+            EVENT_SHED.inc("busy")
+            request.app.add_task(handle_busy_event(event))
+
+    # Renew the service base URLs in the background, at most one check at a time
+    task = request.app.get_task("check_services", raise_exception=False)
+    if task is None or task.done():
+        request.app.add_task(check_services(request.app), name="check_services")
+
+    return empty()
@@ -2,23 +2,75 @@
 from . import contact as ntpu_contact
 from . import course as ntpu_course
 from . import id as ntpu_id
-from .line_api_util import LINE_API_UTIL
+from .admin_util import admin_job, authorize_admin, cache_stats
+from .crawl_util import CRAWLS
+from .idempotency_util import WEBHOOK_EVENT_FILTER
+from .job_util import JOBS
+from .line_api_util import LINE_API_UTIL, LOADING_SAVED
+from .log_util import LOG_PIPELINE
+from .memory_report_util import MEMORY_REPORT
+from .memory_util import memory_usage
+from .metric_util import METRICS
+from .preload_util import (
+    PRELOAD,
+    is_crawler,
+    load_datasets,
+    preload,
+    save_datasets,
+    watch_datasets,
+)
+from .profile_util import PROFILER, to_collapsed, to_speedscope
+from .queue_util import EVENT_QUEUE, EVENT_SHED
+from .readiness_util import READINESS
 from .route_util import (
-    handle_follow_join_event,
-    handle_postback_event,
-    handle_sticker_message,
-    handle_text_message,
+    handle_busy_event,
+    handle_event,
+    is_local_event,
+    is_supported_payload,
 )
+from .startup_util import PROCESS_RSS, mark_phase, process_memory, process_rss
 from .sticker_util import STICKER
+from .trace_util import TRACER, Span
+from .user_agent_util import user_agent_pool
 
 __all__ = [
     "ntpu_contact",
     "ntpu_course",
     "ntpu_id",
+    "admin_job",
+    "authorize_admin",
+    "cache_stats",
+    "CRAWLS",
+    "JOBS",
     "LINE_API_UTIL",
-    "handle_follow_join_event",
-    "handle_postback_event",
-    "handle_sticker_message",
-    "handle_text_message",
+    "LOADING_SAVED",
+    "METRICS",
+    "LOG_PIPELINE",
+    "MEMORY_REPORT",
+    "memory_usage",
+    "PRELOAD",
+    "is_crawler",
+    "load_datasets",
+    "preload",
+    "save_datasets",
+    "watch_datasets",
+    "PROFILER",
+    "to_collapsed",
+    "to_speedscope",
+    "EVENT_QUEUE",
+    "EVENT_SHED",
+    "READINESS",
+    "handle_busy_event",
+    "handle_event",
+    "is_local_event",
+    "is_supported_payload",
+    "mark_phase",
+    "PROCESS_RSS",
+    "process_memory",
+    "process_rss",
     "STICKER",
+    "TRACER",
+    "Span",
+    "user_agent_pool",
+    "WEBHOOK_EVENT_FILTER",
 ]
@@ -1,9 +1,11 @@
 # -*- coding:utf-8 -*-
 from abc import ABC, abstractmethod
-from typing import Optional
+from typing import Optional, Sequence
 
 from linebot.v3.messaging.models import Message
 
+from .postback_util import PostbackHandler, encode_postback
+
 
 class Bot(ABC):
     """Abstract class for creating bots"""
@@ -14,10 +16,22 @@ class Bot(ABC):
 
         return "$"
 
+    @property
+    @abstractmethod
+    def commands(self) -> dict[str, Sequence[str]]:
+        """Keywords of each command, followed by a space and the criteria"""
+
+    @property
+    def prefix_commands(self) -> dict[str, Sequence[str]]:
+        """Keywords of each command that must start the message, followed by the criteria"""
+
+        return {}
+
     @abstractmethod
     async def handle_text_message(
         self,
         payload: str,
+        commands: dict[str, str],
         quote_token: Optional[str] = None,
     ) -> list[Message]:
         """
@@ -25,6 +39,7 @@ class Bot(ABC):
 
         Args:
             payload (str): The text message payload received by the bot.
+            commands (dict[str, str]): The criteria of each command of the bot found in the payload.
             quote_token (Optional[str]): An optional quote token used for quoting the message.
 
         Returns:
@@ -32,13 +47,50 @@ class Bot(ABC):
         """
 
     @abstractmethod
-    async def handle_postback_event(self, payload: str) -> list[Message]:
+    def needs_upstream_text(self, commands: dict[str, str]) -> bool:
+        """
+        Predict whether handling the text message needs an upstream request.
+
+        Args:
+            commands (dict[str, str]): The criteria of each command of the bot found in the payload.
+
+        Returns:
+            bool: True if the reply may not be served from local data.
+        """
+
+    @property
+    @abstractmethod
+    def postback_namespace(self) -> str:
+        """Namespace of the postback actions of the bot"""
+
+    @property
+    @abstractmethod
+    def postback_handlers(self) -> dict[str, PostbackHandler]:
+        """Handlers of the postback actions of the bot"""
+
+    def postback_data(self, action: str, *args: str | int) -> str:
+        """
+        Encode a postback action of the bot.
+
+        Args:
+            action (str): The name of the action.
+            *args (str | int): The arguments of the action.
+
+        Returns:
+            str: The postback data.
+        """
+
+        return encode_postback(self.postback_namespace, action, *args)
+
+    @abstractmethod
+    def parse_legacy_postback(self, payload: str) -> Optional[tuple[str, list[str]]]:
         """
-        Handle a postback event and return a list of messages as a response.
+        Translate a postback payload in the legacy format, still found in chat histories,
+        to an action of the bot.
 
         Args:
-            payload (str): The payload received by the bot representing a postback event.
+            payload (str): The legacy postback data.
 
         Returns:
-            list[Message]: A list of Message objects representing the bot's response to the postback event.
+            Optional[tuple[str, list[str]]]: The action and its arguments, None if the payload is not for the bot.
         """
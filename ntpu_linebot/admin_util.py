@@ -0,0 +1,257 @@
+# -*- coding:utf-8 -*-
+from asyncio import sleep
+from datetime import datetime
+from hmac import compare_digest
+from os import getenv
+from typing import Any, Awaitable, Callable
+
+from sanic import NotFound, Request, Unauthorized
+
+from .contact.request import CONTACT_REQUEST
+from .course.request import COURSE_REQUEST
+from .crawl_util import CRAWLS
+from .id.request import ID_REQUEST
+from .id.util import DEPARTMENT_CODE
+from .memory_report_util import MEMORY_REPORT
+from .memory_util import (
+    CACHE_LOOKUPS,
+    MEMORY_STORES,
+    TTL_CACHES,
+    MemoryStore,
+    MeteredTTLCache,
+)
+
+__ADMIN_TOKEN = getenv("ADMIN_TOKEN", "")
+__CONTACT_UNITS = {
+    "administrative": CONTACT_REQUEST.get_administrative_contacts,
+    "academic": CONTACT_REQUEST.get_academic_contacts,
+}
+__PREWARM = {
+    "student": ID_REQUEST.get_student_by_uid,
+    "course": COURSE_REQUEST.get_course_by_uid,
+    "contact": CONTACT_REQUEST.get_contacts_by_criteria,
+}
+__MAX_PREWARM_KEYS = 100
+__PREWARM_DELAY = 1
+
+
+def authorize_admin(request: Request) -> None:
+    """
+    Check the bearer token of a request to an admin endpoint against ADMIN_TOKEN.
+
+    Args:
+        request (Request): The request object.
+
+    Raises:
+        NotFound: If ADMIN_TOKEN is not set, so the admin endpoints do not exist.
+        Unauthorized: If the token is missing or wrong.
+    """
+
+    if not __ADMIN_TOKEN:
+        raise NotFound("Not Found")
+
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not compare_digest(
+        token.strip().encode(), __ADMIN_TOKEN.encode()
+    ):
+        raise Unauthorized("Invalid admin token", scheme="Bearer")
+
+
+def cache_stats() -> list[dict[str, Any]]:
+    """
+    Report the size and the lookups of each dataset and cache.
+
+    Returns:
+        list[dict[str, Any]]: The usage of each dataset and cache, with its hits and misses.
+    """
+
+    return [
+        usage
+        | {
+            "hits": CACHE_LOOKUPS.value(usage["name"], "hit"),
+            "misses": CACHE_LOOKUPS.value(usage["name"], "miss"),
+        }
+        for usage in MEMORY_REPORT.datasets()
+    ]
+
+
+def admin_job(action: str, params: dict[str, Any]) -> Callable[[], Awaitable[Any]]:
+    """
+    Check the parameters of an admin action and prepare it to run as a job.
+
+    Actions:
+        invalidate: Remove the entries of a dataset or cache (`cache`), by `key` or `prefix`, all if neither is given.
+        refresh: Fetch one student roster (`dataset` "student", `year`, `department`),
+            one course year (`dataset` "course", `year`) or one contact unit
+            (`dataset` "contact", `unit` "administrative" or "academic") again.
+        prewarm: Load the given `keys` of a dataset ("student", "course" or "contact") from the upstream.
+
+    Args:
+        action (str): The name of the action.
+        params (dict[str, Any]): The parameters of the action.
+
+    Returns:
+        Callable[[], Awaitable[Any]]: Runs the action, returning its result.
+
+    Raises:
+        ValueError: If the action or its parameters are invalid.
+    """
+
+    if action == "invalidate":
+        return __invalidate_job(params)
+
+    if action == "refresh":
+        return __refresh_job(params)
+
+    if action == "prewarm":
+        return __prewarm_job(params)
+
+    raise ValueError(f"Unknown action: {action}")
+
+
+def __invalidate_job(params: dict[str, Any]) -> Callable[[], Awaitable[Any]]:
+    """Prepare the invalidate action, see `admin_job`."""
+
+    cache = __find_cache(params.get("cache"))
+
+    key, prefix = params.get("key"), params.get("prefix")
+    if not isinstance(key, (str, type(None))) or not isinstance(
+        prefix, (str, type(None))
+    ):
+        raise ValueError("key and prefix must be strings")
+
+    async def run() -> dict[str, int]:
+        return {"removed": cache.invalidate(key, prefix)}
+
+    return run
+
+
+def __refresh_job(params: dict[str, Any]) -> Callable[[], Awaitable[Any]]:
+    """Prepare the refresh action, see `admin_job`."""
+
+    dataset = params.get("dataset")
+    cur_year = datetime.now().year - 1911
+
+    if dataset == "student":
+        year, department = params.get("year"), params.get("department")
+        if not isinstance(year, int) or not 100 < year <= cur_year:
+            raise ValueError("year must be a year of the Republic of China")
+
+        if department not in DEPARTMENT_CODE.values():
+            raise ValueError(f"Unknown department: {department}")
+
+        async def refresh_student() -> dict[str, int]:
+            await __check_url(ID_REQUEST)
+            # The cached roster would be returned instead of fetched
+            __find_cache("department_query").invalidate(f"{year}:{department}")
+            with CRAWLS.crawl("refresh_student", 1) as crawl:
+                students = await ID_REQUEST.get_students_by_year_and_department(
+                    year, department
+                )
+                crawl.advance()
+
+            return {"entries": len(students)}
+
+        return refresh_student
+
+    if dataset == "course":
+        year = params.get("year")
+        if not isinstance(year, int) or not 90 <= year <= cur_year:
+            raise ValueError("year must be a year of the Republic of China")
+
+        async def refresh_course() -> dict[str, int]:
+            await __check_url(COURSE_REQUEST)
+            with CRAWLS.crawl("refresh_course", 1) as crawl:
+                courses = await COURSE_REQUEST.get_simple_courses_by_year(year)
+                crawl.advance()
+
+            return {"entries": len(courses)}
+
+        return refresh_course
+
+    if dataset == "contact":
+        if (fetch := __CONTACT_UNITS.get(params.get("unit", ""))) is None:
+            raise ValueError(f"unit must be one of {', '.join(__CONTACT_UNITS)}")
+
+        async def refresh_contact() -> dict[str, int]:
+            await __check_url(CONTACT_REQUEST)
+            with CRAWLS.crawl("refresh_contact", 1) as crawl:
+                contacts = await fetch()
+                crawl.advance()
+
+            # Searches answered before the refresh may miss the new contacts
+            __find_cache("contact_query").invalidate()
+            return {"entries": len(contacts)}
+
+        return refresh_contact
+
+    raise ValueError(f"Unknown dataset: {dataset}")
+
+
+def __prewarm_job(params: dict[str, Any]) -> Callable[[], Awaitable[Any]]:
+    """Prepare the prewarm action, see `admin_job`."""
+
+    dataset = params.get("dataset")
+    if (fetch := __PREWARM.get(dataset)) is None:
+        raise ValueError(f"dataset must be one of {', '.join(__PREWARM)}")
+
+    keys = params.get("keys")
+    if (
+        not isinstance(keys, list)
+        or not 0 < len(keys) <= __MAX_PREWARM_KEYS
+        or not all(isinstance(key, str) for key in keys)
+    ):
+        raise ValueError(f"keys must be a list of 1 to {__MAX_PREWARM_KEYS} strings")
+
+    async def run() -> dict[str, str]:
+        results = dict[str, str]()
+        for key in keys:
+            try:
+                await fetch(key)
+                results[key] = "ok"
+
+            # Any failure of a key is reported in the result, the other keys are still warmed
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                results[key] = type(exc).__name__
+
+            await sleep(__PREWARM_DELAY)
+
+        return results
+
+    return run
+
+
+def __find_cache(name: Any) -> MemoryStore | MeteredTTLCache:
+    """
+    Get a dataset or cache by its name.
+
+    Args:
+        name (Any): The name of the dataset or cache.
+
+    Returns:
+        MemoryStore | MeteredTTLCache: The dataset or cache.
+
+    Raises:
+        ValueError: If there is no dataset or cache with the name.
+    """
+
+    for cache in [*MEMORY_STORES, *TTL_CACHES]:
+        if cache.name == name:
+            return cache
+
+    raise ValueError(f"Unknown cache: {name}")
+
+
+async def __check_url(request: Any) -> None:
+    """
+    Make sure an upstream site is reachable before a refresh.
+
+    Args:
+        request (Any): The request helper of the site, e.g. ID_REQUEST.
+
+    Raises:
+        ValueError: If the site is not reachable.
+    """
+
+    if not await request.check_url() and not await request.change_base_url():
+        raise ValueError("The upstream site is not reachable")
@@ -0,0 +1,125 @@
+# -*- coding:utf-8 -*-
+from asyncio import timeout
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from os import getenv
+from time import monotonic, time
+from typing import AsyncIterator, Iterator, Optional
+
+from .metric_util import Counter
+
+BUDGET_OVERRUNS = Counter(
+    "ntpu_linebot_budget_overruns_total",
+    "Stages stopped because their timeout or the reply latency budget ran out",
+    ("stage",),
+)
+
+REPLY_BUDGET = float(getenv("REPLY_BUDGET_SECONDS", "20"))
+REPLY_TOKEN_TTL = float(getenv("REPLY_TOKEN_SECONDS", "60"))
+# Time left to an enclosing stage to build a partial answer
+__NESTED_MARGIN = 0.5
+
+__DEADLINE = ContextVar[Optional[float]]("deadline", default=None)
+__EVENT_TIME = ContextVar[Optional[float]]("event_time", default=None)
+
+
+class BudgetExceeded(TimeoutError):
+    """Raised when a stage runs out of time"""
+
+    def __init__(self, stage_name: str) -> None:
+        super().__init__(f"Stage {stage_name} ran out of time")
+        self.stage_name = stage_name
+
+
+@contextmanager
+def latency_budget(
+    event_timestamp: Optional[int] = None, budget: float = REPLY_BUDGET
+) -> Iterator[None]:
+    """
+    Set the latency budget of the current event, counted from the time the event happened.
+
+    Args:
+        event_timestamp (int, optional): The event timestamp in milliseconds. Defaults to now.
+        budget (float, optional): The budget in seconds. Defaults to REPLY_BUDGET_SECONDS.
+    """
+
+    event_time = time()
+    if event_timestamp is not None:
+        event_time = min(event_timestamp / 1000, event_time)
+
+    elapsed = min(time() - event_time, budget)
+    token = __DEADLINE.set(monotonic() + budget - elapsed)
+    time_token = __EVENT_TIME.set(event_time)
+    try:
+        yield
+
+    finally:
+        __EVENT_TIME.reset(time_token)
+        __DEADLINE.reset(token)
+
+
+def event_age() -> Optional[float]:
+    """
+    Get the time since the current event happened.
+
+    Returns:
+        Optional[float]: The elapsed seconds, None if not handling an event.
+    """
+
+    if (event_time := __EVENT_TIME.get()) is None:
+        return None
+
+    return time() - event_time
+
+
+def remaining_budget() -> float:
+    """
+    Get the remaining latency budget of the current event.
+
+    Returns:
+        float: The remaining seconds, infinity if no budget is set.
+    """
+
+    if (deadline := __DEADLINE.get()) is None:
+        return float("inf")
+
+    return deadline - monotonic()
+
+
+@asynccontextmanager
+async def stage(name: str, seconds: float) -> AsyncIterator[None]:
+    """
+    Run a stage within its own timeout and the remaining latency budget.
+    Stages nested in it end a little earlier, so it can still answer with a partial result.
+    Stages outside of an event, e.g. background crawls, are not bounded.
+
+    Args:
+        name (str): The name of the stage, used in the overrun metric.
+        seconds (float): The timeout of the stage.
+
+    Raises:
+        BudgetExceeded: If the stage runs out of time.
+    """
+
+    if __DEADLINE.get() is None:
+        yield
+        return
+
+    if (limit := min(seconds, remaining_budget())) <= 0:
+        BUDGET_OVERRUNS.inc(name)
+        raise BudgetExceeded(name)
+
+    token = __DEADLINE.set(monotonic() + limit - __NESTED_MARGIN)
+    try:
+        async with timeout(limit):
+            yield
+
+    except BudgetExceeded:
+        raise
+
+    except TimeoutError as exc:
+        BUDGET_OVERRUNS.inc(name)
+        raise BudgetExceeded(name) from exc
+
+    finally:
+        __DEADLINE.reset(token)
@@ -0,0 +1,87 @@
+# -*- coding:utf-8 -*-
+from collections.abc import Hashable
+from typing import Generic, Iterable, TypeVar
+
+T = TypeVar("T", bound=Hashable)
+
+
+class _Node(Generic[T]):
+    """A node of the keyword trie"""
+
+    __slots__ = ("children", "targets")
+
+    def __init__(self) -> None:
+        self.children = dict[str, "_Node[T]"]()
+        self.targets = list[T]()
+
+
+class CommandRouter(Generic[T]):
+    """
+    Find the commands of a text message in one pass, with keyword tries compiled once.
+
+    A keyword followed by a space or a plus sign starts a command, and the rest of the message is its criteria,
+    the same as the regex of `normal_util.list_to_regex`.
+    A prefix keyword only starts a command at the beginning of the message, and needs no separator.
+    Keywords are matched case-insensitively.
+    """
+
+    __SEPARATORS = " +"
+
+    def __init__(self) -> None:
+        # Keywords are stored reversed, so they can be matched backwards from each separator
+        self.__suffixes = _Node[T]()
+        self.__prefixes = _Node[T]()
+
+    def add(self, keywords: Iterable[str], target: T, prefix: bool = False) -> None:
+        """
+        Add the keywords of a command.
+
+        Args:
+            keywords (Iterable[str]): The keywords starting the command.
+            target (T): The command returned when a keyword is found.
+            prefix (bool, optional): Whether the keywords must start the message. Defaults to False.
+        """
+
+        for keyword in keywords:
+            node = self.__prefixes if prefix else self.__suffixes
+            for char in keyword.lower() if prefix else reversed(keyword.lower()):
+                node = node.children.setdefault(char, _Node[T]())
+
+            if target not in node.targets:
+                node.targets.append(target)
+
+    def route(self, payload: str) -> dict[T, str]:
+        """
+        Find the commands in the message.
+
+        Args:
+            payload (str): The normalized text of the message.
+
+        Returns:
+            dict[T, str]: The criteria of each command found, after its first keyword.
+        """
+
+        commands = dict[T, str]()
+
+        node = self.__prefixes
+        for index, char in enumerate(payload):
+            if (node := node.children.get(char.lower())) is None:
+                break
+
+            for target in node.targets:
+                commands.setdefault(target, payload[index + 1 :])
+
+        for index, char in enumerate(payload):
+            if char not in self.__SEPARATORS:
+                continue
+
+            # Keywords contain no separator, so at most the word before is walked
+            node = self.__suffixes
+            for back in range(index - 1, -1, -1):
+                if (node := node.children.get(payload[back].lower())) is None:
+                    break
+
+                for target in node.targets:
+                    commands.setdefault(target, payload[index + 1 :])
+
+        return commands
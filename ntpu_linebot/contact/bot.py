@@ -1,5 +1,4 @@
 # -*- coding:utf-8 -*-
-from re import IGNORECASE, search
 from typing import Optional, Sequence
 
 from linebot.v3.messaging.models import (
@@ -16,8 +15,10 @@ from linebot.v3.messaging.models import (
 )
 
 from ..abs_bot import Bot
-from ..line_bot_util import EMPTY_POSTBACK_ACTION, get_sender
-from ..normal_util import list_to_regex, partition
+from ..budget_util import BudgetExceeded
+from ..line_bot_util import EMPTY_POSTBACK_ACTION, StaticReply, get_sender
+from ..normal_util import partition
+from ..postback_util import PostbackHandler, encode_postback
 from .contact import Contact, Individual, Organization
 from .util import search_contacts_by_criteria, search_contacts_by_name
 
@@ -37,76 +38,96 @@ class ContactBot(Bot):
         "連絡方式",
         "連絡方式",
     ]
-    __CONTACT_REGEX = list_to_regex(__VALID_CONTACT_STR)
+    __COMMANDS = {"contact": __VALID_CONTACT_STR}
+    __PREFIX_COMMANDS = {"emergency": ["緊急"]}
+    # 舊格式的回傳事件前綴 -> 動作
+    __LEGACY_POSTBACKS = {"查看更多": "more", "查看成員": "members", "查看資訊": "info"}
+    __EMERGENCY_REPLY = StaticReply(
+        [
+            TemplateMessage(
+                altText="緊急電話",
+                template=ButtonsTemplate(
+                    altText="各種緊急電話",
+                    text="\n\n".join(
+                        [
+                            "\n".join(
+                                [
+                                    f"三峽校區電話：{Contact.SANXIA_NORMAL_PHONE}",
+                                    f"三峽校區24H緊急行政電話：{Contact.SANXIA_24H_PHONE}",
+                                    f"三峽校區24H急難救助電話：{Contact.SANXIA_EMERGENCY_PHONE}",
+                                ]
+                            ),
+                            "\n".join(
+                                [
+                                    f"台北校區電話：{Contact.TAIPEI_NORMAL_PHONE}",
+                                    f"台北校區24H急難救助電話：{Contact.TAIPEI_EMERGENCY_PHONE}",
+                                ]
+                            ),
+                        ]
+                    ),
+                    defaultAction=URIAction(
+                        label="查看更多",
+                        uri="https://new.ntpu.edu.tw/safety",
+                    ),
+                    actions=[
+                        ClipboardAction(
+                            label="複製三峽校區24H緊急行政電話",
+                            clipboardText=Contact.SANXIA_24H_PHONE,
+                        ),
+                        ClipboardAction(
+                            label="複製三峽校區24H急難救助電話",
+                            clipboardText=Contact.SANXIA_EMERGENCY_PHONE,
+                        ),
+                        ClipboardAction(
+                            label="複製台北校區24H急難救助電話",
+                            clipboardText=Contact.TAIPEI_EMERGENCY_PHONE,
+                        ),
+                        URIAction(
+                            label="查看更多",
+                            uri="https://new.ntpu.edu.tw/safety",
+                        ),
+                    ],
+                ),
+                sender=get_sender(__SENDER_NAME),
+            )
+        ]
+    )
+
+    def __init__(self) -> None:
+        self.__postback_handlers = {
+            "more": PostbackHandler(self.__show_more, (str,)),
+            "members": PostbackHandler(self.__show_members, (str,)),
+            "info": PostbackHandler(self.__show_info, (str,)),
+        }
 
     @property
     def __sender_name(self) -> str:
         return self.__SENDER_NAME
 
     @property
-    def __contact_regex(self):
-        return self.__CONTACT_REGEX
+    def commands(self) -> dict[str, Sequence[str]]:
+        """聯絡資料的查詢指令"""
+
+        return self.__COMMANDS
+
+    @property
+    def prefix_commands(self) -> dict[str, Sequence[str]]:
+        """緊急電話的查詢指令"""
+
+        return self.__PREFIX_COMMANDS
 
     async def handle_text_message(
         self,
         payload: str,
+        commands: dict[str, str],
         quote_token: Optional[str] = None,
     ) -> list[Message]:
         """處理文字訊息"""
 
-        if payload.startswith("緊急"):
-            return [
-                TemplateMessage(
-                    altText="緊急電話",
-                    template=ButtonsTemplate(
-                        altText="各種緊急電話",
-                        text="\n\n".join(
-                            [
-                                "\n".join(
-                                    [
-                                        f"三峽校區電話：{Contact.SANXIA_NORMAL_PHONE}",
-                                        f"三峽校區24H緊急行政電話：{Contact.SANXIA_24H_PHONE}",
-                                        f"三峽校區24H急難救助電話：{Contact.SANXIA_EMERGENCY_PHONE}",
-                                    ]
-                                ),
-                                "\n".join(
-                                    [
-                                        f"台北校區電話：{Contact.TAIPEI_NORMAL_PHONE}",
-                                        f"台北校區24H急難救助電話：{Contact.TAIPEI_EMERGENCY_PHONE}",
-                                    ]
-                                ),
-                            ]
-                        ),
-                        defaultAction=URIAction(
-                            label="查看更多",
-                            uri="https://new.ntpu.edu.tw/safety",
-                        ),
-                        actions=[
-                            ClipboardAction(
-                                label="複製三峽校區24H緊急行政電話",
-                                clipboardText=Contact.SANXIA_24H_PHONE,
-                            ),
-                            ClipboardAction(
-                                label="複製三峽校區24H急難救助電話",
-                                clipboardText=Contact.SANXIA_EMERGENCY_PHONE,
-                            ),
-                            ClipboardAction(
-                                label="複製台北校區24H急難救助電話",
-                                clipboardText=Contact.TAIPEI_EMERGENCY_PHONE,
-                            ),
-                            URIAction(
-                                label="查看更多",
-                                uri="https://new.ntpu.edu.tw/safety",
-                            ),
-                        ],
-                    ),
-                    sender=get_sender(self.__sender_name),
-                )
-            ]
-
-        if m := search(self.__contact_regex, payload, IGNORECASE):
-            criteria = m.group()
+        if "emergency" in commands:
+            return self.__EMERGENCY_REPLY.messages()
 
+        if (criteria := commands.get("contact")) is not None:
             if contacts := search_contacts_by_name(criteria):
                 return [
                     TemplateMessage(
@@ -117,7 +138,19 @@ class ContactBot(Bot):
                     for template in self.__generate_contact_templates(contacts)
                 ]
 
-            if contacts := await search_contacts_by_criteria(criteria):
+            try:
+                contacts = await search_contacts_by_criteria(criteria)
+
+            except BudgetExceeded:
+                return [
+                    TextMessage(
+                        text=f"查詢「{criteria}」逾時，請稍後再試",
+                        sender=get_sender(self.__sender_name),
+                        quoteToken=quote_token,
+                    )
+                ]
+
+            if contacts:
                 return [
                     TemplateMessage(
                         altText="搜尋結果",
@@ -137,58 +170,101 @@ class ContactBot(Bot):
 
         return []
 
-    async def handle_postback_event(self, payload: str) -> list[Message]:
-        """處理回傳事件"""
+    def needs_upstream_text(self, commands: dict[str, str]) -> bool:
+        """找不到本地資料時會連線搜尋"""
 
-        if payload.startswith("查看更多"):
-            payload = payload.split(self.split_char)[1]
+        return "emergency" not in commands and "contact" in commands
 
-            if contacts := search_contacts_by_name(payload):
-                return [
-                    TemplateMessage(
-                        altText="更多資訊",
-                        template=template,
-                        sender=get_sender(self.__sender_name),
-                    )
-                    for template in self.__generate_contact_templates(contacts, True)
-                ]
+    @property
+    def postback_namespace(self) -> str:
+        """聯繫魔法師的回傳事件"""
+
+        return "contact"
+
+    @property
+    def postback_handlers(self) -> dict[str, PostbackHandler]:
+        """查看更多、成員與教師資訊的回傳事件"""
+
+        return self.__postback_handlers
 
-        if payload.startswith("查看成員"):
-            payload = payload.split(self.split_char)[1]
-
-            if contacts := search_contacts_by_name(payload):
-                if isinstance(contact := contacts[0], Organization):
-                    return [
-                        TemplateMessage(
-                            altText="成員清單",
-                            template=template,
-                            sender=get_sender(self.__sender_name),
-                        )
-                        for template in self.__generate_contact_templates(
-                            contact.members
-                        )
-                    ]
-
-        if payload.startswith("查看資訊"):
-            payload = payload.split(self.split_char)[1]
-
-            if contacts := search_contacts_by_name(payload):
-                if individual_contacts := [
-                    c for c in contacts if isinstance(c, Individual)
-                ]:
-                    return [
-                        TemplateMessage(
-                            altText="更多資訊",
-                            template=template,
-                            sender=get_sender(self.__sender_name),
-                        )
-                        for template in self.__generate_contact_templates(
-                            individual_contacts
-                        )
-                    ]
+    def parse_legacy_postback(self, payload: str) -> Optional[tuple[str, list[str]]]:
+        """舊格式為「查看更多$名稱」、「查看成員$名稱」與「查看資訊$名稱」"""
+
+        prefix, split_char, name = payload.partition(self.split_char)
+        if split_char and (action := self.__LEGACY_POSTBACKS.get(prefix)):
+            return action, [name]
+
+        return None
+
+    async def __show_more(self, _: Optional[str], name: str) -> list[Message]:
+        """
+        Reply with more information of the contacts with the name.
+
+        Args:
+            name (str): The name of the contact.
+
+        Returns:
+            list[Message]: The contact templates, empty if not found.
+        """
+
+        return [
+            TemplateMessage(
+                altText="更多資訊",
+                template=template,
+                sender=get_sender(self.__sender_name),
+            )
+            for template in self.__generate_contact_templates(
+                search_contacts_by_name(name), True
+            )
+        ]
+
+    async def __show_members(self, _: Optional[str], name: str) -> list[Message]:
+        """
+        Reply with the members of the organization with the name.
+
+        Args:
+            name (str): The name of the organization.
+
+        Returns:
+            list[Message]: The member templates, empty if not found.
+        """
+
+        if (contacts := search_contacts_by_name(name)) and isinstance(
+            contact := contacts[0], Organization
+        ):
+            return [
+                TemplateMessage(
+                    altText="成員清單",
+                    template=template,
+                    sender=get_sender(self.__sender_name),
+                )
+                for template in self.__generate_contact_templates(contact.members)
+            ]
 
         return []
 
+    async def __show_info(self, _: Optional[str], name: str) -> list[Message]:
+        """
+        Reply with the information of the individuals with the name, e.g. a teacher.
+
+        Args:
+            name (str): The name of the individual.
+
+        Returns:
+            list[Message]: The individual templates, empty if not found.
+        """
+
+        return [
+            TemplateMessage(
+                altText="更多資訊",
+                template=template,
+                sender=get_sender(self.__sender_name),
+            )
+            for template in self.__generate_contact_templates(
+                [c for c in search_contacts_by_name(name) if isinstance(c, Individual)]
+            )
+        ]
+
     def __generate_individual_carousel_column(
         self,
         individual: Individual,
@@ -238,7 +314,7 @@ class ContactBot(Bot):
                 PostbackAction(
                     label="查看更多",
                     displayText=f"搜尋 {individual.name} 的更多資訊",
-                    data=f"查看更多{self.split_char}{individual.name}",
+                    data=self.postback_data("more", individual.name),
                 )
             )
 
@@ -263,7 +339,7 @@ class ContactBot(Bot):
                 PostbackAction(
                     label="授課課程",
                     displayText=f"搜尋 {individual.name} 的授課課程",
-                    data=f"授課課程{self.split_char}{individual.name}",
+                    data=encode_postback("course", "teacher", individual.name),
                 )
             )
 
@@ -314,7 +390,7 @@ class ContactBot(Bot):
             PostbackAction(
                 label="查看成員",
                 displayText=f"搜尋 {organization.name} 的成員",
-                data=f"查看成員{self.split_char}{organization.name}",
+                data=self.postback_data("members", organization.name),
             )
         )
 
@@ -2,13 +2,18 @@
 from typing import Optional
 from urllib.parse import quote
 
-from httpx import AsyncClient, HTTPError
+from httpx import HTTPError
 from asyncache import cached
-from bs4 import BeautifulSoup as Bs4
 from bs4 import NavigableString
-from cachetools import TTLCache
-from fake_useragent import UserAgent
 
+from ..budget_util import stage
+from ..memory_util import (
+    MemoryStore,
+    MeteredTTLCache,
+    budget_from_env,
+    max_age_from_env,
+)
+from ..upstream_util import UpstreamClient, parse_html
 from .contact import Contact, Individual, Organization
 
 
@@ -19,11 +24,15 @@ class ContactRequest:
         "https://120.126.197.7",
         "https://sea.cc.ntpu.edu.tw",
     ]
-    __UA = UserAgent(min_percentage=0.01)
     __ALL_ADMINISTATIVE_URL = "/pls/ld/CAMPUS_DIR_M.p1?kind=1"
     __ALL_ACADEMIC_URL = "/pls/ld/CAMPUS_DIR_M.p1?kind=2"
     __SEARCH_URL = "/pls/ld/CAMPUS_DIR_M.pq?q="
-    CONTACT_DICT = dict[str, Contact]()
+    __SEARCH_TIMEOUT = 8
+    CONTACT_DICT = MemoryStore[str, Contact](
+        "contact",
+        budget=budget_from_env("CONTACT_DICT", 16),
+        max_age=max_age_from_env("CONTACT_DICT"),
+    )
 
     async def check_url(self, url: Optional[str] = None) -> bool:
         """
@@ -43,9 +52,7 @@ class ContactRequest:
             return False
 
         try:
-            async with AsyncClient(
-                headers={"User-Agent": self.__UA.random}
-            ) as client:
+            async with UpstreamClient("check") as client:
                 await client.head(url)
 
         except HTTPError:
@@ -81,11 +88,9 @@ class ContactRequest:
         contacts: list[Contact] = []
 
         try:
-            async with AsyncClient(
-                headers={"User-Agent": self.__UA.random}
-            ) as client:
+            async with UpstreamClient("contacts") as client:
                 res = await client.get(url)
-                soup = Bs4(res.text, "lxml")
+                soup = parse_html(res.text, "contacts")
 
                 for organization in soup.find_all(
                     "div", {"class": "alert alert-info mt-0 mb-0"}
@@ -162,11 +167,9 @@ class ContactRequest:
         contacts: list[Contact] = []
 
         try:
-            async with AsyncClient(
-                headers={"User-Agent": self.__UA.random}
-            ) as client:
+            async with UpstreamClient("directory") as client:
                 res = await client.get(url)
-                soup = Bs4(res.text, "lxml")
+                soup = parse_html(res.text, "directory")
 
                 for department in soup.find_all("div", {"class": "card-header"}):
                     url = f"{self.__base_url}/pls/ld/{department.find("a")["href"]}"
@@ -200,7 +203,7 @@ class ContactRequest:
         url = self.__base_url + self.__ALL_ACADEMIC_URL
         return await self.get_contact_pages_by_url(url)
 
-    @cached(TTLCache(maxsize=9, ttl=60 * 60 * 24 * 7))
+    @cached(MeteredTTLCache("contact_query", maxsize=9, ttl=60 * 60 * 24 * 7))
     async def get_contacts_by_criteria(self, criteria: str) -> list[Contact]:
         """
         Asynchronously retrieves contacts by the given criteria and returns a list of Contact objects.
@@ -210,11 +213,16 @@ class ContactRequest:
 
         Returns:
             list[Contact]: A list of Contact objects if found.
+
+        Raises:
+            BudgetExceeded: If the request runs out of time.
         """
 
         criteria = quote(criteria, encoding="big5")
         url = self.__base_url + self.__SEARCH_URL + criteria
-        return await self.get_contacts_by_url(url)
+
+        async with stage("contact.search", self.__SEARCH_TIMEOUT):
+            return await self.get_contacts_by_url(url)
 
 
 CONTACT_REQUEST = ContactRequest()
@@ -7,6 +7,8 @@ from sanic import Sanic
 
 from ntpu_linebot.contact.contact import Contact, Individual, Organization
 
+from ..crawl_util import CRAWLS
+from ..preload_util import is_crawler, persist_dataset
 from .request import CONTACT_REQUEST
 
 
@@ -26,8 +28,9 @@ async def healthz(app: Sanic, force: bool = False) -> bool:
         return True
 
     if force or await CONTACT_REQUEST.change_base_url():
-        await app.cancel_task("load_contact_dict", raise_exception=False)
-        app.add_task(load_contact_dict(), name="load_contact_dict")
+        if is_crawler():
+            await app.cancel_task("load_contact_dict", raise_exception=False)
+            app.add_task(load_contact_dict(), name="load_contact_dict")
 
         return True
 
@@ -37,10 +40,18 @@ async def healthz(app: Sanic, force: bool = False) -> bool:
 async def load_contact_dict() -> None:
     """Updates the contact dict for each year."""
 
-    await sleep(random.uniform(15, 25))
-    await CONTACT_REQUEST.get_administrative_contacts()
-    await sleep(random.uniform(15, 25))
-    await CONTACT_REQUEST.get_academic_contacts()
+    try:
+        with CRAWLS.crawl("contact", 2) as crawl:
+            await sleep(random.uniform(15, 25))
+            await CONTACT_REQUEST.get_administrative_contacts()
+            crawl.advance()
+            await sleep(random.uniform(15, 25))
+            await CONTACT_REQUEST.get_academic_contacts()
+            crawl.advance()
+
+    finally:
+        # Keep what was crawled, even when the crawl stopped part way
+        await persist_dataset("contact")
 
 
 def search_contact_by_uid(uid: str) -> Optional[Contact]:
@@ -54,6 +65,7 @@ def search_contact_by_uid(uid: str) -> Optional[Contact]:
         Optional[Contact]: The contact object if found, otherwise None.
     """
 
+    CONTACT_REQUEST.CONTACT_DICT.touch([uid])
     return CONTACT_REQUEST.CONTACT_DICT.get(uid)
 
 
@@ -68,13 +80,16 @@ def search_contacts_by_name(name: str) -> list[Contact]:
         list[Contact]: A list of Contact objects with the matching name.
     """
 
-    return [
+    contacts = [
         contact
         for contact in CONTACT_REQUEST.CONTACT_DICT.values()
         if name == contact.name
         or isinstance(contact, Organization)
         and name == contact.superior
     ]
+    CONTACT_REQUEST.CONTACT_DICT.touch(contact.uid for contact in contacts)
+
+    return contacts
 
 
 async def search_contacts_by_criteria(criteria: str) -> list[Contact]:
@@ -86,6 +101,9 @@ async def search_contacts_by_criteria(criteria: str) -> list[Contact]:
 
     Returns:
         list[Contact]: A list of contacts matching the criteria.
+
+    Raises:
+        BudgetExceeded: If the upstream request runs out of time.
     """
 
     if contacts := [
@@ -95,6 +113,7 @@ async def search_contacts_by_criteria(criteria: str) -> list[Contact]:
         or isinstance(contact, Organization)
         and set(criteria).issubset(contact.superior)
     ]:
+        CONTACT_REQUEST.CONTACT_DICT.touch(contact.uid for contact in contacts)
         return contacts
 
     return await CONTACT_REQUEST.get_contacts_by_criteria(criteria)
@@ -1,5 +1,6 @@
 # -*- coding:utf-8 -*-
 from .bot import COURSE_BOT
+from .subscription import COURSE_SUBSCRIPTIONS
 from .util import healthz
 
-__all__ = ["COURSE_BOT", "healthz"]
+__all__ = ["COURSE_BOT", "COURSE_SUBSCRIPTIONS", "healthz"]
@@ -1,7 +1,8 @@
 # -*- coding:utf-8 -*-
+from functools import partial
 from random import sample
-from re import IGNORECASE, fullmatch, match, search
-from typing import Optional
+from re import IGNORECASE, fullmatch
+from typing import Optional, Sequence
 
 from linebot.v3.messaging.models import (
     ButtonsTemplate,
@@ -9,17 +10,23 @@ from linebot.v3.messaging.models import (
     CarouselTemplate,
     Message,
     PostbackAction,
+    QuickReply,
+    QuickReplyItem,
     TemplateMessage,
     TextMessage,
     URIAction,
 )
 
 from ..abs_bot import Bot
+from ..budget_util import BudgetExceeded
 from ..line_bot_util import EMPTY_POSTBACK_ACTION, get_sender
-from ..normal_util import list_to_regex
+from ..postback_util import PostbackHandler, encode_postback
 from .course import ALL_EDU_CODE, Course, SimpleCourse
+from .subscription import COURSE_SUBSCRIPTIONS
 from .util import (
     SearchKind,
+    get_loaded_course,
+    is_course_loaded,
     search_course_by_uid,
     search_simple_courses_by_criteria_and_kind,
 )
@@ -61,26 +68,62 @@ class CourseBot(Bot):
         "授課教授",
     ]
     __UID_REGEX = r"\d{3,4}[" + "".join(ALL_EDU_CODE) + r"]\d{4}"
-    __SEARCH_REGEX = r"|".join(__VALID_CLASS_STR + __VALID_TEACHER_STR)
-    __CLASS_REGEX = list_to_regex(__VALID_CLASS_STR)
-    __TEACHER_REGEX = list_to_regex(__VALID_TEACHER_STR)
+    __COMMANDS = {"title": __VALID_CLASS_STR, "teacher": __VALID_TEACHER_STR}
+    __PREFIX_COMMANDS = {"search": __VALID_CLASS_STR + __VALID_TEACHER_STR}
+    # 舊格式的回傳事件前綴 -> 動作
+    __LEGACY_POSTBACKS = {
+        "授課課程": "teacher",
+        "訂閱課程": "subscribe",
+        "取消訂閱": "unsubscribe",
+    }
+
+    def __init__(self) -> None:
+        self.__postback_handlers = {
+            "teacher": PostbackHandler(self.__search_teacher, (str,)),
+            "detail": PostbackHandler(
+                self.__show_course,
+                (str,),
+                needs_upstream=lambda uid: bool(
+                    fullmatch(self.__UID_REGEX, uid, IGNORECASE)
+                    and not is_course_loaded(uid)
+                ),
+            ),
+            "subscribe": PostbackHandler(
+                partial(self.__change_subscription, subscribe=True), (str,)
+            ),
+            "unsubscribe": PostbackHandler(
+                partial(self.__change_subscription, subscribe=False), (str,)
+            ),
+        }
+
+    @property
+    def commands(self) -> dict[str, Sequence[str]]:
+        """課程名稱與授課教師的查詢指令"""
+
+        return self.__COMMANDS
+
+    @property
+    def prefix_commands(self) -> dict[str, Sequence[str]]:
+        """課程查詢要以關鍵字開頭"""
+
+        return self.__PREFIX_COMMANDS
 
     async def handle_text_message(
         self,
         payload: str,
+        commands: dict[str, str],
         quote_token: Optional[str] = None,
     ) -> list[Message]:
         """處理文字訊息"""
 
-        if match(self.__SEARCH_REGEX, payload, IGNORECASE):
-            if m := search(self.__CLASS_REGEX, payload, IGNORECASE):
-                criteria = m.group()
-                kind = SearchKind.TITLE
-
-            if m := search(self.__TEACHER_REGEX, payload, IGNORECASE):
-                criteria = m.group()
+        if "search" in commands and ("title" in commands or "teacher" in commands):
+            if (criteria := commands.get("teacher")) is not None:
                 kind = SearchKind.TEACHER
 
+            else:
+                criteria = commands["title"]
+                kind = SearchKind.TITLE
+
             if courses := search_simple_courses_by_criteria_and_kind(criteria, kind):
                 return [
                     TemplateMessage(
@@ -108,49 +151,191 @@ class CourseBot(Bot):
 
         return []
 
-    async def handle_postback_event(self, payload: str) -> list[Message]:
-        """處理回傳事件"""
+    def needs_upstream_text(self, commands: dict[str, str]) -> bool:
+        """課程搜尋都使用本地資料"""
 
-        if payload.startswith("授課課程"):
-            payload = payload.split(self.split_char)[1]
+        return False
 
-            if courses := search_simple_courses_by_criteria_and_kind(
-                payload,
-                SearchKind.STRICT_TEACHER,
-            ):
-                return [
-                    TemplateMessage(
-                        altText="請選擇要查詢的課程",
-                        template=self.__choose_course_message(courses),
-                        sender=get_sender(self.__SENDER_NAME),
-                    )
-                ]
+    @property
+    def postback_namespace(self) -> str:
+        """課程魔法師的回傳事件"""
+
+        return "course"
+
+    @property
+    def postback_handlers(self) -> dict[str, PostbackHandler]:
+        """授課課程、課程資訊與異動通知的回傳事件"""
+
+        return self.__postback_handlers
+
+    def parse_legacy_postback(self, payload: str) -> Optional[tuple[str, list[str]]]:
+        """舊格式為「授課課程$教師」、「訂閱課程$uid」、「取消訂閱$uid」與課程 uid"""
+
+        prefix, split_char, arg = payload.partition(self.split_char)
+        if split_char and (action := self.__LEGACY_POSTBACKS.get(prefix)):
+            return action, [arg]
+
+        if fullmatch(self.__UID_REGEX, payload, IGNORECASE):
+            return "detail", [payload]
+
+        return None
+
+    async def __search_teacher(self, _: Optional[str], teacher: str) -> list[Message]:
+        """
+        Reply with the courses taught by the teacher.
+
+        Args:
+            teacher (str): The full name of the teacher.
+
+        Returns:
+            list[Message]: The courses to choose from.
+        """
+
+        if courses := search_simple_courses_by_criteria_and_kind(
+            teacher,
+            SearchKind.STRICT_TEACHER,
+        ):
+            return [
+                TemplateMessage(
+                    altText="請選擇要查詢的課程",
+                    template=self.__choose_course_message(courses),
+                    sender=get_sender(self.__SENDER_NAME),
+                )
+            ]
+
+        return [
+            TextMessage(
+                text=f"查無授課教師為「{teacher}」的課程",
+                sender=get_sender(self.__SENDER_NAME),
+            )
+        ]
+
+    async def __show_course(self, user_id: Optional[str], uid: str) -> list[Message]:
+        """
+        Reply with the information of the course.
 
+        Args:
+            user_id (Optional[str]): The user ID, None if not in a one-on-one chat.
+            uid (str): The unique identifier of the course.
+
+        Returns:
+            list[Message]: The course information, empty if the UID is invalid.
+        """
+
+        if not fullmatch(self.__UID_REGEX, uid, IGNORECASE):
+            return []
+
+        try:
+            course = await search_course_by_uid(uid)
+
+        except BudgetExceeded:
             return [
                 TextMessage(
-                    text=f"查無授課教師為「{payload}」的課程",
+                    text=f"查詢 uid 為「{uid}」的課程逾時，請稍後再試",
                     sender=get_sender(self.__SENDER_NAME),
                 )
             ]
 
-        if fullmatch(self.__UID_REGEX, payload, IGNORECASE):
-            if course := await search_course_by_uid(payload):
-                return [
-                    TemplateMessage(
-                        altText=f"{course.title}的課程資訊",
-                        template=self.__course_info_message(course),
-                        sender=get_sender(self.__SENDER_NAME),
-                    )
-                ]
+        if isinstance(course, Course):
+            return [
+                TemplateMessage(
+                    altText=f"{course.title}的課程資訊",
+                    template=self.__course_info_message(course),
+                    sender=get_sender(self.__SENDER_NAME),
+                    quickReply=self.__subscription_quick_reply(course, user_id),
+                )
+            ]
 
+        if course:
             return [
                 TextMessage(
-                    text=f"查無 uid 為「{payload}」的課程",
+                    text=f"{self.__generate_course_text(course)}\n\n詳細資訊查詢逾時，請稍後再試",
                     sender=get_sender(self.__SENDER_NAME),
                 )
             ]
 
-        return []
+        return [
+            TextMessage(
+                text=f"查無 uid 為「{uid}」的課程",
+                sender=get_sender(self.__SENDER_NAME),
+            )
+        ]
+
+    async def __change_subscription(
+        self,
+        user_id: Optional[str],
+        uid: str,
+        subscribe: bool,
+    ) -> list[Message]:
+        """
+        Subscribe to or unsubscribe from the changes of a course.
+
+        Args:
+            user_id (Optional[str]): The user ID, None if not in a one-on-one chat.
+            uid (str): The unique identifier of the course.
+            subscribe (bool): Whether to subscribe or unsubscribe.
+
+        Returns:
+            list[Message]: The result of the action.
+        """
+
+        if user_id is None:
+            text = "請私訊課程魔法師來訂閱課程異動通知"
+
+        elif (course := get_loaded_course(uid)) is None:
+            text = f"查無 uid 為「{uid}」的課程"
+
+        elif not subscribe:
+            await COURSE_SUBSCRIPTIONS.unsubscribe(user_id, uid)
+            text = f"已取消「{course.title}」的異動通知"
+
+        elif await COURSE_SUBSCRIPTIONS.subscribe(user_id, course):
+            text = f"已訂閱「{course.title}」的異動通知\n時間、地點或教師異動時會通知你"
+
+        else:
+            text = "訂閱的課程已達上限，請先取消其他課程的訂閱"
+
+        return [
+            TextMessage(
+                text=text,
+                sender=get_sender(self.__SENDER_NAME),
+            )
+        ]
+
+    def __subscription_quick_reply(
+        self,
+        course: Course,
+        user_id: Optional[str],
+    ) -> Optional[QuickReply]:
+        """
+        Generate the quick reply to subscribe to or unsubscribe from the changes of a course.
+
+        Args:
+            course (Course): The course shown to the user.
+            user_id (Optional[str]): The user ID, None if not in a one-on-one chat.
+
+        Returns:
+            Optional[QuickReply]: The quick reply, None if the user cannot subscribe.
+        """
+
+        if user_id is None:
+            return None
+
+        if COURSE_SUBSCRIPTIONS.is_subscribed(user_id, course.uid):
+            action = PostbackAction(
+                label="取消異動通知",
+                displayText=f"取消 {course.title} 的異動通知",
+                data=self.postback_data("unsubscribe", course.uid),
+            )
+
+        else:
+            action = PostbackAction(
+                label="訂閱異動通知",
+                displayText=f"訂閱 {course.title} 的異動通知",
+                data=self.postback_data("subscribe", course.uid),
+            )
+
+        return QuickReply(items=[QuickReplyItem(action=action)])
 
     def __course_info_message(self, course: Course) -> ButtonsTemplate:
         """
@@ -172,7 +357,7 @@ class CourseBot(Bot):
             teacher_actions.append(
                 PostbackAction(
                     label="查看教師資訊",
-                    data=f"查看資訊{self.split_char}{course.teachers[0]}",
+                    data=encode_postback("contact", "info", course.teachers[0]),
                 )
             )
 
@@ -239,7 +424,7 @@ class CourseBot(Bot):
             PostbackAction(
                 label=course.title,
                 displayText=f"查詢 {course.title} 的課程資訊",
-                data=course.uid,
+                data=self.postback_data("detail", course.uid),
             )
             for course in courses
         ]
@@ -1,5 +1,6 @@
 # -*- coding:utf-8 -*-
 ALL_EDU_CODE = ["U", "M", "N", "P"]
+RECENT_YEAR_COUNT = 5
 
 
 class SimpleCourse:
@@ -1,14 +1,22 @@
 # -*- coding:utf-8 -*-
+from datetime import datetime
 from re import search, sub
 from typing import Optional
 
-from httpx import AsyncClient, HTTPError, Timeout
+from httpx import HTTPError, Timeout
 from asyncache import cached
 from bs4 import BeautifulSoup as Bs4
-from cachetools import TTLCache
-from fake_useragent import UserAgent
 
-from .course import ALL_EDU_CODE, Course, SimpleCourse
+from ..budget_util import stage
+from ..memory_util import (
+    MemoryStore,
+    MeteredTTLCache,
+    budget_from_env,
+    max_age_from_env,
+)
+from ..upstream_util import UpstreamClient, parse_html
+from .course import ALL_EDU_CODE, RECENT_YEAR_COUNT, Course, SimpleCourse
+from .subscription import COURSE_SUBSCRIPTIONS
 
 __CLASSROOM_STR_LIST = ["教室", "上課地點"]
 __CLASSROOM_REGEX = (
@@ -97,8 +105,15 @@ class CourseRequest:
         "https://sea.cc.ntpu.edu.tw",
     ]
     __COURSE_QUERY_URL = "/pls/dev_stud/course_query_all.queryByKeyword"
-    __UA = UserAgent(min_percentage=0.01)
-    COURSE_DICT = dict[str, SimpleCourse]()
+    __DETAIL_TIMEOUT = 8
+    COURSE_DICT = MemoryStore[str, SimpleCourse](
+        "course",
+        budget=budget_from_env("COURSE_DICT", 64),
+        max_age=max_age_from_env("COURSE_DICT"),
+        is_stale=lambda _, course: (
+            course.year <= datetime.now().year - 1911 - RECENT_YEAR_COUNT
+        ),
+    )
 
     async def check_url(self, url: Optional[str] = None) -> bool:
         """
@@ -118,7 +133,7 @@ class CourseRequest:
             return False
 
         try:
-            async with AsyncClient(headers={"User-Agent": self.__UA.random}) as client:
+            async with UpstreamClient("check") as client:
                 await client.head(url)
 
         except HTTPError:
@@ -140,7 +155,7 @@ class CourseRequest:
         self.__base_url = ""
         return False
 
-    @cached(TTLCache(maxsize=9, ttl=60 * 60 * 24 * 7))
+    @cached(MeteredTTLCache("course_query", maxsize=9, ttl=60 * 60 * 24 * 7))
     async def get_course_by_uid(self, uid: str) -> Course:
         """
         Asynchronously retrieves a course by UID from the specified URL and returns a Course object if found, otherwise returns None.
@@ -150,6 +165,9 @@ class CourseRequest:
 
         Returns:
             Course: The Course object if found, otherwise throws an exception.
+
+        Raises:
+            BudgetExceeded: If the request runs out of time.
         """
 
         url = self.__base_url + self.__COURSE_QUERY_URL
@@ -168,9 +186,12 @@ class CourseRequest:
         }
 
         try:
-            async with AsyncClient(headers={"User-Agent": self.__UA.random}) as client:
+            async with (
+                stage("course.detail", self.__DETAIL_TIMEOUT),
+                UpstreamClient("course") as client,
+            ):
                 res = await client.get(url, params=params)
-                soup = Bs4(res.text, "lxml")
+                soup = parse_html(res.text, "course")
 
             if table := soup.find("table"):
                 course_infos = table.find("tbody").find("tr")
@@ -197,6 +218,9 @@ class CourseRequest:
                 )
 
                 self.COURSE_DICT[c.uid] = c
+                COURSE_SUBSCRIPTIONS.observe(c)
+                # Not awaited, the reply does not wait for the subscription file
+                COURSE_SUBSCRIPTIONS.flush_later()
 
                 return c
 
@@ -229,15 +253,12 @@ class CourseRequest:
         }
 
         try:
-            async with AsyncClient(
-                timeout=Timeout(60),
-                headers={"User-Agent": self.__UA.random},
-            ) as client:
+            async with UpstreamClient("courses", timeout=Timeout(60)) as client:
                 for code in ALL_EDU_CODE:
                     params["courseno"] = code
 
                     res = await client.get(url, params=params)
-                    soup = Bs4(res.text, "lxml")
+                    soup = parse_html(res.text, "courses")
 
                     if table := soup.find("table"):
                         for course_info in table.find("tbody").find_all("tr"):
@@ -259,12 +280,17 @@ class CourseRequest:
                             )
 
                             self.COURSE_DICT[sc.uid] = sc
+                            COURSE_SUBSCRIPTIONS.observe(sc)
                             courses[sc.uid] = sc
 
         except HTTPError as exc:
             self.__base_url = ""
             raise ValueError("An error occurred while fetching courses.") from exc
 
+        finally:
+            # The changes of the year are saved and notified at once
+            await COURSE_SUBSCRIPTIONS.flush()
+
         return courses
 
 
@@ -0,0 +1,386 @@
+# -*- coding:utf-8 -*-
+import fcntl
+import json
+from asyncio import Task, create_task, to_thread
+from os import getenv
+from pathlib import Path
+from typing import Any, Callable, Optional, TypeVar
+
+from linebot.v3.messaging import TextMessage
+from sanic.log import error_logger
+
+from ..file_util import write_atomic
+from ..line_api_util import LINE_API_UTIL
+from ..line_bot_util import get_sender
+from ..metric_util import Counter, Gauge
+from .course import Course, SimpleCourse
+
+COURSE_CHANGES = Counter(
+    "ntpu_linebot_course_changes_total",
+    "Changes found in subscribed courses, by field",
+    ("field",),
+)
+COURSE_SUBSCRIPTIONS_COUNT = Gauge(
+    "ntpu_linebot_course_subscriptions",
+    "Course subscriptions of all users",
+)
+
+T = TypeVar("T")
+
+
+class CourseSubscriptions:
+    """
+    An index from course UID to the subscribed users, with the last seen fields of each course,
+    optionally persisted across restarts (COURSE_SUBSCRIPTION_PATH).
+
+    When persisted, the file is the source of truth shared by the workers.
+    Changes are made to the file under a file lock, in a thread so the event loop never waits on another worker,
+    and the subscriptions in memory are replaced by the file read back.
+    Refreshed courses are compared in memory and their changes saved and notified once per crawl.
+    """
+
+    __LIMIT = int(getenv("COURSE_SUBSCRIPTION_LIMIT", "20"))
+    __PATH = getenv("COURSE_SUBSCRIPTION_PATH")
+    __SENDER_NAME = "課程魔法師"
+    # Field -> label in the notification
+    __FIELDS = {
+        "title": "課程",
+        "teachers": "教師",
+        "times": "時間",
+        "locations": "地點",
+    }
+
+    def __init__(self) -> None:
+        # Course UID -> user IDs
+        self.__subscribers = dict[str, set[str]]()
+        # User ID -> course UIDs
+        self.__courses = dict[str, set[str]]()
+        # Course UID -> field -> last seen value
+        self.__snapshots = dict[str, dict[str, Any]]()
+        # Course UID -> field -> refreshed value, waiting to be compared with the saved one
+        self.__pending = dict[str, dict[str, Any]]()
+        self.__flush_task: Optional[Task] = None
+
+    def is_subscribed(self, user_id: str, uid: str) -> bool:
+        """
+        Check whether the user subscribed to the course.
+
+        Args:
+            user_id (str): The user ID.
+            uid (str): The unique identifier of the course.
+
+        Returns:
+            bool: True if the user is notified of the course changes.
+        """
+
+        return uid in self.__courses.get(user_id, ())
+
+    async def subscribe(self, user_id: str, course: SimpleCourse) -> bool:
+        """
+        Subscribe the user to the changes of the course.
+
+        Args:
+            user_id (str): The user ID.
+            course (SimpleCourse): The course, as the user last saw it.
+
+        Returns:
+            bool: False if the user already subscribed to too many courses.
+        """
+
+        snapshot = self.__snapshot(course)
+
+        def change(data: dict[str, dict[str, Any]]) -> bool:
+            user_ids = data["subscribers"].setdefault(course.uid, [])
+            if user_id in user_ids:
+                return True
+
+            if (
+                sum(user_id in ids for ids in data["subscribers"].values())
+                >= self.__LIMIT
+            ):
+                if not user_ids:
+                    del data["subscribers"][course.uid]
+
+                return False
+
+            user_ids.append(user_id)
+            data["snapshots"].setdefault(course.uid, snapshot)
+            return True
+
+        return await self.__update(change)
+
+    async def unsubscribe(self, user_id: str, uid: str) -> None:
+        """
+        Unsubscribe the user from the changes of the course.
+
+        Args:
+            user_id (str): The user ID.
+            uid (str): The unique identifier of the course.
+        """
+
+        def change(data: dict[str, dict[str, Any]]) -> None:
+            if user_id not in (user_ids := data["subscribers"].get(uid, [])):
+                return
+
+            user_ids.remove(user_id)
+            if not user_ids:
+                del data["subscribers"][uid]
+                data["snapshots"].pop(uid, None)
+
+        await self.__update(change)
+
+    def observe(self, course: SimpleCourse) -> None:
+        """
+        Compare a refreshed course with its last seen fields in memory.
+        Courses without subscribers are skipped at once,
+        the changed ones are saved and notified by `flush`.
+
+        Args:
+            course (SimpleCourse): The refreshed course.
+        """
+
+        if course.uid not in self.__subscribers:
+            return
+
+        new = self.__pending.get(course.uid, {}) | self.__snapshot(course)
+        if self.__snapshots[course.uid] | new != self.__snapshots[course.uid]:
+            self.__pending[course.uid] = new
+
+    def flush_later(self) -> None:
+        """Flush the observed changes in the background, unless a flush is already waiting to run."""
+
+        if self.__pending and self.__flush_task is None:
+            self.__flush_task = create_task(self.flush(), name="flush_subscriptions")
+
+    async def flush(self) -> None:
+        """
+        Save the fields of the refreshed courses and notify the subscribers of the changes,
+        and read the subscriptions saved by the other workers.
+        The fields are compared with the saved ones under the file lock,
+        so a change seen by several workers is notified once.
+        """
+
+        self.__flush_task = None
+        pending, self.__pending = self.__pending, {}
+
+        def change(
+            data: dict[str, dict[str, Any]],
+        ) -> list[tuple[list[str], list[str], str]]:
+            notifications = list[tuple[list[str], list[str], str]]()
+            for uid, new in pending.items():
+                if uid not in data["subscribers"] or uid not in data["snapshots"]:
+                    continue
+
+                old = data["snapshots"][uid]
+                # A simple course has no locations, so the last seen ones are kept
+                data["snapshots"][uid] = old | new
+
+                changes = [
+                    field
+                    for field, value in new.items()
+                    if field in old and old[field] != value
+                ]
+                if not changes:
+                    continue
+
+                texts = [f"課程異動通知：{new['title']}"]
+                for field in changes:
+                    texts.append(
+                        f"{self.__FIELDS[field]}：{self.__format(old[field])} → {self.__format(new[field])}"
+                    )
+
+                notifications.append(
+                    (data["subscribers"][uid], changes, "\n".join(texts))
+                )
+
+            return notifications
+
+        try:
+            notifications = await self.__update(change if pending else None)
+
+        except OSError:
+            error_logger.warning("Failed to save the course subscriptions")
+            self.__pending = pending | self.__pending
+            return
+
+        for subscribers, changes, text in notifications or ():
+            for field in changes:
+                COURSE_CHANGES.inc(field)
+
+            LINE_API_UTIL.multicast_message(
+                subscribers,
+                [
+                    TextMessage(
+                        text=text,
+                        sender=get_sender(self.__SENDER_NAME),
+                    )
+                ],
+            )
+
+    def load(self) -> None:
+        """Load the subscriptions saved by the previous run, if persistence is enabled."""
+
+        if self.__PATH:
+            self.__apply(self.__read(Path(self.__PATH)))
+
+    async def __update(
+        self, change: Optional[Callable[[dict[str, dict[str, Any]]], T]]
+    ) -> Optional[T]:
+        """
+        Change the subscriptions, in the file if persistence is enabled, then in memory.
+
+        Args:
+            change (Optional[Callable[[dict[str, dict[str, Any]]], T]]): Changes the subscriptions in place,
+            with the user IDs and the last seen fields by course UID. None only reads the file.
+
+        Returns:
+            Optional[T]: The result of the change.
+        """
+
+        if not self.__PATH:
+            data = {
+                "subscribers": {
+                    uid: sorted(user_ids)
+                    for uid, user_ids in self.__subscribers.items()
+                },
+                "snapshots": dict(self.__snapshots),
+            }
+            result = change(data) if change else None
+
+        else:
+            result, data = await to_thread(self.__transact, Path(self.__PATH), change)
+
+        self.__apply(data)
+        return result
+
+    @classmethod
+    def __transact(
+        cls,
+        path: Path,
+        change: Optional[Callable[[dict[str, dict[str, Any]]], T]],
+    ) -> tuple[Optional[T], dict[str, dict[str, Any]]]:
+        """
+        Read the subscription file and save the change, holding its lock against the other workers.
+        Run in a thread, as the lock may be held by another worker.
+
+        Args:
+            path (Path): The subscription file.
+            change (Optional[Callable[[dict[str, dict[str, Any]]], T]]): Changes the subscriptions in place,
+            None only reads the file.
+
+        Returns:
+            tuple[Optional[T], dict[str, dict[str, Any]]]: The result of the change and the saved subscriptions.
+        """
+
+        if change is None:
+            return None, cls.__read(path)
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path.with_name(path.name + ".lock"), "a", encoding="utf-8") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            try:
+                data = cls.__read(path)
+                result = change(data)
+                write_atomic(path, json.dumps(data, ensure_ascii=False))
+
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        return result, data
+
+    @staticmethod
+    def __read(path: Path) -> dict[str, dict[str, Any]]:
+        """
+        Read the subscription file.
+
+        Args:
+            path (Path): The subscription file.
+
+        Returns:
+            dict[str, dict[str, Any]]: The user IDs and the last seen fields by course UID,
+            empty if the file is missing or unreadable.
+        """
+
+        data: dict[str, dict[str, Any]] = {}
+        if path.is_file():
+            try:
+                data = json.loads(path.read_text(encoding="utf-8"))
+
+            except (OSError, ValueError):
+                error_logger.warning("Failed to load the course subscriptions")
+
+        return {
+            "subscribers": data.get("subscribers", {}),
+            "snapshots": data.get("snapshots", {}),
+        }
+
+    def __apply(self, data: dict[str, dict[str, Any]]) -> None:
+        """
+        Replace the subscriptions in memory.
+
+        Args:
+            data (dict[str, dict[str, Any]]): The user IDs and the last seen fields by course UID.
+        """
+
+        subscribers = dict[str, set[str]]()
+        courses = dict[str, set[str]]()
+        for uid, user_ids in data["subscribers"].items():
+            if uid not in data["snapshots"]:
+                continue
+
+            subscribers[uid] = set(user_ids)
+            for user_id in user_ids:
+                courses.setdefault(user_id, set()).add(uid)
+
+        # Replaced at once, they are read while replying
+        self.__subscribers = subscribers
+        self.__courses = courses
+        self.__snapshots = {uid: data["snapshots"][uid] for uid in subscribers}
+
+        COURSE_SUBSCRIPTIONS_COUNT.set(
+            value=sum(len(user_ids) for user_ids in subscribers.values())
+        )
+
+    @staticmethod
+    def __snapshot(course: SimpleCourse) -> dict[str, Any]:
+        """
+        Get the fields of the course that subscribers are notified of.
+
+        Args:
+            course (SimpleCourse): The course.
+
+        Returns:
+            dict[str, Any]: The field values, locations only for a full course.
+        """
+
+        snapshot: dict[str, Any] = {
+            "title": course.title,
+            "teachers": list(course.teachers),
+            "times": list(course.times),
+        }
+
+        if isinstance(course, Course):
+            snapshot["locations"] = list(course.locations)
+
+        return snapshot
+
+    @staticmethod
+    def __format(value: str | list[str]) -> str:
+        """
+        Format a field value in the notification.
+
+        Args:
+            value (str | list[str]): The field value.
+
+        Returns:
+            str: The value, lists joined by commas.
+        """
+
+        if isinstance(value, str):
+            return value
+
+        return ", ".join(value) or "無"
+
+
+COURSE_SUBSCRIPTIONS = CourseSubscriptions()
@@ -3,10 +3,14 @@ import random
 from asyncio import sleep
 from datetime import datetime
 from enum import Enum, auto, unique
+from typing import Optional
 
 from sanic import Sanic
 
-from .course import Course, SimpleCourse
+from ..budget_util import BudgetExceeded
+from ..crawl_util import CRAWLS
+from ..preload_util import is_crawler, persist_dataset
+from .course import RECENT_YEAR_COUNT, Course, SimpleCourse
 from .request import COURSE_REQUEST
 
 
@@ -26,8 +30,9 @@ async def healthz(app: Sanic, force: bool = False) -> bool:
         return True
 
     if force or await COURSE_REQUEST.change_base_url():
-        await app.cancel_task("load_course_dict", raise_exception=False)
-        app.add_task(load_course_dict(), name="load_course_dict")
+        if is_crawler():
+            await app.cancel_task("load_course_dict", raise_exception=False)
+            app.add_task(load_course_dict(), name="load_course_dict")
 
         return True
 
@@ -38,12 +43,21 @@ async def load_course_dict() -> None:
     """Updates the course dict for each year."""
 
     cur_year = datetime.now().year - 1911
-    for year in range(cur_year, cur_year - 5, -1):
-        await sleep(random.uniform(15, 25))
-        await COURSE_REQUEST.get_simple_courses_by_year(year)
+    try:
+        with CRAWLS.crawl("course", RECENT_YEAR_COUNT) as crawl:
+            for year in range(cur_year, cur_year - RECENT_YEAR_COUNT, -1):
+                await sleep(random.uniform(15, 25))
+                await COURSE_REQUEST.get_simple_courses_by_year(year)
+                crawl.advance()
 
+        COURSE_REQUEST.COURSE_DICT.evict_stale()
 
-async def search_course_by_uid(uid: str) -> Course:
+    finally:
+        # Keep what was crawled, even when the crawl stopped part way
+        await persist_dataset("course")
+
+
+async def search_course_by_uid(uid: str) -> SimpleCourse:
     """
     Asynchronously searches for course by UID.
 
@@ -51,10 +65,54 @@ async def search_course_by_uid(uid: str) -> Course:
         uid (str): The unique identifier of the course to search for.
 
     Returns:
-        Course: The course corresponding to the given UID.
+        SimpleCourse: The course corresponding to the given UID,
+        only the simple information if the upstream request runs out of time.
+
+    Raises:
+        BudgetExceeded: If the upstream request runs out of time and the course is not loaded.
     """
 
-    return await COURSE_REQUEST.get_course_by_uid(uid)
+    if isinstance(course := COURSE_REQUEST.COURSE_DICT.get(uid), Course):
+        COURSE_REQUEST.COURSE_DICT.touch([uid])
+        return course
+
+    try:
+        return await COURSE_REQUEST.get_course_by_uid(uid)
+
+    except BudgetExceeded:
+        if course is None:
+            raise
+
+        COURSE_REQUEST.COURSE_DICT.touch([uid])
+        return course
+
+
+def get_loaded_course(uid: str) -> Optional[SimpleCourse]:
+    """
+    Get a course from the local data, without an upstream request.
+
+    Args:
+        uid (str): The unique identifier of the course.
+
+    Returns:
+        Optional[SimpleCourse]: The course, None if it is not loaded.
+    """
+
+    return COURSE_REQUEST.COURSE_DICT.get(uid)
+
+
+def is_course_loaded(uid: str) -> bool:
+    """
+    Check if the full information of a course is already in the local data.
+
+    Args:
+        uid (str): The unique identifier of the course.
+
+    Returns:
+        bool: True if the course can be found without an upstream request.
+    """
+
+    return isinstance(COURSE_REQUEST.COURSE_DICT.get(uid), Course)
 
 
 @unique
@@ -118,4 +176,7 @@ def search_simple_courses_by_criteria_and_kind(
         case _:
             raise ValueError("Invalid SearchArgument")
 
-    return sorted(courses, key=lambda c: (-c.year, c.term, c.no))[:limit]
+    courses = sorted(courses, key=lambda c: (-c.year, c.term, c.no))[:limit]
+    COURSE_REQUEST.COURSE_DICT.touch(course.uid for course in courses)
+
+    return courses
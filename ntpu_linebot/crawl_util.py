@@ -0,0 +1,235 @@
+# -*- coding:utf-8 -*-
+import logging
+from asyncio import CancelledError
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import monotonic, time
+from typing import Any, Iterator, Optional
+
+from .log_util import LOGGER
+from .metric_util import Counter, Gauge
+
+CRAWL_UNITS = Gauge(
+    "ntpu_linebot_crawl_units",
+    "Units of the current or last run of each crawler, by crawler and state (done or total)",
+    ("crawler", "state"),
+)
+CRAWL_PAGES = Counter(
+    "ntpu_linebot_crawl_pages_total",
+    "Upstream pages fetched by each crawler, by crawler",
+    ("crawler",),
+)
+CRAWL_BYTES = Counter(
+    "ntpu_linebot_crawl_bytes_total",
+    "Decoded size of the upstream pages fetched by each crawler, by crawler",
+    ("crawler",),
+)
+CRAWL_PARSE_SECONDS = Counter(
+    "ntpu_linebot_crawl_parse_seconds_total",
+    "Time spent parsing the pages of each crawler, by crawler",
+    ("crawler",),
+)
+CRAWL_ERRORS = Counter(
+    "ntpu_linebot_crawl_errors_total",
+    "Upstream errors met by each crawler, by crawler and status or error",
+    ("crawler", "error"),
+)
+CRAWL_RUNS = Counter(
+    "ntpu_linebot_crawl_runs_total",
+    "Finished runs of each crawler, by crawler and result (complete, failed or cancelled)",
+    ("crawler", "result"),
+)
+CRAWL_LAST_COMPLETE = Gauge(
+    "ntpu_linebot_crawl_last_complete_timestamp_seconds",
+    "Time of the last complete run of each crawler, by crawler",
+    ("crawler",),
+)
+
+
+class Crawl:
+    """The progress of a run of a crawler"""
+
+    RUNNING = "running"
+    COMPLETE = "complete"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, name: str, total: int) -> None:
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.pages = 0
+        self.bytes = 0
+        self.parse_seconds = 0.0
+        self.last_error: Optional[str] = None
+        self.state = self.RUNNING
+        self.started_at = time()
+        self.__start = monotonic()
+        self.__end: Optional[float] = None
+
+        CRAWL_UNITS.set(name, "done", value=0)
+        CRAWL_UNITS.set(name, "total", value=total)
+
+    def advance(self, units: int = 1) -> None:
+        """
+        Count finished units of the crawl.
+
+        Args:
+            units (int, optional): The number of units. Defaults to 1.
+        """
+
+        self.done += units
+        CRAWL_UNITS.set(self.name, "done", value=self.done)
+
+    def record_page(self, size: int) -> None:
+        """
+        Count a fetched page.
+
+        Args:
+            size (int): The decoded size of the page in bytes.
+        """
+
+        self.pages += 1
+        self.bytes += size
+        CRAWL_PAGES.inc(self.name)
+        CRAWL_BYTES.inc(self.name, value=size)
+
+    def record_parse(self, seconds: float) -> None:
+        """
+        Count the time spent parsing a page.
+
+        Args:
+            seconds (float): The parse time.
+        """
+
+        self.parse_seconds += seconds
+        CRAWL_PARSE_SECONDS.inc(self.name, value=seconds)
+
+    def record_error(self, error: str, message: Optional[str] = None) -> None:
+        """
+        Keep an error met by the crawl.
+
+        Args:
+            error (str): The status code or the name of the error.
+            message (str, optional): The details of the error. Defaults to None.
+        """
+
+        self.last_error = f"{error}: {message}" if message else error
+        CRAWL_ERRORS.inc(self.name, error)
+
+    def finish(self, state: str) -> None:
+        """
+        End the crawl.
+
+        Args:
+            state (str): How the crawl ended, COMPLETE, FAILED or CANCELLED.
+        """
+
+        self.state = state
+        self.__end = monotonic()
+        CRAWL_RUNS.inc(self.name, state)
+
+        if state == self.COMPLETE:
+            CRAWL_LAST_COMPLETE.set(self.name, value=time())
+
+        LOGGER.log(
+            logging.INFO if state == self.COMPLETE else logging.WARNING,
+            "crawl %s",
+            state,
+            extra={"fields": self.status()},
+        )
+
+    def status(self) -> dict[str, Any]:
+        """
+        Report the progress of the crawl.
+
+        Returns:
+            dict[str, Any]: The state, the units done and remaining, the pages per second,
+            the bytes, the parse time, the last error and the estimated seconds left.
+        """
+
+        elapsed = (self.__end or monotonic()) - self.__start
+        remaining = max(self.total - self.done, 0)
+
+        return {
+            "name": self.name,
+            "state": self.state,
+            "started_at": int(self.started_at),
+            "elapsed_seconds": round(elapsed, 1),
+            "done": self.done,
+            "remaining": remaining,
+            "pages": self.pages,
+            "pages_per_second": round(self.pages / elapsed, 3) if elapsed else 0,
+            "bytes": self.bytes,
+            "parse_seconds": round(self.parse_seconds, 3),
+            "last_error": self.last_error,
+            "eta_seconds": (
+                round(elapsed / self.done * remaining, 1)
+                if self.state == self.RUNNING and self.done
+                else None
+            ),
+        }
+
+
+class CrawlTracker:
+    """
+    The progress of the crawlers loading the datasets in the background.
+    Pages fetched and parsed within a crawl are counted by the upstream client.
+    """
+
+    def __init__(self) -> None:
+        self.__current = ContextVar[Optional[Crawl]]("crawl", default=None)
+        self.__crawls = dict[str, Crawl]()
+
+    @property
+    def current(self) -> Optional[Crawl]:
+        """The crawl of the running task, if any"""
+
+        return self.__current.get()
+
+    @contextmanager
+    def crawl(self, name: str, total: int) -> Iterator[Crawl]:
+        """
+        Track a run of a crawler, replacing its previous run.
+
+        Args:
+            name (str): The name of the crawler.
+            total (int): The number of units to crawl.
+
+        Yields:
+            Crawl: The progress of the run, advanced by the crawler.
+        """
+
+        crawl = self.__crawls[name] = Crawl(name, total)
+        token = self.__current.set(crawl)
+
+        try:
+            yield crawl
+
+        except CancelledError:
+            crawl.finish(Crawl.CANCELLED)
+            raise
+
+        except Exception as exc:
+            crawl.record_error(type(exc).__name__, str(exc))
+            crawl.finish(Crawl.FAILED)
+            raise
+
+        else:
+            crawl.finish(Crawl.COMPLETE)
+
+        finally:
+            self.__current.reset(token)
+
+    def status(self) -> list[dict[str, Any]]:
+        """
+        Report the progress of the current or last run of each crawler.
+
+        Returns:
+            list[dict[str, Any]]: The progress of each crawler.
+        """
+
+        return [crawl.status() for crawl in self.__crawls.values()]
+
+
+CRAWLS = CrawlTracker()
@@ -0,0 +1,30 @@
+# -*- coding:utf-8 -*-
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+
+
+def write_atomic(path: Path, data: str | bytes) -> None:
+    """
+    Replace a file at once, through a temporary file of its own next to it,
+    so a crash never leaves half of the file and processes writing it at the same time never clash.
+
+    Args:
+        path (Path): The file to write.
+        data (str | bytes): The content, text is encoded in UTF-8.
+    """
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+
+    with NamedTemporaryFile(
+        dir=path.parent, prefix=f".{path.name}.", suffix=".tmp", delete=False
+    ) as file:
+        file.write(data)
+
+    try:
+        Path(file.name).replace(path)
+
+    except OSError:
+        Path(file.name).unlink(missing_ok=True)
+        raise
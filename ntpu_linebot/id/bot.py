@@ -1,8 +1,7 @@
 # -*- coding:utf-8 -*-
 from datetime import datetime
 from math import ceil
-from re import IGNORECASE, search
-from typing import Optional
+from typing import Optional, Sequence
 
 from linebot.v3.messaging.models import (
     ButtonsTemplate,
@@ -20,14 +19,17 @@ from linebot.v3.messaging.models import (
 )
 
 from ..abs_bot import Bot
-from ..line_bot_util import EMPTY_POSTBACK_ACTION, get_sender
-from ..normal_util import list_to_regex, partition
+from ..budget_util import BudgetExceeded
+from ..line_bot_util import EMPTY_POSTBACK_ACTION, StaticReply, get_sender
+from ..normal_util import partition
+from ..postback_util import PostbackHandler
 from .util import (
     DEPARTMENT_CODE,
     DEPARTMENT_NAME,
     FULL_DEPARTMENT_CODE,
     FULL_DEPARTMENT_NAME,
     Order,
+    is_student_loaded,
     search_student_by_uid,
     search_students_by_name,
     search_students_by_year_and_department,
@@ -79,43 +81,97 @@ class IDBot(Bot):
         "學號",
         "學生編號",
     ]
-    __DEPARTMENT_REGEX = list_to_regex(__VALID_DEPARTMENT_STR)
-    __DEPARTMENT_CODE_REGEX = list_to_regex(__VALID_DEPARTMENT_CODE_STR)
-    __YEAR_REGEX = list_to_regex(__VALID_YEAR_STR)
-    __STUDENT_REGEX = list_to_regex(__VALID_STUDENT_STR)
     __ALL_DEPARTMENT_CODE = "所有系代碼"
-    __COLLEGE_NAMES = [
-        "人文學院",
-        "法律學院",
-        "商學院",
-        "公共事務學院",
-        "社會科學學院",
-        "電機資訊學院",
-    ]
+    __COMMANDS = {
+        "department": __VALID_DEPARTMENT_STR,
+        "department_code": __VALID_DEPARTMENT_CODE_STR,
+        "year": __VALID_YEAR_STR,
+        "student": __VALID_STUDENT_STR,
+    }
+    __PREFIX_COMMANDS = {"all_department_code": [__ALL_DEPARTMENT_CODE]}
+    __COLLEGE_GROUPS = {
+        "搜尋全系": ["文法商", "公社電資"],
+        "文法商": ["人文學院", "法律學院", "商學院"],
+        "公社電資": ["公共事務學院", "社會科學學院", "電機資訊學院"],
+    }
+    # 學院名稱 -> (圖片網址, 科系名稱)
+    __COLLEGE_DEPARTMENTS = {
+        "人文學院": (
+            "https://walkinto.in/upload/-192z7YDP8-JlchfXtDvI.JPG",
+            ["中文", "應外", "歷史"],
+        ),
+        "法律學院": (
+            "https://walkinto.in/upload/byupdk9PvIZyxupOy9Dw8.JPG",
+            ["法學", "司法", "財法"],
+        ),
+        "商學院": (
+            "https://walkinto.in/upload/ZJum7EYwPUZkedmXNtvPL.JPG",
+            ["企管", "金融", "會計", "統計", "休運"],
+        ),
+        "公共事務學院": (
+            "https://walkinto.in/upload/ZJhs4wEaDIWklhiVwV6DI.jpg",
+            ["公行", "不動", "財政"],
+        ),
+        "社會科學學院": (
+            "https://walkinto.in/upload/WyPbshN6DIZ1gvZo2NTvU.JPG",
+            ["經濟", "社學", "社工"],
+        ),
+        "電機資訊學院": (
+            "https://walkinto.in/upload/bJ9zWWHaPLWJg9fW-STD8.png",
+            ["電機", "資工", "通訊"],
+        ),
+    }
+    __ALL_DEPARTMENT_CODE_REPLY = StaticReply(
+        [
+            TextMessage(
+                text="\n".join([f"{x}系 -> {y}" for x, y in DEPARTMENT_CODE.items()]),
+                sender=get_sender(__SENDER_NAME),
+            ),
+        ]
+    )
+
+    def __init__(self) -> None:
+        self.__postback_handlers = {
+            "scold": PostbackHandler(self.__scold),
+            "college": PostbackHandler(self.__choose_college, (str, int)),
+            "students": PostbackHandler(
+                self.__search_department,
+                (int, str),
+                needs_upstream=lambda *_: True,
+            ),
+        }
+
+        # (選單, 學年度) -> 回覆，只預先建立有學生資料的學年度
+        self.__college_replies = {
+            (data, str(year)): StaticReply(self.__college_messages(data, str(year)))
+            for year in range(95, 113)
+            for data in [*self.__COLLEGE_GROUPS, *self.__COLLEGE_DEPARTMENTS]
+        }
+
+    @property
+    def commands(self) -> dict[str, Sequence[str]]:
+        """系所、系代碼、學年度與學生的查詢指令"""
+
+        return self.__COMMANDS
+
+    @property
+    def prefix_commands(self) -> dict[str, Sequence[str]]:
+        """所有系代碼的查詢指令"""
+
+        return self.__PREFIX_COMMANDS
 
     async def handle_text_message(
         self,
         payload: str,
+        commands: dict[str, str],
         quote_token: Optional[str] = None,
     ) -> list[Message]:
         """處理文字訊息"""
 
-        if payload == self.__ALL_DEPARTMENT_CODE:
-            department_info = "\n".join(
-                [f"{x}系 -> {y}" for x, y in DEPARTMENT_CODE.items()]
-            )
-
-            return [
-                TextMessage(
-                    text=department_info,
-                    sender=get_sender(self.__SENDER_NAME),
-                    quoteToken=quote_token,
-                ),
-            ]
-
-        if match := search(self.__DEPARTMENT_REGEX, payload, IGNORECASE):
-            criteria = match.group()
+        if commands.get("all_department_code") == "":
+            return self.__ALL_DEPARTMENT_CODE_REPLY.messages(quote_token)
 
+        if (criteria := commands.get("department")) is not None:
             if department_code := DEPARTMENT_CODE.get(criteria.rstrip("系")):
                 return [
                     TextMessage(
@@ -162,9 +218,7 @@ class IDBot(Bot):
                 ),
             ]
 
-        if match := search(self.__DEPARTMENT_CODE_REGEX, payload, IGNORECASE):
-            criteria = match.group()
-
+        if (criteria := commands.get("department_code")) is not None:
             if full_department_name := FULL_DEPARTMENT_NAME.get(criteria):
                 return [
                     TextMessage(
@@ -192,9 +246,7 @@ class IDBot(Bot):
                 ),
             ]
 
-        if match := search(self.__YEAR_REGEX, payload, IGNORECASE):
-            criteria = match.group()
-
+        if (criteria := commands.get("year")) is not None:
             if 2 <= len(criteria) <= 4:
                 year = int(criteria) if int(criteria) < 1911 else int(criteria) - 1911
 
@@ -249,13 +301,15 @@ class IDBot(Bot):
                                 PostbackAction(
                                     label="哪次不是",
                                     displayText="哪次不是",
-                                    data=f"搜尋全系{self.split_char}{year}",
+                                    data=self.postback_data(
+                                        "college", "搜尋全系", year
+                                    ),
                                     inputOption="openRichMenu",
                                 ),
                                 PostbackAction(
                                     label="我在想想",
                                     displayText="再啦乾ಠ_ಠ",
-                                    data="兇",
+                                    data=self.postback_data("scold"),
                                     inputOption="openKeyboard",
                                 ),
                             ],
@@ -272,11 +326,21 @@ class IDBot(Bot):
                 ),
             ]
 
-        if match := search(self.__STUDENT_REGEX, payload, IGNORECASE):
-            criteria = match.group()
-
+        if (criteria := commands.get("student")) is not None:
             if criteria.isdecimal() and 8 <= len(criteria) <= 9:
-                if (student_info := await search_student_by_uid(criteria)) is None:
+                try:
+                    student_info = await search_student_by_uid(criteria)
+
+                except BudgetExceeded:
+                    return [
+                        TextMessage(
+                            text=f"學號 {criteria} 查詢逾時，請稍後再試",
+                            sender=get_sender(self.__SENDER_NAME),
+                            quoteToken=quote_token,
+                        ),
+                    ]
+
+                if student_info is None:
                     return [
                         TextMessage(
                             text=f"學號 {criteria} 不存在OAO",
@@ -322,7 +386,9 @@ class IDBot(Bot):
                                 action=PostbackAction(
                                     label=show_text,
                                     displayText=f"{show_text}",
-                                    data=f"{year}{self.split_char}{department}",
+                                    data=self.postback_data(
+                                        "students", year, department
+                                    ),
                                     inputOption="closeRichMenu",
                                 ),
                             ),
@@ -365,116 +431,177 @@ class IDBot(Bot):
 
         return []
 
-    async def handle_postback_event(self, payload: str) -> list[Message]:
-        """處理回傳事件"""
+    def needs_upstream_text(self, commands: dict[str, str]) -> bool:
+        """只有查詢未載入的學號需要連線"""
+
+        if commands.get("all_department_code") == "" or any(
+            command in commands for command in ["department", "department_code", "year"]
+        ):
+            return False
+
+        if (criteria := commands.get("student")) is not None:
+            return (
+                criteria.isdecimal()
+                and 8 <= len(criteria) <= 9
+                and not is_student_loaded(criteria)
+            )
+
+        return False
+
+    @property
+    def postback_namespace(self) -> str:
+        """學號魔法師的回傳事件"""
+
+        return "id"
+
+    @property
+    def postback_handlers(self) -> dict[str, PostbackHandler]:
+        """選擇學院、科系與學生名單的回傳事件"""
+
+        return self.__postback_handlers
+
+    def parse_legacy_postback(self, payload: str) -> Optional[tuple[str, list[str]]]:
+        """舊格式為「兇」、「選單$學年度」與「學年度$系代碼」"""
 
         if payload == "兇":
-            return [
-                TextMessage(
-                    text="泥好兇喔~~இ௰இ",
-                    sender=get_sender(self.__SENDER_NAME),
-                ),
-            ]
+            return "scold", []
 
-        if self.split_char in payload:
-            data, year = payload.split(self.split_char)
+        data, split_char, arg = payload.partition(self.split_char)
+        if not split_char:
+            return None
 
-            if data == "搜尋全系":
-                return [
-                    TemplateMessage(
-                        altText="選擇學院群",
-                        template=ButtonsTemplate(
-                            thumbnailImageUrl="https://new.ntpu.edu.tw/assets/logo/ntpu_logo.png",
-                            title="選擇學院群",
-                            text="請選擇科系所屬學院群",
-                            actions=[
-                                self.__college_postback("文法商", year),
-                                self.__college_postback("公社電資", year),
-                            ],
-                        ),
-                        sender=get_sender(self.__SENDER_NAME),
-                    ),
-                ]
+        if data in self.__COLLEGE_GROUPS or data in self.__COLLEGE_DEPARTMENTS:
+            return "college", [data, arg]
 
-            if data in ["文法商", "公社電資"]:
-                return [
-                    TemplateMessage(
-                        altText="選擇學院",
-                        template=ButtonsTemplate(
-                            title="選擇學院",
-                            text="請選擇科系所屬學院",
-                            actions=(
-                                [
-                                    self.__college_postback("人文學院", year),
-                                    self.__college_postback("法律學院", year),
-                                    self.__college_postback("商學院", year),
-                                ]
-                                if data == "文法商"
-                                else [
-                                    self.__college_postback("公共事務學院", year),
-                                    self.__college_postback("社會科學學院", year),
-                                    self.__college_postback("電機資訊學院", year),
-                                ]
-                            ),
-                        ),
-                        sender=get_sender(self.__SENDER_NAME),
-                    ),
-                ]
+        if data.isdecimal() and arg in DEPARTMENT_NAME:
+            return "students", [data, arg]
 
-            if data in self.__COLLEGE_NAMES:
-                department_message = {
-                    "人文學院": self.__choose_department_message(
-                        year,
-                        "https://walkinto.in/upload/-192z7YDP8-JlchfXtDvI.JPG",
-                        ["中文", "應外", "歷史"],
-                    ),
-                    "法律學院": self.__choose_department_message(
-                        year,
-                        "https://walkinto.in/upload/byupdk9PvIZyxupOy9Dw8.JPG",
-                        ["法學", "司法", "財法"],
-                        is_law=True,
-                    ),
-                    "商學院": self.__choose_department_message(
-                        year,
-                        "https://walkinto.in/upload/ZJum7EYwPUZkedmXNtvPL.JPG",
-                        ["企管", "金融", "會計", "統計", "休運"],
-                    ),
-                    "公共事務學院": self.__choose_department_message(
-                        year,
-                        "https://walkinto.in/upload/ZJhs4wEaDIWklhiVwV6DI.jpg",
-                        ["公行", "不動", "財政"],
-                    ),
-                    "社會科學學院": self.__choose_department_message(
-                        year,
-                        "https://walkinto.in/upload/WyPbshN6DIZ1gvZo2NTvU.JPG",
-                        ["經濟", "社學", "社工"],
-                    ),
-                    "電機資訊學院": self.__choose_department_message(
-                        year,
-                        "https://walkinto.in/upload/bJ9zWWHaPLWJg9fW-STD8.png",
-                        ["電機", "資工", "通訊"],
+        return None
+
+    async def __scold(self, _: Optional[str]) -> list[Message]:
+        """
+        Reply to the user declining to search the students.
+
+        Returns:
+            list[Message]: The reply.
+        """
+
+        return [
+            TextMessage(
+                text="泥好兇喔~~இ௰இ",
+                sender=get_sender(self.__SENDER_NAME),
+            ),
+        ]
+
+    async def __choose_college(
+        self,
+        _: Optional[str],
+        data: str,
+        year: int,
+    ) -> list[Message]:
+        """
+        Reply with the next choice of college groups, colleges or departments.
+
+        Args:
+            data (str): The college group or the college chosen.
+            year (int): The year for which the students are being searched.
+
+        Returns:
+            list[Message]: The template message of the next choice, empty if the choice is unknown.
+        """
+
+        if data not in self.__COLLEGE_GROUPS and data not in self.__COLLEGE_DEPARTMENTS:
+            return []
+
+        if reply := self.__college_replies.get((data, str(year))):
+            return reply.messages()
+
+        return self.__college_messages(data, str(year))
+
+    async def __search_department(
+        self,
+        _: Optional[str],
+        year: int,
+        department: str,
+    ) -> list[Message]:
+        """
+        Reply with the students of a department.
+
+        Args:
+            year (int): The year for which the students are being searched.
+            department (str): The department code.
+
+        Returns:
+            list[Message]: The student list, empty if the department is unknown.
+        """
+
+        if department not in DEPARTMENT_NAME:
+            return []
+
+        return [
+            TextMessage(
+                text=await search_students_by_year_and_department(year, department),
+                sender=get_sender(self.__SENDER_NAME),
+            )
+        ]
+
+    def __college_messages(self, data: str, year: str) -> list[Message]:
+        """
+        Creates the messages for choosing a college or a department.
+
+        Args:
+            data (str): The college group or the college chosen.
+            year (str): The year for which the students are being searched.
+
+        Returns:
+            list[Message]: The template message of the next choice.
+        """
+
+        if data == "搜尋全系":
+            return [
+                TemplateMessage(
+                    altText="選擇學院群",
+                    template=ButtonsTemplate(
+                        thumbnailImageUrl="https://new.ntpu.edu.tw/assets/logo/ntpu_logo.png",
+                        title="選擇學院群",
+                        text="請選擇科系所屬學院群",
+                        actions=[
+                            self.__college_postback(name, year)
+                            for name in self.__COLLEGE_GROUPS[data]
+                        ],
                     ),
-                }
+                    sender=get_sender(self.__SENDER_NAME),
+                ),
+            ]
 
-                return [
-                    TemplateMessage(
-                        altText=f"選擇{"組別" if data == "法律學院" else "科系"}",
-                        template=department_message[data],
-                        sender=get_sender(self.__SENDER_NAME),
-                    )
-                ]
+        if data in self.__COLLEGE_GROUPS:
+            return [
+                TemplateMessage(
+                    altText="選擇學院",
+                    template=ButtonsTemplate(
+                        title="選擇學院",
+                        text="請選擇科系所屬學院",
+                        actions=[
+                            self.__college_postback(name, year)
+                            for name in self.__COLLEGE_GROUPS[data]
+                        ],
+                    ),
+                    sender=get_sender(self.__SENDER_NAME),
+                ),
+            ]
 
-            if data in DEPARTMENT_NAME:
-                return [
-                    TextMessage(
-                        text=await search_students_by_year_and_department(
-                            int(year), data
-                        ),
-                        sender=get_sender(self.__SENDER_NAME),
-                    )
-                ]
+        image_url, departments = self.__COLLEGE_DEPARTMENTS[data]
+        is_law = data == "法律學院"
 
-        return []
+        return [
+            TemplateMessage(
+                altText=f"選擇{"組別" if is_law else "科系"}",
+                template=self.__choose_department_message(
+                    year, image_url, departments, is_law=is_law
+                ),
+                sender=get_sender(self.__SENDER_NAME),
+            )
+        ]
 
     def __college_postback(self, college_name: str, year: str) -> PostbackAction:
         """
@@ -488,11 +615,10 @@ class IDBot(Bot):
             PostbackAction: A postback action object that represents the college.
         """
 
-        data = f"{college_name}{self.split_char}{year}"
         return PostbackAction(
             label=college_name,
             displayText=college_name,
-            data=data,
+            data=self.postback_data("college", college_name, year),
             inputOption="closeRichMenu",
         )
 
@@ -525,12 +651,10 @@ class IDBot(Bot):
         else:
             display_text += "系"
 
-        data = f"{year}{self.split_char}{department_code}"
-
         return PostbackAction(
             label=full_name,
             displayText=display_text,
-            data=data,
+            data=self.postback_data("students", year, department_code),
             inputOption="closeRichMenu",
         )
 
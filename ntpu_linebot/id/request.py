@@ -1,11 +1,17 @@
 # -*- coding:utf-8 -*-
 from typing import Optional
 
-from httpx import AsyncClient, HTTPError
+from httpx import HTTPError
 from asyncache import cached
-from bs4 import BeautifulSoup as Bs4
-from cachetools import TTLCache
-from fake_useragent import UserAgent
+
+from ..budget_util import stage
+from ..memory_util import (
+    MemoryStore,
+    MeteredTTLCache,
+    budget_from_env,
+    max_age_from_env,
+)
+from ..upstream_util import UpstreamClient, parse_html
 
 
 class IDRequest:
@@ -16,8 +22,13 @@ class IDRequest:
         "https://lms.ntpu.edu.tw",
     ]
     __STUDENT_SEARCH_URL = "/portfolio/search.php"
-    __UA = UserAgent(min_percentage=0.01)
-    STUDENT_DICT = dict[str, str]()
+    __STUDENT_TIMEOUT = 5
+    __DEPARTMENT_TIMEOUT = 15
+    STUDENT_DICT = MemoryStore[str, str](
+        "student",
+        budget=budget_from_env("STUDENT_DICT", 64),
+        max_age=max_age_from_env("STUDENT_DICT"),
+    )
 
     async def check_url(self, url: Optional[str] = None) -> bool:
         """
@@ -37,7 +48,7 @@ class IDRequest:
             return False
 
         try:
-            async with AsyncClient(headers={"User-Agent": self.__UA.random}) as client:
+            async with UpstreamClient("check") as client:
                 await client.head(url)
 
         except HTTPError:
@@ -59,7 +70,7 @@ class IDRequest:
         self.__base_url = ""
         return False
 
-    @cached(TTLCache(maxsize=9, ttl=60 * 60 * 24 * 7))
+    @cached(MeteredTTLCache("student_query", maxsize=9, ttl=60 * 60 * 24 * 7))
     async def get_student_by_uid(self, uid: str) -> str:
         """
         Asynchronously gets a student by their ID.
@@ -69,6 +80,9 @@ class IDRequest:
 
         Returns:
             str: The name of the student, if found. Otherwise, throws an exception.
+
+        Raises:
+            BudgetExceeded: If the request runs out of time.
         """
 
         url = self.__base_url + self.__STUDENT_SEARCH_URL
@@ -80,9 +94,12 @@ class IDRequest:
         }
 
         try:
-            async with AsyncClient(headers={"User-Agent": self.__UA.random}) as client:
+            async with (
+                stage("id.student", self.__STUDENT_TIMEOUT),
+                UpstreamClient("student") as client,
+            ):
                 res = await client.get(url, params=params)
-                soup = Bs4(res.text, "lxml")
+                soup = parse_html(res.text, "student")
 
             if student := soup.find("div", {"class": "bloglistTitle"}):
                 name = student.find("a").text
@@ -94,7 +111,7 @@ class IDRequest:
 
         raise ValueError("Student not found.")
 
-    @cached(TTLCache(maxsize=9, ttl=60 * 60 * 24 * 7))
+    @cached(MeteredTTLCache("department_query", maxsize=9, ttl=60 * 60 * 24 * 7))
     async def get_students_by_year_and_department(
         self,
         year: int,
@@ -109,6 +126,9 @@ class IDRequest:
 
         Returns:
             dict[str, str]: A dictionary of student numbers and names, or throws an exception if not found.
+
+        Raises:
+            BudgetExceeded: If the request runs out of time.
         """
 
         students = dict[str, str]()
@@ -118,20 +138,20 @@ class IDRequest:
             "page": "1",
             "fmKeyword": f"4{year}{department}",
         }
-        headers = {
-            "User-Agent": self.__UA.random,
-        }
 
         try:
-            async with AsyncClient(headers={"User-Agent": self.__UA.random}) as client:
+            async with (
+                stage("id.department", self.__DEPARTMENT_TIMEOUT),
+                UpstreamClient("department") as client,
+            ):
                 res = await client.get(url, params=params)
-                data = Bs4(res.text, "lxml")
+                data = parse_html(res.text, "department")
                 pages = len(data.find_all("span", {"class": "item"}))
 
                 for i in range(1, pages):
                     params["page"] = str(i)
                     res = await client.get(url, params=params)
-                    data = Bs4(res.text, "lxml")
+                    data = parse_html(res.text, "department")
 
                     for item in data.find_all("div", {"class": "bloglistTitle"}):
                         name = item.find("a").text
@@ -7,6 +7,9 @@ from typing import Optional
 
 from sanic import Sanic
 
+from ..budget_util import BudgetExceeded
+from ..crawl_util import CRAWLS
+from ..preload_util import is_crawler, persist_dataset
 from .request import ID_REQUEST
 
 # 科系名稱 -> 科系代碼
@@ -175,8 +178,9 @@ async def healthz(app: Sanic, force: bool = False) -> bool:
         return True
 
     if force or await ID_REQUEST.change_base_url():
-        await app.cancel_task("load_student_dict", raise_exception=False)
-        app.add_task(load_student_dict(), name="load_student_dict")
+        if is_crawler():
+            await app.cancel_task("load_student_dict", raise_exception=False)
+            app.add_task(load_student_dict(), name="load_student_dict")
 
         return True
 
@@ -188,11 +192,19 @@ async def load_student_dict() -> None:
 
     cur_year = datetime.now().year - 1911
     from_year = min(112, cur_year)
+    years = range(from_year, 100, -1)
 
-    for year in range(from_year, 100, -1):
-        for dep in DEPARTMENT_CODE.values():
-            await sleep(random.uniform(15, 25))
-            await ID_REQUEST.get_students_by_year_and_department(year, dep)
+    try:
+        with CRAWLS.crawl("student", len(years) * len(DEPARTMENT_CODE)) as crawl:
+            for year in years:
+                for dep in DEPARTMENT_CODE.values():
+                    await sleep(random.uniform(15, 25))
+                    await ID_REQUEST.get_students_by_year_and_department(year, dep)
+                    crawl.advance()
+
+    finally:
+        # Keep what was crawled, even when the crawl stopped part way
+        await persist_dataset("student")
 
 
 @unique
@@ -288,7 +300,7 @@ def student_info_format(
     return (" " * space).join(message)
 
 
-async def search_student_by_uid(uid: str) -> str:
+async def search_student_by_uid(uid: str) -> Optional[str]:
     """
     Async function to search for a student by ID.
 
@@ -296,10 +308,35 @@ async def search_student_by_uid(uid: str) -> str:
         uid (str): The unique identifier of the student.
 
     Returns:
-        str: The information of the student if found.
+        Optional[str]: The information of the student if found, None otherwise.
+
+    Raises:
+        BudgetExceeded: If the upstream request runs out of time.
+    """
+
+    if is_student_loaded(uid):
+        ID_REQUEST.STUDENT_DICT.touch([uid])
+        return ID_REQUEST.STUDENT_DICT[uid]
+
+    try:
+        return await ID_REQUEST.get_student_by_uid(uid)
+
+    except ValueError:
+        return None
+
+
+def is_student_loaded(uid: str) -> bool:
+    """
+    Check if a student is already in the local data.
+
+    Args:
+        uid (str): The unique identifier of the student.
+
+    Returns:
+        bool: True if the student can be found without an upstream request.
     """
 
-    return await ID_REQUEST.get_student_by_uid(uid)
+    return uid in ID_REQUEST.STUDENT_DICT
 
 
 def search_students_by_name(name: str) -> list[tuple[str, str]]:
@@ -313,11 +350,14 @@ def search_students_by_name(name: str) -> list[tuple[str, str]]:
         list: A list of tuples containing the names and IDs of the matching students.
     """
 
-    return [
+    students = [
         (key, value)
         for key, value in ID_REQUEST.STUDENT_DICT.items()
         if set(name).issubset(value)
     ]
+    ID_REQUEST.STUDENT_DICT.touch(key for key, _ in students)
+
+    return students
 
 
 async def search_students_by_year_and_department(year: int, department: str) -> str:
@@ -335,9 +375,23 @@ async def search_students_by_year_and_department(year: int, department: str) ->
     department_name = DEPARTMENT_NAME.get(department, "")
     department_type = "組" if department.startswith(DEPARTMENT_CODE["法律"]) else "系"
 
-    if students := await ID_REQUEST.get_students_by_year_and_department(
-        year, department
-    ):
+    is_partial = False
+    try:
+        students = await ID_REQUEST.get_students_by_year_and_department(
+            year, department
+        )
+
+    except BudgetExceeded:
+        # Answer with the students loaded so far
+        is_partial = True
+        prefix = f"4{year}{department}"
+        students = {
+            key: value
+            for key, value in ID_REQUEST.STUDENT_DICT.items()
+            if key.startswith(prefix)
+        }
+
+    if students:
         students_info = "\n".join(
             [
                 student_info_format(student_id, student_name, [Order.ID, Order.NAME], 3)
@@ -345,7 +399,16 @@ async def search_students_by_year_and_department(year: int, department: str) ->
             ]
         )
 
-        students_info += f"\n\n{year}學年度{department_name}{department_type}共有{len(students)}位學生"
+        if is_partial:
+            students_info += f"\n\n查詢逾時，目前只找到{year}學年度{department_name}{department_type}的{len(students)}位學生"
+
+        else:
+            students_info += f"\n\n{year}學年度{department_name}{department_type}共有{len(students)}位學生"
+
+    elif is_partial:
+        students_info = (
+            f"{year}學年度{department_name}{department_type}查詢逾時，請稍後再試"
+        )
 
     else:
         students_info = f"{year}學年度{department_name}{department_type}好像沒有人耶OAO"
@@ -0,0 +1,132 @@
+# -*- coding:utf-8 -*-
+import fcntl
+import json
+from collections import OrderedDict
+from os import getenv
+from pathlib import Path
+from time import time
+
+from .file_util import write_atomic
+from .metric_util import Counter
+
+DUPLICATED_EVENTS = Counter(
+    "ntpu_linebot_duplicated_events_total",
+    "Redelivered webhook events dropped because they were already processed",
+)
+
+
+class WebhookEventFilter:
+    """
+    A bounded, time-windowed set of seen webhook event IDs,
+    optionally persisted across restarts (WEBHOOK_SEEN_PATH).
+
+    Deduplication is best-effort per worker: a redelivery handled by another worker than the first delivery
+    is only dropped after a restart, when the IDs saved by every worker are loaded.
+    """
+
+    __WINDOW = float(getenv("WEBHOOK_SEEN_SECONDS", str(60 * 60 * 24)))
+    __MAX_SIZE = int(getenv("WEBHOOK_SEEN_SIZE", "100000"))
+    __PATH = getenv("WEBHOOK_SEEN_PATH")
+
+    def __init__(self) -> None:
+        # webhookEventId -> received at, oldest first
+        self.__seen = OrderedDict[str, float]()
+
+    def is_duplicate(self, webhook_event_id: str, is_redelivery: bool) -> bool:
+        """
+        Record the event and check whether it was already processed.
+
+        Args:
+            webhook_event_id (str): The webhookEventId of the event.
+            is_redelivery (bool): The deliveryContext.isRedelivery flag of the event.
+
+        Returns:
+            bool: True if the event should be dropped.
+        """
+
+        now = time()
+        while self.__seen and now - next(iter(self.__seen.values())) > self.__WINDOW:
+            self.__seen.popitem(last=False)
+
+        # Only redelivered events can have been seen before
+        if is_redelivery and webhook_event_id in self.__seen:
+            DUPLICATED_EVENTS.inc()
+            return True
+
+        self.__seen[webhook_event_id] = now
+        if len(self.__seen) > self.__MAX_SIZE:
+            self.__seen.popitem(last=False)
+
+        return False
+
+    def load(self) -> None:
+        """Load the seen event IDs saved by the workers of the previous run, if persistence is enabled."""
+
+        if self.__PATH:
+            self.__merge(self.__read(Path(self.__PATH)))
+
+    def save(self) -> None:
+        """
+        Save the seen event IDs for the next run, if persistence is enabled.
+        They are merged with the ones saved by the other workers, under a file lock.
+        """
+
+        if not self.__PATH:
+            return
+
+        path = Path(self.__PATH)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        with open(path.with_name(path.name + ".lock"), "a", encoding="utf-8") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            try:
+                self.__merge(self.__read(path))
+                write_atomic(path, json.dumps(self.__seen))
+
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def __merge(self, seen: dict[str, float]) -> None:
+        """
+        Add seen event IDs within the time window, keeping the newest ones within the size limit.
+
+        Args:
+            seen (dict[str, float]): The time each event was received at, by webhookEventId.
+        """
+
+        now = time()
+        merged = {
+            event_id: received_at
+            for event_id, received_at in (seen | self.__seen).items()
+            if now - received_at <= self.__WINDOW
+        }
+
+        self.__seen = OrderedDict(
+            sorted(merged.items(), key=lambda i: i[1])[-self.__MAX_SIZE :]
+        )
+
+    @staticmethod
+    def __read(path: Path) -> dict[str, float]:
+        """
+        Read the saved event IDs.
+
+        Args:
+            path (Path): The file of the event IDs.
+
+        Returns:
+            dict[str, float]: The time each event was received at, by webhookEventId,
+            empty if the file is missing or unreadable.
+        """
+
+        if not path.is_file():
+            return {}
+
+        try:
+            return json.loads(path.read_text(encoding="utf-8"))
+
+        except (OSError, ValueError):
+            return {}
+
+
+WEBHOOK_EVENT_FILTER = WebhookEventFilter()
@@ -0,0 +1,167 @@
+# -*- coding:utf-8 -*-
+from asyncio import CancelledError, Lock, Task, create_task, gather
+from collections import OrderedDict
+from itertools import count
+from os import getpid
+from time import time
+from typing import Any, Awaitable, Callable, Optional
+
+from .log_util import LOGGER
+
+
+class Job:
+    """An admin task run in the background, polled by its ID"""
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, job_id: str, action: str, params: dict[str, Any]) -> None:
+        self.id = job_id
+        self.action = action
+        self.params = params
+        self.state = self.QUEUED
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.created_at = time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def finished(self) -> bool:
+        """Whether the job is done or failed"""
+
+        return self.state in (self.DONE, self.FAILED)
+
+    def status(self) -> dict[str, Any]:
+        """
+        Report the state of the job.
+
+        Returns:
+            dict[str, Any]: The ID, action, parameters, state, result, error and times of the job.
+        """
+
+        return {
+            "id": self.id,
+            "action": self.action,
+            "params": self.params,
+            "state": self.state,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobRunner:
+    """
+    Runs the admin jobs of this worker one at a time, in the order they were submitted,
+    so refreshes do not add up on the upstream sites. The last finished jobs are kept for polling.
+    """
+
+    __MAX_FINISHED = 100
+
+    def __init__(self) -> None:
+        self.__jobs = OrderedDict[str, Job]()
+        self.__tasks = set[Task]()
+        self.__lock = Lock()
+        self.__ids = count(1)
+
+    def submit(
+        self,
+        action: str,
+        params: dict[str, Any],
+        run: Callable[[], Awaitable[Any]],
+    ) -> Job:
+        """
+        Queue a job.
+
+        Args:
+            action (str): The name of the action.
+            params (dict[str, Any]): The parameters of the action, shown in the status.
+            run (Callable[[], Awaitable[Any]]): Runs the action, returning its result.
+
+        Returns:
+            Job: The queued job.
+        """
+
+        # The worker is part of the ID, as each worker runs its own jobs
+        job = Job(f"{getpid()}-{next(self.__ids)}", action, params)
+        self.__jobs[job.id] = job
+
+        finished = [j.id for j in self.__jobs.values() if j.finished]
+        for job_id in finished[: -self.__MAX_FINISHED]:
+            del self.__jobs[job_id]
+
+        task = create_task(self.__run(job, run), name=f"job_{job.id}")
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """
+        Get a job by its ID.
+
+        Args:
+            job_id (str): The ID of the job.
+
+        Returns:
+            Optional[Job]: The job, None if unknown to this worker.
+        """
+
+        return self.__jobs.get(job_id)
+
+    def status(self) -> list[dict[str, Any]]:
+        """
+        Report the state of the known jobs.
+
+        Returns:
+            list[dict[str, Any]]: The state of each job, oldest first.
+        """
+
+        return [job.status() for job in self.__jobs.values()]
+
+    async def stop(self) -> None:
+        """Cancel the queued and running jobs."""
+
+        for task in self.__tasks:
+            task.cancel()
+
+        await gather(*self.__tasks, return_exceptions=True)
+
+    async def __run(self, job: Job, run: Callable[[], Awaitable[Any]]) -> None:
+        """
+        Run a job after the ones before it.
+
+        Args:
+            job (Job): The job.
+            run (Callable[[], Awaitable[Any]]): Runs the action, returning its result.
+        """
+
+        async with self.__lock:
+            job.state = Job.RUNNING
+            job.started_at = time()
+
+            try:
+                job.result = await run()
+                job.state = Job.DONE
+
+            except CancelledError:
+                job.error = "Cancelled"
+                job.state = Job.FAILED
+                raise
+
+            # Any failure of the action is reported in the job status instead of being lost in the task
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                job.error = f"{type(exc).__name__}: {exc}"
+                job.state = Job.FAILED
+
+            finally:
+                job.finished_at = time()
+                LOGGER.info("admin job %s", job.state, extra={"fields": job.status()})
+
+
+JOBS = JobRunner()
@@ -1,10 +1,33 @@
 # -*- coding:utf-8 -*-
+import random
 import sys
+from asyncio import (
+    CancelledError,
+    Event,
+    Task,
+    create_task,
+    ensure_future,
+    gather,
+    sleep,
+    wait,
+)
+from base64 import b64encode
+from collections import deque
+from email.utils import parsedate_to_datetime
+from hashlib import sha256
+from hmac import HMAC, compare_digest
+from itertools import count
 from os import getenv
-from typing import Optional
+from pathlib import Path
+from time import monotonic, time
+from typing import Any, Awaitable, Callable, Iterable, Optional
+from uuid import uuid4
 
-from linebot.v3 import WebhookParser
+from aiohttp import ClientError
+from httpx import AsyncClient, HTTPError, HTTPStatusError, Limits, TimeoutException
+from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import (
+    ApiException,
     AsyncApiClient,
     AsyncMessagingApi,
     Configuration,
@@ -12,11 +35,81 @@ from linebot.v3.messaging import (
     ReplyMessageRequest,
     ShowLoadingAnimationRequest,
 )
+from sanic.log import error_logger
+
+from .budget_util import REPLY_TOKEN_TTL, event_age
+from .file_util import write_atomic
+from .line_bot_util import to_json_dict
+from .metric_util import Counter, Gauge, Histogram
+from .trace_util import TRACER
+
+try:
+    from ujson import dumps, loads
+except ImportError:
+    from json import dumps, loads
+
+LOADING_SENT = Counter(
+    "ntpu_linebot_loading_animation_sent_total",
+    "Loading animations sent to LINE",
+)
+LOADING_SAVED = Counter(
+    "ntpu_linebot_loading_animation_saved_total",
+    "Loading animation API calls saved, by reason",
+    ("reason",),
+)
+FAST_REPLY_FALLBACK = Counter(
+    "ntpu_linebot_fast_reply_fallback_total",
+    "Replies sent through the SDK because the fast reply path could not serialize them",
+)
+LINE_API_LATENCY = Histogram(
+    "ntpu_linebot_line_api_request_seconds",
+    "Latency of LINE API requests, by endpoint",
+    ("endpoint",),
+)
+LINE_API_ERRORS = Counter(
+    "ntpu_linebot_line_api_errors_total",
+    "Failed LINE API requests, by endpoint and status",
+    ("endpoint", "status"),
+)
+LINE_API_RETRIES = Counter(
+    "ntpu_linebot_line_api_retries_total",
+    "Retried LINE API requests, by endpoint",
+    ("endpoint",),
+)
+MULTICAST_SENT = Counter(
+    "ntpu_linebot_multicast_recipients_total",
+    "Users sent multicast messages",
+)
+OUTBOX_DEPTH = Gauge(
+    "ntpu_linebot_outbox_batches",
+    "Multicast batches waiting in the outbox",
+)
 
 
 class LineAPIUtil:
-    __parser: Optional[WebhookParser] = None
+    __LOADING_GRACE = float(getenv("LOADING_GRACE_SECONDS", "1"))
+    __FAST_REPLY = getenv("FAST_REPLY", "true").lower() != "false"
+    __REPLY_URL = "https://api.line.me/v2/bot/message/reply"
+    __POOL_SIZE = int(getenv("LINE_API_POOL_SIZE", "20"))
+    __TIMEOUT = float(getenv("LINE_API_TIMEOUT_SECONDS", "10"))
+    __MAX_RETRIES = int(getenv("LINE_API_MAX_RETRIES", "3"))
+    __BACKOFF = float(getenv("LINE_API_BACKOFF_SECONDS", "0.5"))
+    __MAX_BACKOFF = 8.0
+    __MAX_SEND_ATTEMPTS = int(getenv("MULTICAST_MAX_ATTEMPTS", "10"))
+    __MULTICAST_URL = "https://api.line.me/v2/bot/message/multicast"
+    __MULTICAST_SIZE = 500
+    __MULTICAST_INTERVAL = 1 / float(getenv("MULTICAST_RATE_PER_SECOND", "100"))
+    __OUTBOX_PATH = getenv("OUTBOX_PATH")
+    __channel_secret: Optional[bytes] = None
     __line_bot_api: Optional[AsyncMessagingApi] = None
+    __client: Optional[AsyncClient] = None
+
+    def __init__(self) -> None:
+        # Multicast batches waiting to be sent, oldest first
+        self.__outbox = deque[dict[str, Any]]()
+        self.__outbox_ready: Optional[Event] = None
+        self.__outbox_worker: Optional[Task] = None
+        self.__sending: Optional[dict[str, Any]] = None
 
     @property
     def line_bot_api(self) -> AsyncMessagingApi:
@@ -29,12 +122,9 @@ class LineAPIUtil:
 
         if self.__line_bot_api is None:
             if channel_access_token := getenv("LINE_CHANNEL_ACCESS_TOKEN"):
-                self.__line_bot_api = AsyncMessagingApi(
-                    AsyncApiClient(
-                        Configuration(access_token=channel_access_token),
-                        pool_threads=2,
-                    )
-                )
+                configuration = Configuration(access_token=channel_access_token)
+                configuration.connection_pool_maxsize = self.__POOL_SIZE
+                self.__line_bot_api = AsyncMessagingApi(AsyncApiClient(configuration))
 
             else:
                 sys.exit("Specify LINE_CHANNEL_ACCESS_TOKEN as environment variable.")
@@ -42,38 +132,381 @@ class LineAPIUtil:
         return self.__line_bot_api
 
     @property
-    def parser(self) -> WebhookParser:
+    def channel_secret(self) -> bytes:
         """
-        Retrieves an instance of the WebhookParser class.
+        Retrieves the channel secret used to verify webhook signatures.
 
         Returns:
-            WebhookParser: An instance of the WebhookParser class.
+            bytes: The channel secret.
         """
 
-        if self.__parser is None:
+        if self.__channel_secret is None:
             if channel_secret := getenv("LINE_CHANNEL_SECRET"):
-                self.__parser = WebhookParser(channel_secret)
+                self.__channel_secret = channel_secret.encode()
 
             else:
                 sys.exit("Specify LINE_CHANNEL_SECRET as environment variable.")
 
-        return self.__parser
+        return self.__channel_secret
+
+    def parse_payloads(
+        self,
+        body: bytes,
+        signature: Optional[str],
+    ) -> list[dict[str, Any]]:
+        """
+        Verify the signature of a webhook request body and decode its events,
+        without building the SDK event models.
+
+        Args:
+            body (bytes): The raw request body.
+            signature (Optional[str]): The X-Line-Signature header.
+
+        Returns:
+            list[dict[str, Any]]: The decoded JSON of the events.
+
+        Raises:
+            InvalidSignatureError: If the signature is missing or invalid.
+            ValueError: If the body is not a JSON object with a list of event objects.
+        """
+
+        digest = HMAC(self.channel_secret, body, sha256).digest()
+        if signature is None or not compare_digest(
+            b64encode(digest), signature.encode()
+        ):
+            raise InvalidSignatureError(f"Invalid signature. signature={signature}")
+
+        if not isinstance(data := loads(body), dict):
+            raise ValueError("The webhook body is not a JSON object")
+
+        events = data.get("events", [])
+        if not isinstance(events, list) or not all(
+            isinstance(event, dict) for event in events
+        ):
+            raise ValueError("The webhook events are not a list of JSON objects")
+
+        return events
+
+    @property
+    def client(self) -> AsyncClient:
+        """
+        Retrieves the pooled HTTP client for the fast reply path.
+
+        Returns:
+            AsyncClient: An HTTP client authorized with the channel access token.
+        """
+
+        if self.__client is None:
+            access_token = self.line_bot_api.api_client.configuration.access_token
+            self.__client = AsyncClient(
+                headers={
+                    "Authorization": f"Bearer {access_token}",
+                    "Content-Type": "application/json",
+                },
+                limits=Limits(
+                    max_connections=self.__POOL_SIZE,
+                    max_keepalive_connections=self.__POOL_SIZE,
+                ),
+                timeout=self.__TIMEOUT,
+            )
+
+        return self.__client
+
+    async def close(self) -> None:
+        """Close the pooled HTTP client."""
+
+        if self.__client is not None:
+            await self.__client.aclose()
+            self.__client = None
 
     async def reply_message(self, reply_token: str, messages: list[Message]) -> None:
         """
         Create and send reply messages in the Line messaging platform.
+        Failed requests are retried while the reply token is still valid.
+
+        Args:
+            reply_token (str): The token for replying to a specific message.
+            messages (list[Message]): The list of messages to be sent as a reply.
+        """
+
+        expires_at = None
+        if (age := event_age()) is not None:
+            expires_at = monotonic() + REPLY_TOKEN_TTL - age
+
+        await self.__request(
+            "reply",
+            lambda: self.__send_reply_message(reply_token, messages),
+            self.__MAX_RETRIES,
+            expires_at,
+        )
+
+    async def __send_reply_message(
+        self,
+        reply_token: str,
+        messages: list[Message],
+    ) -> None:
+        """
+        Send reply messages once. The request is serialized and sent directly (FAST_REPLY),
+        falling back to the SDK if the messages cannot be serialized.
 
         Args:
             reply_token (str): The token for replying to a specific message.
             messages (list[Message]): The list of messages to be sent as a reply.
+
+        Raises:
+            HTTPError: If the fast request fails, retried by the caller.
         """
 
+        if self.__FAST_REPLY:
+            try:
+                await self.__fast_reply_message(reply_token, messages)
+                return
+
+            # HTTP errors are not retried through the SDK, the same endpoint would fail the same way
+            except (TypeError, ValueError):
+                FAST_REPLY_FALLBACK.inc()
+
+        # The messages are validated models or pre-serialized ones, skip validating them again
         await self.line_bot_api.reply_message(
-            ReplyMessageRequest(
-                replyToken=reply_token,
+            ReplyMessageRequest.construct(
+                reply_token=reply_token,
                 messages=messages,
-            )
+            ),
+            _request_timeout=self.__TIMEOUT,
+        )
+
+    async def __fast_reply_message(
+        self,
+        reply_token: str,
+        messages: list[Message],
+    ) -> None:
+        """
+        Send reply messages without the SDK request models and serializer.
+
+        Args:
+            reply_token (str): The token for replying to a specific message.
+            messages (list[Message]): The list of messages to be sent as a reply.
+
+        Raises:
+            HTTPError: If the request fails.
+        """
+
+        payload: dict[str, Any] = {
+            "replyToken": reply_token,
+            "messages": [to_json_dict(message) for message in messages],
+        }
+
+        res = await self.client.post(
+            self.__REPLY_URL,
+            content=dumps(payload, ensure_ascii=False).encode(),
+        )
+        res.raise_for_status()
+
+    def multicast_message(
+        self, user_ids: Iterable[str], messages: list[Message]
+    ) -> None:
+        """
+        Queue messages to be sent to many users, in multicast batches of up to 500 users.
+        Users already waiting for the same messages are skipped.
+        The outbox is kept across restarts if OUTBOX_PATH is set.
+
+        Args:
+            user_ids (Iterable[str]): The user IDs of the recipients.
+            messages (list[Message]): The list of messages to be sent.
+        """
+
+        data = [to_json_dict(message) for message in messages]
+        key = dumps(data, sort_keys=True)
+
+        waiting = set[str]()
+        open_batches = deque[dict[str, Any]]()
+        for batch in self.__outbox:
+            if batch["key"] == key:
+                waiting.update(batch["to"])
+
+                # The batch being sent must not change
+                if batch is not self.__sending:
+                    open_batches.append(batch)
+
+        for user_id in dict.fromkeys(user_ids):
+            if user_id in waiting:
+                continue
+
+            while open_batches and len(open_batches[0]["to"]) >= self.__MULTICAST_SIZE:
+                open_batches.popleft()
+
+            if not open_batches:
+                batch = {
+                    "key": key,
+                    "retryKey": str(uuid4()),
+                    "to": [],
+                    "messages": data,
+                }
+                self.__outbox.append(batch)
+                open_batches.append(batch)
+
+            open_batches[0]["to"].append(user_id)
+            waiting.add(user_id)
+
+        OUTBOX_DEPTH.set(value=len(self.__outbox))
+        self.__save_outbox()
+
+        if self.__outbox and self.__outbox_ready is not None:
+            self.__outbox_ready.set()
+
+    def start_outbox(self) -> None:
+        """Load the saved outbox and start sending it in the running event loop."""
+
+        self.__load_outbox()
+        self.__outbox_ready = Event()
+        self.__outbox_worker = create_task(self.__send_outbox(), name="outbox")
+
+        if self.__outbox:
+            self.__outbox_ready.set()
+
+    async def stop_outbox(self) -> None:
+        """Stop sending the outbox and save the unsent batches."""
+
+        if self.__outbox_worker is not None:
+            self.__outbox_worker.cancel()
+            await gather(self.__outbox_worker, return_exceptions=True)
+            self.__outbox_worker = None
+
+        self.__save_outbox()
+
+    async def __send_outbox(self) -> None:
+        """Send the multicast batches one by one, paced below the rate limit."""
+
+        while True:
+            await self.__outbox_ready.wait()
+            self.__outbox_ready.clear()
+
+            while self.__outbox:
+                batch = self.__sending = self.__outbox[0]
+
+                try:
+                    await self.__request(
+                        "multicast",
+                        lambda: self.__send_multicast(batch),
+                        self.__MAX_RETRIES,
+                    )
+                    MULTICAST_SENT.inc(value=len(batch["to"]))
+
+                except HTTPStatusError as exc:
+                    # 409 means the batch was already accepted before a restart
+                    if exc.response.status_code != 409:
+                        if (
+                            not exc.response.is_client_error
+                            and await self.__retry_later(batch)
+                        ):
+                            continue
+
+                        error_logger.error(
+                            "Multicast to %d users dropped: %s",
+                            len(batch["to"]),
+                            exc.response.text,
+                        )
+
+                except (HTTPError, TimeoutError) as exc:
+                    if await self.__retry_later(batch):
+                        continue
+
+                    error_logger.error(
+                        "Multicast to %d users dropped: %r", len(batch["to"]), exc
+                    )
+
+                except CancelledError:
+                    self.__sending = None
+                    raise
+
+                self.__outbox.popleft()
+                self.__sending = None
+                OUTBOX_DEPTH.set(value=len(self.__outbox))
+                self.__save_outbox()
+
+                await sleep(self.__MULTICAST_INTERVAL)
+
+    async def __retry_later(self, batch: dict[str, Any]) -> bool:
+        """
+        Count a failed send of a batch and wait before sending it again,
+        unless it has failed too many times, so a broken batch does not hold back the outbox forever.
+
+        Args:
+            batch (dict[str, Any]): The batch at the head of the outbox.
+
+        Returns:
+            bool: True if the batch is kept to be retried, False if it should be dropped.
+        """
+
+        batch["attempts"] = batch.get("attempts", 0) + 1
+        if batch["attempts"] >= self.__MAX_SEND_ATTEMPTS:
+            return False
+
+        self.__save_outbox()
+        await sleep(self.__MAX_BACKOFF)
+
+        return True
+
+    async def __send_multicast(self, batch: dict[str, Any]) -> None:
+        """
+        Send a multicast batch once. The retry key lets LINE drop the batch if it was already accepted.
+
+        Args:
+            batch (dict[str, Any]): The batch in the outbox.
+
+        Raises:
+            HTTPError: If the request fails.
+        """
+
+        payload = {"to": batch["to"], "messages": batch["messages"]}
+
+        res = await self.client.post(
+            self.__MULTICAST_URL,
+            content=dumps(payload, ensure_ascii=False).encode(),
+            headers={"X-Line-Retry-Key": batch["retryKey"]},
         )
+        res.raise_for_status()
+
+    def __outbox_file(self) -> Optional[Path]:
+        """
+        The file keeping the outbox of this worker, if persistence is enabled.
+        Each worker has its own, named after its slot so a restarted worker picks up the file of the one it replaces.
+
+        Returns:
+            Optional[Path]: The file, None if persistence is disabled.
+        """
+
+        if not self.__OUTBOX_PATH:
+            return None
+
+        path = Path(self.__OUTBOX_PATH)
+        if worker := getenv("SANIC_WORKER_NAME"):
+            # The server number in the worker name stays the same across restarts
+            slot = worker.rsplit("-", 1)[0]
+            path = path.with_name(f"{path.stem}.{slot}{path.suffix}")
+
+        return path
+
+    def __load_outbox(self) -> None:
+        """Load the outbox saved by the previous run, if persistence is enabled."""
+
+        if (path := self.__outbox_file()) is None or not path.is_file():
+            return
+
+        # The file also holds the batches queued before the start
+        try:
+            self.__outbox = deque(loads(path.read_text(encoding="utf-8")))
+
+        except (OSError, ValueError):
+            return
+
+        OUTBOX_DEPTH.set(value=len(self.__outbox))
+
+    def __save_outbox(self) -> None:
+        """Save the outbox for the next run, if persistence is enabled."""
+
+        if (path := self.__outbox_file()) is not None:
+            write_atomic(path, dumps(list(self.__outbox), ensure_ascii=False))
 
     async def loading_message(self, user_id: str) -> None:
         """
@@ -83,9 +516,142 @@ class LineAPIUtil:
             user_id (str): The user ID of the message sender.
         """
 
-        await self.line_bot_api.show_loading_animation(
-            ShowLoadingAnimationRequest(chatId=user_id, loadingSeconds=10)
+        # The loading animation is only useful right away, so it is not retried
+        await self.__request(
+            "loading",
+            lambda: self.line_bot_api.show_loading_animation(
+                ShowLoadingAnimationRequest(chatId=user_id, loadingSeconds=10),
+                _request_timeout=self.__TIMEOUT,
+            ),
+            0,
         )
 
+    async def __request(
+        self,
+        endpoint: str,
+        send: Callable[[], Awaitable[Any]],
+        retries: int,
+        expires_at: Optional[float] = None,
+    ) -> None:
+        """
+        Send a request to the LINE API, retrying rate limited, server and network errors
+        with jittered exponential backoff, or after the time given by Retry-After.
+
+        Args:
+            endpoint (str): The name of the endpoint, used in the metrics.
+            send (Callable[[], Awaitable[Any]]): A function sending the request once.
+            retries (int): The max number of retries.
+            expires_at (float, optional): The monotonic time after which the request is useless. Defaults to None.
+
+        Raises:
+            ApiException | HTTPError | ClientError | TimeoutError: The error of the last attempt.
+        """
+
+        for attempt in count():
+            start = monotonic()
+            try:
+                with TRACER.span(f"line_api.{endpoint}", attempt=attempt):
+                    await send()
+
+            except (ApiException, HTTPError, ClientError, TimeoutError) as exc:
+                LINE_API_LATENCY.observe(endpoint, value=monotonic() - start)
+
+                status, retry_after = self.__error_info(exc)
+                LINE_API_ERRORS.inc(endpoint, status)
+
+                if retry_after is None:
+                    backoff = min(self.__BACKOFF * 2**attempt, self.__MAX_BACKOFF)
+                    retry_after = backoff / 2 + random.uniform(0, backoff / 2)
+
+                if (
+                    attempt >= retries
+                    or not (status in ["429", "network", "timeout"] or status[0] == "5")
+                    or expires_at is not None
+                    and monotonic() + retry_after >= expires_at
+                ):
+                    raise
+
+                LINE_API_RETRIES.inc(endpoint)
+                await sleep(retry_after)
+
+            else:
+                LINE_API_LATENCY.observe(endpoint, value=monotonic() - start)
+                return
+
+    @staticmethod
+    def __error_info(exc: Exception) -> tuple[str, Optional[float]]:
+        """
+        Get the status and the Retry-After delay of a failed request.
+
+        Args:
+            exc (Exception): The error of the request.
+
+        Returns:
+            tuple[str, Optional[float]]: The HTTP status, "network" or "timeout", and the seconds to wait if given.
+        """
+
+        if isinstance(exc, HTTPStatusError):
+            status, headers = exc.response.status_code, exc.response.headers
+
+        elif isinstance(exc, ApiException):
+            status, headers = exc.status, exc.headers
+
+        elif isinstance(exc, (TimeoutException, TimeoutError)):
+            return "timeout", None
+
+        else:
+            return "network", None
+
+        if not headers or (retry_after := headers.get("Retry-After")) is None:
+            return str(status), None
+
+        try:
+            return str(status), max(float(retry_after), 0)
+
+        except ValueError:
+            pass
+
+        try:
+            return str(status), max(
+                parsedate_to_datetime(retry_after).timestamp() - time(), 0
+            )
+
+        except (TypeError, ValueError):
+            return str(status), None
+
+    async def loading_until_done(
+        self,
+        handler: Awaitable[None],
+        user_id: str,
+        loaded_user_ids: set[str],
+    ) -> None:
+        """
+        Run the handler, sending a loading message only if it has not finished
+        within the grace period (LOADING_GRACE_SECONDS).
+
+        Args:
+            handler (Awaitable[None]): The handler of the event.
+            user_id (str): The user ID of the message sender.
+            loaded_user_ids (set[str]): The users that already got a loading message in this webhook.
+        """
+
+        task = ensure_future(handler)
+        done, _ = await wait([task], timeout=self.__LOADING_GRACE)
+
+        if done:
+            LOADING_SAVED.inc("fast")
+
+        elif user_id in loaded_user_ids:
+            LOADING_SAVED.inc("duplicate")
+
+        else:
+            loaded_user_ids.add(user_id)
+            LOADING_SENT.inc()
+
+            # The loading animation is best effort, it must not fail the handler
+            await gather(self.loading_message(user_id), return_exceptions=True)
+
+        await task
+
 
 LINE_API_UTIL = LineAPIUtil()
@@ -1,16 +1,29 @@
 # -*- coding:utf-8 -*-
 import random
 from datetime import datetime
-from typing import Optional
+from enum import Enum
+from typing import Any, Optional
 
-from linebot.v3.messaging import Sender
+from linebot.v3.messaging import Message, Sender
 from linebot.v3.messaging.models import PostbackAction, TextMessage
+from pydantic.v1 import BaseModel, PrivateAttr
 
 from .sticker_util import STICKER
 
 EMPTY_POSTBACK_ACTION = PostbackAction(label=" ", data="null")
 
 
+def get_icon_url() -> Optional[str]:
+    """
+    Get a random sticker as the sender icon.
+
+    Returns:
+        Optional[str]: The URL of the sticker, None if no sticker is loaded.
+    """
+
+    return random.choice(STICKER.STICKER_LIST) if STICKER.STICKER_LIST else None
+
+
 def get_sender(name: Optional[str] = None) -> Sender:
     """
     Get sender information with a random sticker as the icon.
@@ -22,18 +35,134 @@ def get_sender(name: Optional[str] = None) -> Sender:
         A Sender object with the name and iconUrl.
     """
 
-    return Sender(
-        name=name,
-        iconUrl=random.choice(STICKER.STICKER_LIST) if STICKER.STICKER_LIST else None,
-    )
+    return Sender(name=name, iconUrl=get_icon_url())
+
+
+class SerializedMessage(Message):
+    """A message already serialized to JSON, sent as is without model validation"""
+
+    _data: dict[str, Any] = PrivateAttr()
+
+    @classmethod
+    def of(cls, data: dict[str, Any]) -> "SerializedMessage":
+        """
+        Wrap a serialized message.
+
+        Args:
+            data (dict[str, Any]): The JSON representation of the message.
+
+        Returns:
+            SerializedMessage: The message, without validating the data.
+        """
+
+        message = cls.construct(type=data["type"])
+        message._data = data
+        return message
+
+    def to_dict(self) -> dict[str, Any]:
+        return self._data
+
+
+def to_json_dict(obj: Any) -> Any:
+    """
+    Convert a validated message model to its JSON representation in a single pass.
+    Same as the SDK to_dict(), which serializes nested models once per level.
+
+    Args:
+        obj (Any): The message, or a value in it.
+
+    Returns:
+        Any: The JSON representation, without None values.
+    """
+
+    if isinstance(obj, SerializedMessage):
+        return obj.to_dict()
+
+    if isinstance(obj, BaseModel):
+        return {
+            field.alias: to_json_dict(value)
+            for name, field in obj.__fields__.items()
+            if (value := getattr(obj, name)) is not None
+        }
+
+    if isinstance(obj, list):
+        return [to_json_dict(value) for value in obj]
+
+    if isinstance(obj, dict):
+        return {key: to_json_dict(value) for key, value in obj.items()}
+
+    if isinstance(obj, Enum):
+        return obj.value
+
+    return obj
 
 
-def instruction() -> list[TextMessage]:
+class StaticReply:
+    """
+    Reply messages built and serialized once.
+    Only the sender icon is picked again for each reply.
+    """
+
+    def __init__(self, messages: list[Message]) -> None:
+        self.__messages = [message.to_dict() for message in messages]
+
+    def messages(self, quote_token: Optional[str] = None) -> list[Message]:
+        """
+        Get the messages of the reply with a random sender icon.
+
+        Args:
+            quote_token (str, optional): The quote token for the text messages. Defaults to None.
+
+        Returns:
+            list[Message]: The serialized messages.
+        """
+
+        icon_url = get_icon_url()
+        messages: list[Message] = []
+
+        for data in self.__messages:
+            data = data.copy()
+
+            if sender := data.get("sender"):
+                data["sender"] = sender | {"iconUrl": icon_url}
+                if icon_url is None:
+                    del data["sender"]["iconUrl"]
+
+            if quote_token and data["type"] == "text":
+                data["quoteToken"] = quote_token
+
+            messages.append(SerializedMessage.of(data))
+
+        return messages
+
+
+__INSTRUCTIONS = dict[int, StaticReply]()
+
+
+def instruction() -> list[Message]:
     """Provides instructions on how to use a Line messaging platform bot."""
 
-    mes_sender = get_sender("進階魔法師")
     last_year = datetime.now().year - 1
 
+    if (reply := __INSTRUCTIONS.get(last_year)) is None:
+        reply = __INSTRUCTIONS[last_year] = StaticReply(__build_instruction(last_year))
+
+    return reply.messages()
+
+
+def __build_instruction(last_year: int) -> list[TextMessage]:
+    """
+    Build the instruction messages.
+
+    Args:
+        last_year (int): The last year in the Gregorian calendar, used in the examples.
+
+    Returns:
+        list[TextMessage]: The instruction messages.
+    """
+
+    mes_sender = get_sender("進階魔法師")
+
     text_title = "使用說明："
 
     id_text = "\n".join(
@@ -0,0 +1,182 @@
+# -*- coding:utf-8 -*-
+import json
+import logging
+import random
+import sys
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import UTC, datetime
+from logging.handlers import QueueHandler, QueueListener
+from os import getenv
+from queue import Full, Queue
+from time import monotonic
+from typing import Any, Iterator, Optional
+
+from .metric_util import Counter
+
+LOGS_DROPPED = Counter(
+    "ntpu_linebot_logs_dropped_total",
+    "Log records dropped instead of blocking, by reason",
+    ("reason",),
+)
+
+LOGGER = logging.getLogger(__package__)
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON line, with the fields given in `extra={"fields": {...}}`"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, UTC).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        } | getattr(record, "fields", {})
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RateLimitedQueueHandler(QueueHandler):
+    """
+    Hands the records to the writer thread through a bounded queue,
+    dropping them when the queue is full or more than `rate` records are logged per second.
+    """
+
+    def __init__(self, queue: Queue, rate: float) -> None:
+        """
+        Args:
+            queue (Queue): The queue read by the writer thread.
+            rate (float): The max records per second, with bursts of as many, 0 means unlimited.
+        """
+
+        super().__init__(queue)
+        self.__rate = rate
+        self.__tokens = rate
+        self.__updated = monotonic()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The record stays in this process, so it is formatted by the writer thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if self.__rate:
+            now = monotonic()
+            self.__tokens = min(
+                self.__rate, self.__tokens + (now - self.__updated) * self.__rate
+            )
+            self.__updated = now
+
+            if self.__tokens < 1:
+                LOGS_DROPPED.inc("rate")
+                return
+
+            self.__tokens -= 1
+
+        try:
+            self.queue.put_nowait(record)
+
+        except Full:
+            LOGS_DROPPED.inc("queue")
+
+
+class LogPipeline:
+    """
+    Structured logs written as JSON lines by a background thread, to LOG_PATH or stdout,
+    so logging never blocks the event loop on I/O.
+
+    Each webhook event gets an access record with its latency and command class,
+    sampled at LOG_ACCESS_SAMPLE_RATE except for the failed ones.
+    """
+
+    __LEVEL = getenv("LOG_LEVEL", "INFO").upper()
+    __PATH = getenv("LOG_PATH")
+    __QUEUE_SIZE = int(getenv("LOG_QUEUE_SIZE", "10000"))
+    __RATE = float(getenv("LOG_RATE_PER_SECOND", "200"))
+    __ACCESS_SAMPLE_RATE = float(getenv("LOG_ACCESS_SAMPLE_RATE", "1"))
+
+    def __init__(self) -> None:
+        self.__queue = Queue[logging.LogRecord](maxsize=self.__QUEUE_SIZE)
+        self.__listener: Optional[QueueListener] = None
+        self.__access = ContextVar[Optional[dict[str, Any]]]("access", default=None)
+
+        LOGGER.addHandler(RateLimitedQueueHandler(self.__queue, self.__RATE))
+        LOGGER.setLevel(self.__LEVEL)
+        LOGGER.propagate = False
+
+    def start(self) -> None:
+        """Start the writer thread, writing the records logged so far."""
+
+        if self.__listener is not None:
+            return
+
+        writer = (
+            logging.FileHandler(self.__PATH, encoding="utf-8")
+            if self.__PATH
+            else logging.StreamHandler(sys.stdout)
+        )
+        writer.setFormatter(JsonFormatter())
+
+        self.__listener = QueueListener(self.__queue, writer)
+        self.__listener.start()
+
+    def stop(self) -> None:
+        """Write the remaining records and stop the writer thread."""
+
+        if self.__listener is None:
+            return
+
+        self.__listener.stop()
+        for handler in self.__listener.handlers:
+            handler.close()
+
+        self.__listener = None
+
+    @contextmanager
+    def access(self, **fields: Any) -> Iterator[None]:
+        """
+        Log an access record when the block ends, with its latency and outcome.
+
+        Args:
+            **fields (Any): The fields of the record, more can be added with `annotate`.
+        """
+
+        record = dict(fields)
+        token = self.__access.set(record)
+        start = monotonic()
+        failed = False
+
+        try:
+            yield
+            record.setdefault("outcome", "ok")
+
+        except BaseException as exc:
+            record["outcome"] = type(exc).__name__
+            failed = True
+            raise
+
+        finally:
+            self.__access.reset(token)
+            record["latency_ms"] = round((monotonic() - start) * 1000, 1)
+
+            if failed or random.random() < self.__ACCESS_SAMPLE_RATE:
+                LOGGER.info("access", extra={"fields": record})
+
+    def annotate(self, **fields: Any) -> None:
+        """
+        Add fields to the current access record, if any.
+
+        Args:
+            **fields (Any): The fields to add.
+        """
+
+        if (record := self.__access.get()) is not None:
+            record.update(fields)
+
+
+LOG_PIPELINE = LogPipeline()
@@ -0,0 +1,178 @@
+# -*- coding:utf-8 -*-
+import tracemalloc
+from asyncio import Task, create_task, gather, sleep
+from collections import deque
+from os import getenv
+from time import time
+from typing import Any, Optional
+
+from .memory_util import TTL_CACHES, deep_sizeof, memory_usage
+from .startup_util import process_memory, process_rss
+from .sticker_util import STICKER
+
+
+class MemoryReport:
+    """
+    The memory used by the datasets and caches of the worker, for the admin endpoint.
+
+    The bytes per entry of each dataset are sampled every MEMORY_SAMPLE_SECONDS.
+    Allocations are only traced with tracemalloc once asked for, since tracing slows down every allocation,
+    and each allocation report is compared with the previous one to find what grew in between.
+    """
+
+    __SAMPLE_INTERVAL = float(getenv("MEMORY_SAMPLE_SECONDS", "600"))
+    __MAX_SAMPLES = int(getenv("MEMORY_SAMPLES", "144"))
+    __MAX_TOP = 100
+
+    def __init__(self) -> None:
+        self.__samples = deque[dict[str, Any]](maxlen=self.__MAX_SAMPLES)
+        self.__sampler: Optional[Task] = None
+        self.__snapshot: Optional[tracemalloc.Snapshot] = None
+
+    def datasets(self) -> list[dict[str, Any]]:
+        """
+        Measure the memory used by each dataset and cache.
+
+        Returns:
+            list[dict[str, Any]]: The usage of each dataset and cache, with the bytes per entry.
+        """
+
+        usages = memory_usage()
+        usages.append(
+            {
+                "name": "sticker",
+                "entries": len(STICKER.STICKER_LIST),
+                "bytes": deep_sizeof(STICKER.STICKER_LIST),
+            }
+        )
+        usages += [cache.usage() for cache in TTL_CACHES]
+
+        for usage in usages:
+            usage["bytes_per_entry"] = (
+                usage["bytes"] // usage["entries"] if usage["entries"] else 0
+            )
+
+        return usages
+
+    def sample(self) -> None:
+        """Record the entries and bytes per entry of each dataset."""
+
+        self.__samples.append(
+            {
+                "time": int(time()),
+                "datasets": {
+                    usage["name"]: [usage["entries"], usage["bytes_per_entry"]]
+                    for usage in self.datasets()
+                },
+            }
+        )
+
+    def trend(self) -> list[dict[str, Any]]:
+        """
+        Get the recorded samples, oldest first.
+
+        Returns:
+            list[dict[str, Any]]: The time and the [entries, bytes per entry] of each dataset.
+        """
+
+        return list(self.__samples)
+
+    def allocations(self, top: int) -> dict[str, Any]:
+        """
+        Report the source lines that allocated the most memory since tracing started,
+        and the ones that grew the most since the previous report.
+        Tracing starts with the first report, so the first one is mostly empty.
+
+        Args:
+            top (int): The number of source lines to report.
+
+        Returns:
+            dict[str, Any]: The traced and peak bytes, the top allocators and the growth since the previous report.
+
+        Raises:
+            ValueError: If top is not from 1 to 100.
+        """
+
+        if not 1 <= top <= self.__MAX_TOP:
+            raise ValueError(f"top must be from 1 to {self.__MAX_TOP}")
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.__snapshot = None
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            )
+        )
+        traced, peak = tracemalloc.get_traced_memory()
+
+        report: dict[str, Any] = {
+            "traced_bytes": traced,
+            "peak_bytes": peak,
+            "top": [
+                {"line": str(stat.traceback), "bytes": stat.size, "count": stat.count}
+                for stat in snapshot.statistics("lineno")[:top]
+            ],
+            "diff": None,
+        }
+
+        if self.__snapshot is not None:
+            report["diff"] = [
+                {
+                    "line": str(stat.traceback),
+                    "bytes": stat.size_diff,
+                    "count": stat.count_diff,
+                }
+                for stat in snapshot.compare_to(self.__snapshot, "lineno")[:top]
+            ]
+
+        self.__snapshot = snapshot
+        return report
+
+    def stop_tracing(self) -> None:
+        """Stop tracing the allocations and drop the previous report."""
+
+        tracemalloc.stop()
+        self.__snapshot = None
+
+    def report(self) -> dict[str, Any]:
+        """
+        Report the memory of the worker process, its datasets and their trend.
+
+        Returns:
+            dict[str, Any]: The process memory, the datasets, the trend and whether allocations are traced.
+        """
+
+        return {
+            "process": {"rss": process_rss()} | process_memory(),
+            "datasets": self.datasets(),
+            "trend": self.trend(),
+            "tracing": tracemalloc.is_tracing(),
+        }
+
+    def start_sampler(self) -> None:
+        """Start sampling the datasets in the background."""
+
+        if self.__sampler is None:
+            self.__sampler = create_task(self.__sample_loop(), name="memory_sampler")
+
+    async def stop_sampler(self) -> None:
+        """Stop sampling the datasets."""
+
+        if self.__sampler is not None:
+            self.__sampler.cancel()
+            await gather(self.__sampler, return_exceptions=True)
+            self.__sampler = None
+
+    async def __sample_loop(self) -> None:
+        """Sample the datasets periodically."""
+
+        while True:
+            self.sample()
+            await sleep(self.__SAMPLE_INTERVAL)
+
+
+MEMORY_REPORT = MemoryReport()
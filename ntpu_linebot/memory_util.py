@@ -0,0 +1,460 @@
+# -*- coding:utf-8 -*-
+import sys
+from collections import OrderedDict
+from collections.abc import (
+    ItemsView,
+    Iterable,
+    Iterator,
+    KeysView,
+    MutableMapping,
+    ValuesView,
+)
+from os import getenv
+from time import monotonic
+from typing import Any, Callable, Generic, Optional, TypeVar
+
+from cachetools import Cache, TTLCache
+
+from .metric_util import Counter, Gauge
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+CACHE_LOOKUPS = Counter(
+    "ntpu_linebot_cache_lookups_total",
+    "Lookups of cached data by key, by cache and result",
+    ("cache", "result"),
+)
+STORE_ENTRIES = Gauge(
+    "ntpu_linebot_store_entries",
+    "Entries of each dataset, by store",
+    ("store",),
+)
+STORE_BYTES = Gauge(
+    "ntpu_linebot_store_bytes",
+    "Estimated memory used by each dataset, by store",
+    ("store",),
+)
+STORE_EVICTIONS = Counter(
+    "ntpu_linebot_store_evictions_total",
+    "Entries evicted from each dataset, by store",
+    ("store",),
+)
+
+__MB = 1024 * 1024
+__DAY = 60 * 60 * 24
+
+
+def deep_sizeof(obj: Any, seen: Optional[set[int]] = None) -> int:
+    """
+    Estimate the memory used by an object and everything it references.
+
+    Args:
+        obj (Any): The object to measure.
+        seen (set[int], optional): Ids of objects already counted. Defaults to None.
+
+    Returns:
+        int: The estimated size in bytes.
+    """
+
+    if seen is None:
+        seen = set()
+
+    if id(obj) in seen:
+        return 0
+
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+
+    if isinstance(obj, (str, bytes, int, float, bool)) or obj is None:
+        return size
+
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(i, seen) for i in obj)
+
+    elif hasattr(obj, "__dict__"):
+        size += deep_sizeof(obj.__dict__, seen)
+
+    return size
+
+
+def _key_matches(text: str, key: Optional[str], prefix: Optional[str]) -> bool:
+    """
+    Check whether an entry is selected by a key or a prefix, all entries if neither is given.
+
+    Args:
+        text (str): The key of the entry as text.
+        key (Optional[str]): The key to match exactly.
+        prefix (Optional[str]): The prefix to match.
+
+    Returns:
+        bool: True if the entry is selected.
+    """
+
+    if key is not None and text != key:
+        return False
+
+    return prefix is None or text.startswith(prefix)
+
+
+def budget_from_env(name: str, default_mb: float) -> int:
+    """
+    Read a byte budget from the environment variable `{name}_BUDGET_MB`.
+
+    Args:
+        name (str): The prefix of the environment variable.
+        default_mb (float): The budget in MB used when the variable is not set.
+
+    Returns:
+        int: The budget in bytes, 0 means unlimited.
+    """
+
+    return int(float(getenv(f"{name}_BUDGET_MB", default_mb)) * __MB)
+
+
+def max_age_from_env(name: str) -> Optional[float]:
+    """
+    Read the maximum entry age from the environment variable `{name}_MAX_AGE_DAYS`.
+
+    Args:
+        name (str): The prefix of the environment variable.
+
+    Returns:
+        Optional[float]: The maximum age in seconds, or None if not set.
+    """
+
+    if days := getenv(f"{name}_MAX_AGE_DAYS"):
+        return float(days) * __DAY
+
+    return None
+
+
+class MemoryStore(MutableMapping[K, V], Generic[K, V]):
+    """
+    A dict-like store that accounts the memory used by its entries
+    and evicts them to stay within a byte budget.
+
+    Entries are kept in least recently used order. When the budget is exceeded,
+    stale entries (older than `max_age` or matched by `is_stale`) are dropped first,
+    unless they were queried within `protect` seconds, then the least recently used ones.
+    """
+
+    __SWEEP_INTERVAL = 60
+
+    def __init__(
+        self,
+        name: str,
+        budget: int = 0,
+        max_age: Optional[float] = None,
+        is_stale: Optional[Callable[[K, V], bool]] = None,
+        protect: float = 60 * 60,
+    ) -> None:
+        self.__name = name
+        self.__budget = budget
+        self.__max_age = max_age
+        self.__is_stale = is_stale
+        self.__protect = protect
+        self.__data = OrderedDict[K, V]()
+        self.__sizes = dict[K, int]()
+        self.__inserted = dict[K, float]()
+        self.__accessed = dict[K, float]()
+        self.__bytes = 0
+        self.__evictions = 0
+        self.__last_sweep = 0.0
+
+        MEMORY_STORES.append(self)
+
+    @property
+    def name(self) -> str:
+        """Getter for name"""
+        return self.__name
+
+    @property
+    def budget(self) -> int:
+        """Getter for budget"""
+        return self.__budget
+
+    @property
+    def bytes(self) -> int:
+        """Getter for bytes"""
+        return self.__bytes
+
+    def __getitem__(self, key: K) -> V:
+        try:
+            value = self.__data[key]
+
+        except KeyError:
+            CACHE_LOOKUPS.inc(self.__name, "miss")
+            raise
+
+        CACHE_LOOKUPS.inc(self.__name, "hit")
+        return value
+
+    def __setitem__(self, key: K, value: V) -> None:
+        if key in self.__data:
+            self.__bytes -= self.__sizes[key]
+
+        size = deep_sizeof(key) + deep_sizeof(value)
+        now = monotonic()
+
+        self.__data[key] = value
+        self.__data.move_to_end(key)
+        self.__sizes[key] = size
+        self.__inserted[key] = now
+        self.__accessed[key] = now
+        self.__bytes += size
+
+        if self.__budget and self.__bytes > self.__budget:
+            self.__shrink()
+
+        STORE_ENTRIES.set(self.__name, value=len(self.__data))
+        STORE_BYTES.set(self.__name, value=self.__bytes)
+
+    def __delitem__(self, key: K) -> None:
+        del self.__data[key]
+        self.__bytes -= self.__sizes.pop(key)
+        del self.__inserted[key]
+        del self.__accessed[key]
+
+        STORE_ENTRIES.set(self.__name, value=len(self.__data))
+        STORE_BYTES.set(self.__name, value=self.__bytes)
+
+    def __iter__(self) -> Iterator[K]:
+        return iter(self.__data)
+
+    def __len__(self) -> int:
+        return len(self.__data)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.__data
+
+    def keys(self) -> KeysView[K]:
+        return self.__data.keys()
+
+    def values(self) -> ValuesView[V]:
+        return self.__data.values()
+
+    def items(self) -> ItemsView[K, V]:
+        return self.__data.items()
+
+    def touch(self, keys: Iterable[K]) -> None:
+        """
+        Mark entries as recently queried, protecting them from eviction.
+
+        Args:
+            keys (Iterable[K]): The keys of the queried entries.
+        """
+
+        now = monotonic()
+        for key in keys:
+            if key in self.__data:
+                self.__data.move_to_end(key)
+                self.__accessed[key] = now
+
+    def evict(self, predicate: Callable[[K, V], bool]) -> int:
+        """
+        Remove the entries matching the predicate, except recently queried ones.
+
+        Args:
+            predicate (Callable[[K, V], bool]): Returns True for entries to remove.
+
+        Returns:
+            int: The number of removed entries.
+        """
+
+        now = monotonic()
+        keys = [
+            key
+            for key, value in self.__data.items()
+            if now - self.__accessed[key] > self.__protect and predicate(key, value)
+        ]
+
+        for key in keys:
+            del self[key]
+
+        self.__evictions += len(keys)
+        STORE_EVICTIONS.inc(self.__name, value=len(keys))
+        return len(keys)
+
+    def invalidate(
+        self, key: Optional[str] = None, prefix: Optional[str] = None
+    ) -> int:
+        """
+        Remove an entry, the entries whose key starts with a prefix, or all entries.
+
+        Args:
+            key (str, optional): The key of the entry to remove. Defaults to None.
+            prefix (str, optional): The prefix of the keys to remove. Defaults to None.
+
+        Returns:
+            int: The number of removed entries.
+        """
+
+        keys = [k for k in self.__data if _key_matches(str(k), key, prefix)]
+        for k in keys:
+            del self[k]
+
+        return len(keys)
+
+    def evict_stale(self) -> int:
+        """
+        Remove the entries older than max_age or matched by is_stale.
+
+        Returns:
+            int: The number of removed entries.
+        """
+
+        self.__last_sweep = monotonic()
+        if self.__max_age is None and self.__is_stale is None:
+            return 0
+
+        now = monotonic()
+        return self.evict(
+            lambda key, value: (
+                self.__max_age is not None
+                and now - self.__inserted[key] > self.__max_age
+            )
+            or (self.__is_stale is not None and self.__is_stale(key, value))
+        )
+
+    def usage(self) -> dict[str, Any]:
+        """
+        Report the current memory usage of the store.
+
+        Returns:
+            dict[str, Any]: The name, entry count, used bytes, bytes of the index, budget and eviction count.
+        """
+
+        return {
+            "name": self.__name,
+            "entries": len(self.__data),
+            "bytes": self.__bytes,
+            # The containers themselves, not accounted in the budget
+            "index_bytes": sum(
+                sys.getsizeof(index)
+                for index in (
+                    self.__data,
+                    self.__sizes,
+                    self.__inserted,
+                    self.__accessed,
+                )
+            ),
+            "budget": self.__budget,
+            "evictions": self.__evictions,
+        }
+
+    def __shrink(self) -> None:
+        """Evict entries until the store fits in its budget."""
+
+        if monotonic() - self.__last_sweep > self.__SWEEP_INTERVAL:
+            self.evict_stale()
+
+        while self.__bytes > self.__budget and len(self.__data) > 1:
+            del self[next(iter(self.__data))]
+            self.__evictions += 1
+            STORE_EVICTIONS.inc(self.__name)
+
+
+MEMORY_STORES: list[MemoryStore] = []
+
+
+class MeteredTTLCache(TTLCache):
+    """A TTLCache counting the hits and misses of its lookups"""
+
+    def __init__(self, name: str, maxsize: int, ttl: float) -> None:
+        super().__init__(maxsize, ttl)
+        self.__name = name
+        self.__evicting = False
+
+        TTL_CACHES.append(self)
+
+    @property
+    def name(self) -> str:
+        """Getter for name"""
+        return self.__name
+
+    def __getitem__(
+        self, key: Any, cache_getitem: Callable[[Cache, Any], Any] = Cache.__getitem__
+    ) -> Any:
+        try:
+            value = super().__getitem__(key, cache_getitem)
+
+        except KeyError:
+            CACHE_LOOKUPS.inc(self.__name, "miss")
+            raise
+
+        # An evicted item is read once more on its way out, which is not a lookup
+        if not self.__evicting:
+            CACHE_LOOKUPS.inc(self.__name, "hit")
+
+        return value
+
+    def popitem(self) -> tuple[Any, Any]:
+        self.__evicting = True
+        try:
+            return super().popitem()
+
+        finally:
+            self.__evicting = False
+
+    def invalidate(
+        self, key: Optional[str] = None, prefix: Optional[str] = None
+    ) -> int:
+        """
+        Remove an entry, the entries whose key starts with a prefix, or all entries.
+        The key of an entry is made of the arguments of the cached call joined by ":", e.g. "112:79".
+
+        Args:
+            key (str, optional): The key of the entry to remove. Defaults to None.
+            prefix (str, optional): The prefix of the keys to remove. Defaults to None.
+
+        Returns:
+            int: The number of removed entries.
+        """
+
+        keys = [
+            k
+            for k in list(self)
+            # The bound instance of a cached method is not part of the key
+            if _key_matches(
+                ":".join(str(arg) for arg in k if isinstance(arg, (str, int, float))),
+                key,
+                prefix,
+            )
+        ]
+        for k in keys:
+            del self[k]
+
+        return len(keys)
+
+    def usage(self) -> dict[str, Any]:
+        """
+        Report the current memory usage of the cache, measured now.
+
+        Returns:
+            dict[str, Any]: The name, entry count, used bytes and max size.
+        """
+
+        return {
+            "name": self.__name,
+            "entries": len(self),
+            "bytes": deep_sizeof(self),
+            "maxsize": self.maxsize,
+        }
+
+
+TTL_CACHES: list[MeteredTTLCache] = []
+
+
+def memory_usage() -> list[dict[str, Any]]:
+    """
+    Report the memory usage of all datasets.
+
+    Returns:
+        list[dict[str, Any]]: The usage of each MemoryStore.
+    """
+
+    return [store.usage() for store in MEMORY_STORES]
@@ -0,0 +1,247 @@
+# -*- coding:utf-8 -*-
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Iterator, Sequence
+
+
+class Metric(ABC):
+    """Abstract class for metrics exposed in the Prometheus text format"""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+    ) -> None:
+        self._name = name
+        self._documentation = documentation
+        self._labelnames = labelnames
+        self._values = dict[tuple[str, ...], float]()
+
+        METRICS.register(self)
+
+    @property
+    def name(self) -> str:
+        """Getter for name"""
+        return self._name
+
+    @property
+    @abstractmethod
+    def kind(self) -> str:
+        """The Prometheus metric type"""
+
+    def value(self, *labels: str) -> float:
+        """
+        Get the current value of the metric.
+
+        Args:
+            *labels (str): The label values, in the order of labelnames.
+
+        Returns:
+            float: The current value, 0 if never set.
+        """
+
+        return self._values.get(labels, 0.0)
+
+    def samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+        """
+        Iterate the samples of the metric.
+
+        Returns:
+            Iterator[tuple[str, dict[str, str], float]]: The sample name suffix, labels and value.
+        """
+
+        for labels, value in self._values.items():
+            yield "", dict(zip(self._labelnames, labels)), value
+
+    def render(self) -> str:
+        """
+        Render the metric in the Prometheus text format.
+
+        Returns:
+            str: The rendered metric.
+        """
+
+        lines = [
+            f"# HELP {self._name} {self._documentation}",
+            f"# TYPE {self._name} {self.kind}",
+        ]
+
+        for suffix, labels, value in self.samples():
+            if labels:
+                label_str = ",".join(
+                    f'{k}="{escape_label(v)}"' for k, v in labels.items()
+                )
+                lines.append(f"{self._name}{suffix}{{{label_str}}} {value}")
+
+            else:
+                lines.append(f"{self._name}{suffix} {value}")
+
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """A monotonically increasing value"""
+
+    @property
+    def kind(self) -> str:
+        return "counter"
+
+    def inc(self, *labels: str, value: float = 1.0) -> None:
+        """
+        Increase the counter.
+
+        Args:
+            *labels (str): The label values, in the order of labelnames.
+            value (float, optional): The amount to increase. Defaults to 1.
+        """
+
+        self._values[labels] = self._values.get(labels, 0.0) + value
+
+
+class Gauge(Metric):
+    """A value that can go up and down"""
+
+    @property
+    def kind(self) -> str:
+        return "gauge"
+
+    def set(self, *labels: str, value: float) -> None:
+        """
+        Set the gauge.
+
+        Args:
+            *labels (str): The label values, in the order of labelnames.
+            value (float): The new value.
+        """
+
+        self._values[labels] = value
+
+    def inc(self, *labels: str, value: float = 1.0) -> None:
+        """
+        Increase the gauge.
+
+        Args:
+            *labels (str): The label values, in the order of labelnames.
+            value (float, optional): The amount to increase. Defaults to 1.
+        """
+
+        self._values[labels] = self._values.get(labels, 0.0) + value
+
+    def dec(self, *labels: str, value: float = 1.0) -> None:
+        """
+        Decrease the gauge.
+
+        Args:
+            *labels (str): The label values, in the order of labelnames.
+            value (float, optional): The amount to decrease. Defaults to 1.
+        """
+
+        self._values[labels] = self._values.get(labels, 0.0) - value
+
+
+class Histogram(Metric):
+    """Observations counted in pre-defined buckets"""
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.__buckets = tuple(buckets)
+        self.__counts = dict[tuple[str, ...], list[int]]()
+        self.__sums = dict[tuple[str, ...], float]()
+
+    @property
+    def kind(self) -> str:
+        return "histogram"
+
+    def observe(self, *labels: str, value: float) -> None:
+        """
+        Record an observation.
+
+        Args:
+            *labels (str): The label values, in the order of labelnames.
+            value (float): The observed value.
+        """
+
+        if (counts := self.__counts.get(labels)) is None:
+            counts = self.__counts[labels] = [0] * (len(self.__buckets) + 1)
+
+        counts[bisect_left(self.__buckets, value)] += 1
+        self.__sums[labels] = self.__sums.get(labels, 0.0) + value
+
+    def value(self, *labels: str) -> float:
+        """
+        Get the number of observations.
+
+        Args:
+            *labels (str): The label values, in the order of labelnames.
+
+        Returns:
+            float: The number of observations, 0 if never observed.
+        """
+
+        return float(sum(self.__counts.get(labels, [])))
+
+    def samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+        for labels, counts in self.__counts.items():
+            label_dict = dict(zip(self._labelnames, labels))
+
+            cumulative = 0
+            for bound, count in zip(self.__buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else str(bound)
+                yield "_bucket", label_dict | {"le": le}, cumulative
+
+            yield "_sum", label_dict, self.__sums[labels]
+            yield "_count", label_dict, cumulative
+
+
+def escape_label(value: str) -> str:
+    """
+    Escape a label value for the Prometheus text format.
+
+    Args:
+        value (str): The label value.
+
+    Returns:
+        str: The escaped label value.
+    """
+
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+class MetricRegistry:
+    __metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> None:
+        """
+        Register a metric to be exposed.
+
+        Args:
+            metric (Metric): The metric to register.
+        """
+
+        if metric.name in self.__metrics:
+            raise ValueError(f"Duplicated metric {metric.name}")
+
+        self.__metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """
+        Render all registered metrics in the Prometheus text format.
+
+        Returns:
+            str: The rendered metrics.
+        """
+
+        return "\n".join(m.render() for m in self.__metrics.values()) + "\n"
+
+
+METRICS = MetricRegistry()
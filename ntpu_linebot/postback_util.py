@@ -0,0 +1,91 @@
+# -*- coding:utf-8 -*-
+from typing import Any, Awaitable, Callable, NamedTuple, Optional
+
+from linebot.v3.messaging.models import Message
+
+# Postback data with another version, or none, are the legacy free-form payloads
+POSTBACK_VERSION = "1"
+__SEPARATOR = "|"
+__ESCAPES = [("%", "%25"), ("|", "%7C")]
+
+
+class PostbackHandler(NamedTuple):
+    """
+    The handler of a postback action, with the types of its arguments.
+    It is called with the user ID, None if not in a one-on-one chat, and the typed arguments.
+    needs_upstream predicts from the typed arguments whether an upstream request is needed.
+    """
+
+    handle: Callable[..., Awaitable[list[Message]]]
+    arg_types: tuple[type, ...] = ()
+    needs_upstream: Optional[Callable[..., bool]] = None
+
+    def parse_args(self, args: list[str]) -> Optional[tuple[Any, ...]]:
+        """
+        Convert the arguments of the postback to their types.
+
+        Args:
+            args (list[str]): The decoded arguments.
+
+        Returns:
+            Optional[tuple[Any, ...]]: The typed arguments, None if they do not match the handler.
+        """
+
+        if len(args) != len(self.arg_types):
+            return None
+
+        try:
+            return tuple(arg_type(arg) for arg_type, arg in zip(self.arg_types, args))
+
+        except ValueError:
+            return None
+
+
+def encode_postback(namespace: str, action: str, *args: str | int) -> str:
+    """
+    Encode a postback action as "<version>|<namespace>|<action>|<args>...".
+
+    Args:
+        namespace (str): The namespace of the bot handling the action.
+        action (str): The name of the action.
+        *args (str | int): The arguments of the action.
+
+    Returns:
+        str: The postback data.
+    """
+
+    parts = [POSTBACK_VERSION, namespace, action]
+    for arg in args:
+        arg = str(arg)
+        for char, escape in __ESCAPES:
+            arg = arg.replace(char, escape)
+
+        parts.append(arg)
+
+    return __SEPARATOR.join(parts)
+
+
+def decode_postback(data: str) -> Optional[tuple[str, str, list[str]]]:
+    """
+    Decode postback data encoded by `encode_postback`.
+
+    Args:
+        data (str): The postback data.
+
+    Returns:
+        Optional[tuple[str, str, list[str]]]: The namespace, the action and the arguments,
+        None if the data is a legacy payload.
+    """
+
+    parts = data.split(__SEPARATOR)
+    if len(parts) < 3 or parts[0] != POSTBACK_VERSION or not parts[1] or not parts[2]:
+        return None
+
+    args = []
+    for arg in parts[3:]:
+        for char, escape in reversed(__ESCAPES):
+            arg = arg.replace(escape, char)
+
+        args.append(arg)
+
+    return parts[1], parts[2], args
@@ -0,0 +1,204 @@
+# -*- coding:utf-8 -*-
+import gc
+import pickle
+from asyncio import sleep, to_thread
+from os import getenv
+from pathlib import Path
+from typing import Any, Optional
+
+from sanic.log import error_logger
+
+from .file_util import write_atomic
+from .memory_util import MEMORY_STORES
+
+# Load the datasets in the main process and fork the workers from it (PRELOAD=true)
+PRELOAD = getenv("PRELOAD", "false").lower() == "true"
+__DATASET_PATH = getenv("DATASET_PATH")
+# How often the workers that do not crawl load the datasets saved by the crawler
+__RELOAD_SECONDS = float(getenv("DATASET_RELOAD_SECONDS", "300"))
+# Entries added to a store before yielding to the event loop during a reload
+__RELOAD_CHUNK = 1000
+# The first server worker keeps crawling, its restarts get a new suffix
+__CRAWLER_WORKER = "Sanic-Server-0-"
+
+
+def is_crawler() -> bool:
+    """
+    Check whether this process refreshes the datasets from the upstreams.
+    With PRELOAD and DATASET_PATH, only one worker crawls and saves the datasets,
+    the others serve the preloaded ones and reload what it saves, so the upstream load does not grow with the workers.
+    Otherwise, the crawled datasets cannot be shared and every worker fills its own.
+
+    Returns:
+        bool: True without PRELOAD or DATASET_PATH, for the first server worker,
+        or when not running under the worker manager.
+    """
+
+    if not PRELOAD or not __DATASET_PATH:
+        return True
+
+    worker = getenv("SANIC_WORKER_NAME")
+
+    return not worker or worker.startswith(__CRAWLER_WORKER)
+
+
+def __read_dataset(path: Path) -> Optional[list[tuple[Any, Any]]]:
+    """
+    Read a saved dataset.
+
+    Args:
+        path (Path): The file of the dataset.
+
+    Returns:
+        Optional[list[tuple[Any, Any]]]: The entries, None if the file is unreadable.
+    """
+
+    try:
+        return pickle.loads(path.read_bytes())
+
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        error_logger.warning("Failed to load the %s dataset", path.stem)
+        return None
+
+
+def __write_dataset(path: Path, entries: list[tuple[Any, Any]]) -> None:
+    """
+    Save a dataset.
+
+    Args:
+        path (Path): The file of the dataset.
+        entries (list[tuple[Any, Any]]): The entries of the dataset.
+    """
+
+    write_atomic(path, pickle.dumps(entries))
+
+
+def load_datasets() -> int:
+    """
+    Load the datasets saved by the previous run into their MemoryStore, if persistence is enabled.
+
+    Returns:
+        int: The number of entries loaded.
+    """
+
+    if not __DATASET_PATH:
+        return 0
+
+    count = 0
+    for store in MEMORY_STORES:
+        path = Path(__DATASET_PATH) / f"{store.name}.pickle"
+        if not path.is_file() or (entries := __read_dataset(path)) is None:
+            continue
+
+        store.update(entries)
+        count += len(entries)
+
+    return count
+
+
+def save_datasets(*names: str) -> None:
+    """
+    Save the datasets for the next run and the other workers, if persistence is enabled.
+
+    Args:
+        *names (str): The names of the stores to save, all of them if none is given.
+    """
+
+    if not __DATASET_PATH:
+        return
+
+    for store in MEMORY_STORES:
+        if not names or store.name in names:
+            __write_dataset(
+                Path(__DATASET_PATH) / f"{store.name}.pickle", list(store.items())
+            )
+
+
+async def persist_dataset(name: str) -> None:
+    """
+    Save a dataset once its crawl ends, so a crash does not lose it and the other workers can reload it.
+    The entries are listed on the event loop, where the store is changed, and written in a thread.
+
+    Args:
+        name (str): The name of the store.
+    """
+
+    if not __DATASET_PATH:
+        return
+
+    for store in MEMORY_STORES:
+        if store.name == name:
+            path = Path(__DATASET_PATH) / f"{name}.pickle"
+            entries = list(store.items())
+
+            try:
+                await to_thread(__write_dataset, path, entries)
+
+            except OSError:
+                error_logger.warning("Failed to save the %s dataset", name)
+
+
+async def watch_datasets() -> None:
+    """
+    Reload the datasets saved by the crawler whenever their file changes, in a worker that does not crawl.
+    The files are read in a thread and the entries added in chunks, so the event loop keeps serving.
+    """
+
+    if not __DATASET_PATH:
+        return
+
+    directory = Path(__DATASET_PATH)
+    # The files loaded at startup are the ones seen so far
+    loaded = {
+        store.name: path.stat().st_mtime
+        for store in MEMORY_STORES
+        if (path := directory / f"{store.name}.pickle").is_file()
+    }
+
+    while True:
+        await sleep(__RELOAD_SECONDS)
+
+        for store in MEMORY_STORES:
+            path = directory / f"{store.name}.pickle"
+
+            try:
+                mtime = path.stat().st_mtime
+
+            except OSError:
+                continue
+
+            if loaded.get(store.name) == mtime:
+                continue
+
+            loaded[store.name] = mtime
+            if (entries := await to_thread(__read_dataset, path)) is None:
+                continue
+
+            for i in range(0, len(entries), __RELOAD_CHUNK):
+                store.update(entries[i : i + __RELOAD_CHUNK])
+                await sleep(0)
+
+
+def preload() -> int:
+    """
+    Load the datasets in the main process before the workers are forked.
+    The garbage collector is paused during the load, so no freed holes are left between the loaded objects,
+    then everything alive is frozen, so the collections in the workers never write to those pages
+    and they stay shared copy-on-write. The collector is resumed before the workers are forked,
+    as the frozen objects are left out of its collections.
+
+    Returns:
+        int: The number of entries loaded.
+    """
+
+    if not __DATASET_PATH:
+        error_logger.warning(
+            "PRELOAD is set without DATASET_PATH, every worker crawls its own datasets"
+        )
+
+    gc.disable()
+    count = load_datasets()
+    gc.freeze()
+    gc.enable()
+
+    return count
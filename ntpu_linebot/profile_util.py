@@ -0,0 +1,183 @@
+# -*- coding:utf-8 -*-
+import signal
+import sys
+import threading
+from asyncio import AbstractEventLoop, current_task, get_running_loop, sleep
+from collections import Counter
+from os import getenv
+from types import CodeType, FrameType
+from typing import Any, Optional
+
+# A frame of a sampled stack: name, file and line
+Frame = tuple[str, str, int]
+
+
+class Profiler:
+    """
+    A sampling profiler for a live worker, turned on for a few seconds at a time.
+
+    A timer signal interrupts the worker every PROFILE_INTERVAL_MS of CPU time and records
+    the stack of every thread, so the profiled code runs unchanged and idle time is not sampled.
+    The stacks of the event loop thread start with the asyncio task running at that moment,
+    attributing the time to the event workers and the other tasks.
+    """
+
+    __INTERVAL = float(getenv("PROFILE_INTERVAL_MS", "10")) / 1000
+    __MAX_SECONDS = float(getenv("PROFILE_MAX_SECONDS", "30"))
+
+    def __init__(self) -> None:
+        self.__stacks: Optional[Counter[tuple[Frame, ...]]] = None
+        self.__loop: Optional[AbstractEventLoop] = None
+        self.__labels = dict[CodeType, Frame]()
+
+    async def profile(self, seconds: float) -> Counter[tuple[Frame, ...]]:
+        """
+        Sample the stacks of the worker for a while, from the event loop of the main thread.
+
+        Args:
+            seconds (float): The duration of the profile, up to PROFILE_MAX_SECONDS.
+
+        Returns:
+            Counter[tuple[Frame, ...]]: The number of samples of each stack, outermost frame first.
+
+        Raises:
+            RuntimeError: If a profile is already being taken.
+        """
+
+        if self.__stacks is not None:
+            raise RuntimeError("A profile is already being taken")
+
+        self.__stacks = Counter[tuple[Frame, ...]]()
+        self.__loop = get_running_loop()
+        previous = signal.signal(signal.SIGPROF, self.__sample)
+        signal.setitimer(signal.ITIMER_PROF, self.__INTERVAL, self.__INTERVAL)
+
+        try:
+            await sleep(min(seconds, self.__MAX_SECONDS))
+
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, previous)
+            stacks, self.__stacks = self.__stacks, None
+
+        return stacks
+
+    def __sample(self, _: int, frame: Optional[FrameType]) -> None:
+        """
+        Record the stack of every thread, run in the main thread on each timer signal.
+
+        Args:
+            _ (int): The signal number.
+            frame (Optional[FrameType]): The frame the main thread was running when interrupted.
+        """
+
+        if self.__stacks is None:
+            return
+
+        main = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+        # The only way to get the current frame of every thread
+        frames = sys._current_frames()  # pylint: disable=protected-access
+        for ident, thread_frame in frames.items():
+            stack = [("thread " + names.get(ident, str(ident)), "", 0)]
+
+            if ident == main:
+                # The current frame of the main thread is this handler
+                thread_frame = frame
+                if task := current_task(self.__loop):
+                    stack.append(("task " + task.get_name(), "", 0))
+
+            self.__stacks[tuple(stack) + self.__walk(thread_frame)] += 1
+
+    def __walk(self, frame: Optional[FrameType]) -> tuple[Frame, ...]:
+        """
+        Get the frames of a stack.
+
+        Args:
+            frame (Optional[FrameType]): The innermost frame.
+
+        Returns:
+            tuple[Frame, ...]: The frames, outermost first.
+        """
+
+        stack = list[Frame]()
+
+        while frame is not None:
+            code = frame.f_code
+            if (label := self.__labels.get(code)) is None:
+                label = self.__labels[code] = (
+                    code.co_qualname,
+                    code.co_filename,
+                    code.co_firstlineno,
+                )
+
+            stack.append(label)
+            frame = frame.f_back
+
+        return tuple(reversed(stack))
+
+
+def to_collapsed(stacks: Counter[tuple[Frame, ...]]) -> str:
+    """
+    Convert the sampled stacks to the collapsed format of flamegraph.pl and most flamegraph tools.
+
+    Args:
+        stacks (Counter[tuple[Frame, ...]]): The number of samples of each stack.
+
+    Returns:
+        str: One line per stack, with its frames separated by semicolons and its sample count.
+    """
+
+    return "".join(
+        ";".join(
+            f"{name} ({file}:{line})" if file else name for name, file, line in stack
+        )
+        + f" {count}\n"
+        for stack, count in stacks.most_common()
+    )
+
+
+def to_speedscope(stacks: Counter[tuple[Frame, ...]], name: str) -> dict[str, Any]:
+    """
+    Convert the sampled stacks to the file format of speedscope (https://www.speedscope.app).
+
+    Args:
+        stacks (Counter[tuple[Frame, ...]]): The number of samples of each stack.
+        name (str): The name of the profile.
+
+    Returns:
+        dict[str, Any]: The speedscope file, weighting each stack by its sample count.
+    """
+
+    frames = dict[Frame, int]()
+    samples = list[list[int]]()
+
+    for stack in stacks:
+        samples.append([frames.setdefault(frame, len(frames)) for frame in stack])
+
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "shared": {
+            "frames": [
+                {"name": name, "file": file, "line": line} if file else {"name": name}
+                for name, file, line in frames
+            ]
+        },
+        "profiles": [
+            {
+                "type": "sampled",
+                "name": name,
+                "unit": "none",
+                "startValue": 0,
+                "endValue": stacks.total(),
+                "samples": samples,
+                "weights": list(stacks.values()),
+            }
+        ],
+        "name": name,
+        "exporter": __package__,
+    }
+
+
+PROFILER = Profiler()
@@ -0,0 +1,107 @@
+# -*- coding:utf-8 -*-
+from asyncio import Queue, QueueFull, Task, create_task, gather, wait_for
+from os import getenv
+from time import monotonic
+from typing import Awaitable, Callable, Optional
+
+from sanic.log import error_logger
+
+from .metric_util import Counter, Gauge, Histogram
+
+Job = Callable[[], Awaitable[None]]
+
+EVENT_QUEUE_DEPTH = Gauge(
+    "ntpu_linebot_event_queue_depth",
+    "Events waiting in the event queue",
+)
+EVENT_QUEUE_WAIT = Histogram(
+    "ntpu_linebot_event_queue_wait_seconds",
+    "Time events spent waiting in the event queue",
+)
+EVENT_SHED = Counter(
+    "ntpu_linebot_event_shed_total",
+    "Events not queued because the event queue was full, by fallback",
+    ("fallback",),
+)
+
+
+class EventQueue:
+    """A bounded queue of webhook events processed by a fixed pool of workers"""
+
+    __SIZE = int(getenv("EVENT_QUEUE_SIZE", "200"))
+    __WORKERS = int(getenv("EVENT_WORKERS", "8"))
+    __DRAIN_TIMEOUT = float(getenv("EVENT_DRAIN_SECONDS", "10"))
+    __queue: Optional[Queue[tuple[float, Job]]] = None
+    __workers: list[Task] = []
+
+    def start(self) -> None:
+        """Create the queue and start the workers in the running event loop."""
+
+        self.__queue = Queue(self.__SIZE)
+        self.__workers = [
+            create_task(self.__work(), name=f"event_worker_{i}")
+            for i in range(self.__WORKERS)
+        ]
+
+    def put(self, job: Job) -> bool:
+        """
+        Queue a job without waiting.
+
+        Args:
+            job (Job): A function returning the awaitable that processes the event.
+
+        Returns:
+            bool: False if the queue is full or not accepting jobs, the caller should shed the load.
+        """
+
+        if self.__queue is None or not self.__workers:
+            return False
+
+        try:
+            self.__queue.put_nowait((monotonic(), job))
+
+        except QueueFull:
+            return False
+
+        EVENT_QUEUE_DEPTH.set(value=self.__queue.qsize())
+        return True
+
+    async def drain(self) -> None:
+        """Stop accepting jobs, wait for the queued ones and stop the workers."""
+
+        workers, self.__workers = self.__workers, []
+
+        if self.__queue is not None:
+            try:
+                await wait_for(self.__queue.join(), self.__DRAIN_TIMEOUT)
+
+            except TimeoutError:
+                error_logger.warning(
+                    "Event queue not drained, %d events dropped",
+                    self.__queue.qsize(),
+                )
+
+        for worker in workers:
+            worker.cancel()
+
+        await gather(*workers, return_exceptions=True)
+
+    async def __work(self) -> None:
+        """Process the queued jobs one by one."""
+
+        while True:
+            enqueued_at, job = await self.__queue.get()
+            EVENT_QUEUE_WAIT.observe(value=monotonic() - enqueued_at)
+            EVENT_QUEUE_DEPTH.set(value=self.__queue.qsize())
+
+            try:
+                await job()
+
+            except Exception:  # pylint: disable=broad-except
+                error_logger.exception("Failed to process the event")
+
+            finally:
+                self.__queue.task_done()
+
+
+EVENT_QUEUE = EventQueue()
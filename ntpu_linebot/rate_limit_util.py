@@ -0,0 +1,156 @@
+# -*- coding:utf-8 -*-
+from collections import OrderedDict
+from os import getenv
+from time import monotonic
+from typing import Optional
+
+from linebot.v3.webhooks import GroupSource, RoomSource, Source
+
+from .metric_util import Counter
+
+RATE_LIMITED = Counter(
+    "ntpu_linebot_rate_limited_total",
+    "Messages dropped by the rate limiter, by command class",
+    ("command",),
+)
+DEBOUNCED = Counter(
+    "ntpu_linebot_debounced_total",
+    "Repeated identical messages dropped by the debouncer",
+)
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter keyed by user, group and command class,
+    with a debouncer for repeated identical messages.
+
+    Each command class allows `{CLASS}_RATE_PER_MINUTE` messages per minute per user,
+    with bursts of the same size. Groups and rooms share a bucket that is
+    `GROUP_RATE_MULTIPLIER` times larger.
+    """
+
+    CHEAP = "cheap"
+    UPSTREAM = "upstream"
+    STICKER = "sticker"
+
+    __RATES = {
+        CHEAP: float(getenv("CHEAP_RATE_PER_MINUTE", "30")),
+        UPSTREAM: float(getenv("UPSTREAM_RATE_PER_MINUTE", "6")),
+        STICKER: float(getenv("STICKER_RATE_PER_MINUTE", "10")),
+    }
+    __GROUP_MULTIPLIER = float(getenv("GROUP_RATE_MULTIPLIER", "3"))
+    __DEBOUNCE = float(getenv("DEBOUNCE_SECONDS", "3"))
+    __MAX_KEYS = 10000
+
+    def __init__(self) -> None:
+        # (chat id, command class) -> [tokens, updated at], least recently updated first
+        self.__buckets = OrderedDict[tuple[str, str], list[float]]()
+        # (user id, payload) -> received at, least recently received first
+        self.__recent = OrderedDict[tuple[str, str], float]()
+
+    def allow(self, source: Optional[Source], command: str) -> bool:
+        """
+        Take a token from the buckets of the sender and their group or room.
+
+        Args:
+            source (Optional[Source]): The source of the event.
+            command (str): The command class of the message.
+
+        Returns:
+            bool: True if the message can be handled.
+        """
+
+        rate = self.__RATES[command]
+        now = monotonic()
+        keys: list[tuple[str, float]] = []
+
+        if source is not None and source.user_id:
+            keys.append((source.user_id, rate))
+
+        if isinstance(source, GroupSource):
+            keys.append((source.group_id, rate * self.__GROUP_MULTIPLIER))
+
+        elif isinstance(source, RoomSource):
+            keys.append((source.room_id, rate * self.__GROUP_MULTIPLIER))
+
+        buckets = [
+            self.__bucket((key, command), capacity, now) for key, capacity in keys
+        ]
+
+        if any(bucket[0] < 1 for bucket in buckets):
+            RATE_LIMITED.inc(command)
+            return False
+
+        for bucket in buckets:
+            bucket[0] -= 1
+
+        return True
+
+    def is_duplicate(self, source: Optional[Source], payload: str) -> bool:
+        """
+        Check whether the same sender just sent the same message.
+
+        Args:
+            source (Optional[Source]): The source of the event.
+            payload (str): The normalized payload of the message.
+
+        Returns:
+            bool: True if the message should be dropped.
+        """
+
+        if source is None or not source.user_id:
+            return False
+
+        now = monotonic()
+        while (
+            self.__recent and now - next(iter(self.__recent.values())) > self.__DEBOUNCE
+        ):
+            self.__recent.popitem(last=False)
+
+        key = (source.user_id, payload)
+        if key in self.__recent:
+            DEBOUNCED.inc()
+            return True
+
+        self.__recent[key] = now
+        if len(self.__recent) > self.__MAX_KEYS:
+            self.__recent.popitem(last=False)
+
+        return False
+
+    def __bucket(
+        self,
+        key: tuple[str, str],
+        capacity: float,
+        now: float,
+    ) -> list[float]:
+        """
+        Get the refilled bucket of the key.
+
+        Args:
+            key (tuple[str, str]): The chat id and the command class.
+            capacity (float): The size of the bucket, refilled in one minute.
+            now (float): The current monotonic time.
+
+        Returns:
+            list[float]: The tokens and last updated time of the bucket.
+        """
+
+        if (bucket := self.__buckets.get(key)) is None:
+            bucket = self.__buckets[key] = [capacity, now]
+
+        else:
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * capacity / 60)
+            bucket[1] = now
+            self.__buckets.move_to_end(key)
+
+        # Buckets untouched for a minute are full again, so they can be forgotten
+        while len(self.__buckets) > self.__MAX_KEYS or (
+            now - next(iter(self.__buckets.values()))[1] > 60
+        ):
+            self.__buckets.popitem(last=False)
+
+        return bucket
+
+
+RATE_LIMITER = RateLimiter()
@@ -0,0 +1,56 @@
+# -*- coding:utf-8 -*-
+from .metric_util import Gauge
+
+FEATURE_READY = Gauge(
+    "ntpu_linebot_feature_ready",
+    "Whether the data source of each feature is available, by feature",
+    ("feature",),
+)
+
+
+class Readiness:
+    """
+    The availability of each feature, so the server can start serving at once
+    and features come up one by one as their data sources respond.
+    """
+
+    def __init__(self) -> None:
+        self.__ready = dict[str, bool]()
+
+    def set(self, feature: str, ready: bool) -> None:
+        """
+        Record whether the feature is available.
+
+        Args:
+            feature (str): The name of the feature.
+            ready (bool): Whether its data source responded.
+        """
+
+        self.__ready[feature] = ready
+        FEATURE_READY.set(feature, value=float(ready))
+
+    def is_ready(self, feature: str) -> bool:
+        """
+        Check whether the feature is available.
+
+        Args:
+            feature (str): The name of the feature.
+
+        Returns:
+            bool: True if its data source responded the last time it was checked.
+        """
+
+        return self.__ready.get(feature, False)
+
+    def status(self) -> dict[str, bool]:
+        """
+        Get the availability of all features.
+
+        Returns:
+            dict[str, bool]: Whether each feature is available.
+        """
+
+        return dict(self.__ready)
+
+
+READINESS = Readiness()
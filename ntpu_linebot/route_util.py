@@ -1,23 +1,224 @@
 # -*- coding:utf-8 -*-
+from asyncio import gather
 from re import sub
+from time import monotonic, time_ns
+from typing import Any, Optional
 
 from linebot.v3.messaging import ImageMessage, Message, TextMessage
 from linebot.v3.webhooks import (
+    Event,
     FollowEvent,
     JoinEvent,
     MemberJoinedEvent,
     MessageEvent,
     PostbackEvent,
+    StickerMessageContent,
+    TextMessageContent,
+    UserSource,
 )
 
+from .abs_bot import Bot
+from .budget_util import (
+    REPLY_BUDGET,
+    REPLY_TOKEN_TTL,
+    BudgetExceeded,
+    latency_budget,
+    stage,
+)
+from .command_util import CommandRouter
 from .contact import CONTACT_BOT
 from .course import COURSE_BOT
 from .id import ID_BOT
 from .line_api_util import LINE_API_UTIL
-from .line_bot_util import get_sender, instruction
+from .line_bot_util import StaticReply, get_sender, instruction
+from .log_util import LOG_PIPELINE
+from .metric_util import Histogram
+from .postback_util import PostbackHandler, decode_postback
+from .rate_limit_util import RATE_LIMITER, RateLimiter
+from .trace_util import TRACER
+
+HANDLER_LATENCY = Histogram(
+    "ntpu_linebot_handler_seconds",
+    "Time for a bot to answer, by bot, kind of event and commands or postback action",
+    ("bot", "kind", "command"),
+)
 
 __HELP_COMMANDS = ["使用說明", "help"]
 __PUNCTUATION_REGEX = r"[][!\"#$%&'()*+,./:;<=>?@\\^_`{|}~-]"
+__BOTS = [ID_BOT, CONTACT_BOT, COURSE_BOT]
+__BOT_TIMEOUT = 18
+__SUPPORTED_EVENT_TYPES = {"postback", "follow", "join", "memberJoined"}
+__SUPPORTED_MESSAGE_TYPES = {"text", "sticker"}
+__SUPPORTED_SOURCE_TYPES = {"user", "group", "room"}
+__GREETING_SENDER = get_sender("初階魔法師")
+__GREETING = StaticReply(
+    [
+        TextMessage(
+            text="泥好~~我是北大查詢小工具🔍",
+            sender=__GREETING_SENDER,
+        ),
+        TextMessage(
+            text="使用說明請點選下方選單\n或輸入「使用說明」查看",
+            sender=__GREETING_SENDER,
+        ),
+        TextMessage(
+            text="有疑問可以先去看常見問題\n若無法解決或有發現 Bug\n歡迎到 GitHub 提出",
+            sender=__GREETING_SENDER,
+        ),
+        TextMessage(
+            text="部分內容是由相關資料推斷\n不一定為正確資訊",
+            sender=__GREETING_SENDER,
+        ),
+        TextMessage(
+            text="資料來源：國立臺北大學\n數位學苑2.0(已無新資料)\n校園聯絡簿\n課程查詢系統",
+            sender=__GREETING_SENDER,
+        ),
+    ]
+)
+
+
+def normalize_text(text: str) -> str:
+    """
+    Change whitespace and remove punctuation characters from the message text.
+
+    Args:
+        text (str): The text of the message.
+
+    Returns:
+        str: The normalized payload.
+    """
+
+    payload = sub(r"\s", " ", text)
+    return sub(__PUNCTUATION_REGEX, "", payload)
+
+
+def __build_router() -> CommandRouter[tuple[Bot, str]]:
+    """
+    Compile the command keywords of all bots into one router.
+
+    Returns:
+        CommandRouter[tuple[Bot, str]]: The router finding the bot and the name of each command.
+    """
+
+    router = CommandRouter[tuple[Bot, str]]()
+    for bot in __BOTS:
+        for command, keywords in bot.commands.items():
+            router.add(keywords, (bot, command))
+
+        for command, keywords in bot.prefix_commands.items():
+            router.add(keywords, (bot, command), prefix=True)
+
+    return router
+
+
+__ROUTER = __build_router()
+
+
+def __build_postback_table() -> dict[tuple[str, str], tuple[Bot, PostbackHandler]]:
+    """
+    Collect the postback handlers of all bots into one dispatch table.
+
+    Returns:
+        dict[tuple[str, str], tuple[Bot, PostbackHandler]]: The bot and the handler of each namespace and action.
+    """
+
+    return {
+        (bot.postback_namespace, action): (bot, handler)
+        for bot in __BOTS
+        for action, handler in bot.postback_handlers.items()
+    }
+
+
+__POSTBACK_TABLE = __build_postback_table()
+
+
+def route_text(payload: str) -> dict[Bot, dict[str, str]]:
+    """
+    Find the bots owning the commands in the text, in one pass over it.
+
+    Args:
+        payload (str): The normalized text of the message.
+
+    Returns:
+        dict[Bot, dict[str, str]]: The criteria of each command found, by bot, in the bot order.
+    """
+
+    routes = dict[Bot, dict[str, str]]()
+    for (bot, command), criteria in __ROUTER.route(payload).items():
+        routes.setdefault(bot, {})[command] = criteria
+
+    # Keep the bot order, so the replies are in the same order as before
+    return {bot: routes[bot] for bot in __BOTS if bot in routes}
+
+
+def route_postback(
+    payload: str,
+) -> Optional[tuple[Bot, str, PostbackHandler, tuple[Any, ...]]]:
+    """
+    Find the handler of the postback data.
+    Encoded data are looked up in the dispatch table at once,
+    only legacy payloads are translated by the bots one after another.
+
+    Args:
+        payload (str): The postback data.
+
+    Returns:
+        Optional[tuple[Bot, str, PostbackHandler, tuple[Any, ...]]]: The bot, the action, the handler
+        and the typed arguments, None if no handler accepts the data.
+    """
+
+    if (postback := decode_postback(payload)) is not None:
+        namespace, action, args = postback
+
+    else:
+        for bot in __BOTS:
+            if (legacy := bot.parse_legacy_postback(payload)) is not None:
+                namespace = bot.postback_namespace
+                action, args = legacy
+                break
+
+        else:
+            return None
+
+    if (route := __POSTBACK_TABLE.get((namespace, action))) is None:
+        return None
+
+    bot, handler = route
+    if (typed_args := handler.parse_args(args)) is None:
+        return None
+
+    return bot, action, handler, typed_args
+
+
+def is_local_event(event: Event) -> bool:
+    """
+    Predict whether the reply of the event can be served from local data.
+
+    Args:
+        event (Event): The event to classify.
+
+    Returns:
+        bool: True if no upstream request is expected.
+    """
+
+    if isinstance(event, MessageEvent) and isinstance(
+        event.message, TextMessageContent
+    ):
+        payload = normalize_text(event.message.text)
+        return payload in __HELP_COMMANDS or not any(
+            bot.needs_upstream_text(commands)
+            for bot, commands in route_text(payload).items()
+        )
+
+    if isinstance(event, PostbackEvent):
+        payload = event.postback.data
+        if payload in __HELP_COMMANDS or (route := route_postback(payload)) is None:
+            return True
+
+        _, _, handler, args = route
+        return handler.needs_upstream is None or not handler.needs_upstream(*args)
+
+    return True
 
 
 async def handle_text_message(event: MessageEvent) -> None:
@@ -28,29 +229,92 @@ async def handle_text_message(event: MessageEvent) -> None:
         event (MessageEvent): The event triggered by a text message.
     """
 
-    # Change whitespace and remove punctuation characters from the message text
-    payload = sub(r"\s", " ", event.message.text)
-    payload = sub(__PUNCTUATION_REGEX, "", payload)
+    payload = normalize_text(event.message.text)
     if payload == "":
         return
 
+    if RATE_LIMITER.is_duplicate(event.source, payload):
+        LOG_PIPELINE.annotate(outcome="duplicate")
+        return
+
+    with TRACER.span("route.text"):
+        routes = {} if payload in __HELP_COMMANDS else route_text(payload)
+
+    command = (
+        RateLimiter.UPSTREAM
+        if any(bot.needs_upstream_text(commands) for bot, commands in routes.items())
+        else RateLimiter.CHEAP
+    )
+    LOG_PIPELINE.annotate(
+        command_class=command,
+        commands=sorted(
+            f"{type(bot).__name__}.{name}"
+            for bot, commands in routes.items()
+            for name in commands
+        ),
+    )
+    if not RATE_LIMITER.allow(event.source, command):
+        LOG_PIPELINE.annotate(outcome="rate_limited")
+        return
+
     messages: list[Message] = []
     if payload in __HELP_COMMANDS:
         messages += instruction()
 
     else:
-        messages += await ID_BOT.handle_text_message(payload, event.message.quote_token)
-        messages += await CONTACT_BOT.handle_text_message(
-            payload, event.message.quote_token
-        )
-        messages += await COURSE_BOT.handle_text_message(
-            payload, event.message.quote_token
-        )
+        # Only the bots owning a command run, side by side
+        for replies in await gather(
+            *(
+                __handle_bot_text(bot, payload, commands, event.message.quote_token)
+                for bot, commands in routes.items()
+            )
+        ):
+            messages += replies
 
     if messages:
         await LINE_API_UTIL.reply_message(event.reply_token, messages[:5])
 
 
+async def __handle_bot_text(
+    bot: Bot,
+    payload: str,
+    commands: dict[str, str],
+    quote_token: str,
+) -> list[Message]:
+    """
+    Let a bot handle the text message within its timeout.
+
+    Args:
+        bot (Bot): The bot owning the commands.
+        payload (str): The normalized text of the message.
+        commands (dict[str, str]): The criteria of each command of the bot.
+        quote_token (str): The quote token of the message.
+
+    Returns:
+        list[Message]: The reply of the bot, empty if it runs out of time.
+    """
+
+    start = monotonic()
+    try:
+        with TRACER.span(
+            f"bot.{type(bot).__name__}", command="+".join(sorted(commands))
+        ):
+            async with stage(type(bot).__name__, __BOT_TIMEOUT):
+                return await bot.handle_text_message(payload, commands, quote_token)
+
+    except BudgetExceeded:
+        LOG_PIPELINE.annotate(outcome="budget_exceeded")
+        return []
+
+    finally:
+        HANDLER_LATENCY.observe(
+            type(bot).__name__,
+            "text",
+            "+".join(sorted(commands)),
+            value=monotonic() - start,
+        )
+
+
 async def handle_postback_event(event: PostbackEvent) -> None:
     """
     Process the postback event triggered by the user.
@@ -60,20 +324,67 @@ async def handle_postback_event(event: PostbackEvent) -> None:
     """
 
     payload = event.postback.data
+    user_id = event.source.user_id if isinstance(event.source, UserSource) else None
 
     messages: list[Message] = []
     if payload in __HELP_COMMANDS:
         messages += instruction()
 
     else:
-        messages += await ID_BOT.handle_postback_event(payload)
-        messages += await CONTACT_BOT.handle_postback_event(payload)
-        messages += await COURSE_BOT.handle_postback_event(payload)
+        with TRACER.span("route.postback"):
+            route = route_postback(payload)
+
+        if route is not None:
+            LOG_PIPELINE.annotate(
+                command_class="postback",
+                commands=[f"{type(route[0]).__name__}.{route[1]}"],
+            )
+            messages += await __handle_bot_postback(*route, user_id)
 
     if messages:
         await LINE_API_UTIL.reply_message(event.reply_token, messages[:5])
 
 
+async def __handle_bot_postback(
+    bot: Bot,
+    action: str,
+    handler: PostbackHandler,
+    args: tuple[Any, ...],
+    user_id: Optional[str],
+) -> list[Message]:
+    """
+    Let a bot handle the postback action within its timeout.
+
+    Args:
+        bot (Bot): The bot owning the action.
+        action (str): The name of the action.
+        handler (PostbackHandler): The handler of the action.
+        args (tuple[Any, ...]): The typed arguments of the action.
+        user_id (Optional[str]): The user ID, None if not in a one-on-one chat.
+
+    Returns:
+        list[Message]: The reply of the bot, empty if it runs out of time.
+    """
+
+    start = monotonic()
+    try:
+        with TRACER.span(f"bot.{type(bot).__name__}", action=action):
+            async with stage(type(bot).__name__, __BOT_TIMEOUT):
+                return await handler.handle(user_id, *args)
+
+    except BudgetExceeded:
+        LOG_PIPELINE.annotate(outcome="budget_exceeded")
+        return []
+
+    finally:
+        HANDLER_LATENCY.observe(
+            type(bot).__name__,
+            "postback",
+            action,
+            value=monotonic() - start,
+        )
+
+
 async def handle_sticker_message(event: MessageEvent) -> None:
     """
     Handle sticker messages in a Line bot.
@@ -82,8 +393,17 @@ async def handle_sticker_message(event: MessageEvent) -> None:
         event (MessageEvent): The event object containing information about the sticker message.
     """
 
+    LOG_PIPELINE.annotate(command_class=RateLimiter.STICKER)
+    if not RATE_LIMITER.allow(event.source, RateLimiter.STICKER):
+        LOG_PIPELINE.annotate(outcome="rate_limited")
+        return
+
     msg_sender = get_sender()
 
+    # No sticker is loaded before the sticker sites respond
+    if msg_sender.icon_url is None:
+        return
+
     image_message = ImageMessage(
         originalContentUrl=msg_sender.icon_url,
         previewImageUrl=msg_sender.icon_url,
@@ -104,28 +424,98 @@ async def handle_follow_join_event(
         event (FollowEvent | JoinEvent | MemberJoinedEvent): The event object representing the follow, join, or member joined event.
     """
 
-    mes_sender = get_sender("初階魔法師")
-    messages = [
-        TextMessage(
-            text="泥好~~我是北大查詢小工具🔍",
-            sender=mes_sender,
-        ),
-        TextMessage(
-            text="使用說明請點選下方選單\n或輸入「使用說明」查看",
-            sender=mes_sender,
-        ),
-        TextMessage(
-            text="有疑問可以先去看常見問題\n若無法解決或有發現 Bug\n歡迎到 GitHub 提出",
-            sender=mes_sender,
-        ),
-        TextMessage(
-            text="部分內容是由相關資料推斷\n不一定為正確資訊",
-            sender=mes_sender,
+    await LINE_API_UTIL.reply_message(event.reply_token, __GREETING.messages())
+
+
+def is_supported_payload(payload: dict[str, Any]) -> bool:
+    """
+    Check whether the raw webhook event is handled by the bot, before building its model.
+
+    Args:
+        payload (dict[str, Any]): The decoded JSON of the event.
+
+    Returns:
+        bool: True if the event has a handler and can be replied to.
+    """
+
+    # Events in standby mode cannot be replied to
+    if payload.get("mode") != "active":
+        return False
+
+    if payload.get("source", {}).get("type") not in __SUPPORTED_SOURCE_TYPES:
+        return False
+
+    if payload.get("type") == "message":
+        return payload.get("message", {}).get("type") in __SUPPORTED_MESSAGE_TYPES
+
+    return payload.get("type") in __SUPPORTED_EVENT_TYPES
+
+
+async def handle_event(event: Event) -> None:
+    """
+    Dispatch the event to its handler within the reply latency budget.
+    Events served from local data may use the whole life of the reply token instead,
+    so a late event still gets its answer while the reply can be sent.
+
+    Args:
+        event (Event): The event to handle.
+    """
+
+    with (
+        LOG_PIPELINE.access(
+            event_type=event.type,
+            source_type=event.source.type if event.source else None,
+            # Time from the event to the start of its handling, mostly the webhook delivery and the queue
+            delay_ms=max(time_ns() // 1_000_000 - event.timestamp, 0),
+            redelivery=event.delivery_context.is_redelivery,
         ),
-        TextMessage(
-            text="資料來源：國立臺北大學\n數位學苑2.0(已無新資料)\n校園聯絡簿\n課程查詢系統",
-            sender=mes_sender,
+        latency_budget(
+            event.timestamp,
+            REPLY_TOKEN_TTL if is_local_event(event) else REPLY_BUDGET,
         ),
-    ]
+        TRACER.span("event.dispatch"),
+    ):
+        await __dispatch_event(event)
+
+
+async def __dispatch_event(event: Event) -> None:
+    """
+    Dispatch the event to its handler.
+
+    Args:
+        event (Event): The event to handle.
+    """
+
+    if isinstance(event, MessageEvent):
+        if isinstance(event.message, TextMessageContent):
+            await handle_text_message(event)
+
+        elif isinstance(event.message, StickerMessageContent):
+            await handle_sticker_message(event)
 
-    await LINE_API_UTIL.reply_message(event.reply_token, messages)
+    elif isinstance(event, PostbackEvent):
+        await handle_postback_event(event)
+
+    elif isinstance(event, (FollowEvent, JoinEvent, MemberJoinedEvent)):
+        await handle_follow_join_event(event)
+
+
+async def handle_busy_event(
+    event: MessageEvent | PostbackEvent | FollowEvent | JoinEvent | MemberJoinedEvent,
+) -> None:
+    """
+    Reply to an event that cannot be processed because the bot is overloaded.
+
+    Args:
+        event (MessageEvent | PostbackEvent | FollowEvent | JoinEvent | MemberJoinedEvent): The shed event.
+    """
+
+    await LINE_API_UTIL.reply_message(
+        event.reply_token,
+        [
+            TextMessage(
+                text="目前使用人數過多，請稍後再試(｡ŏ_ŏ)",
+                sender=get_sender(),
+            )
+        ],
+    )
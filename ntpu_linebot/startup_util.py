@@ -0,0 +1,105 @@
+# -*- coding:utf-8 -*-
+import resource
+from os import sysconf
+from pathlib import Path
+from time import monotonic
+
+from .metric_util import Gauge
+
+STARTUP_SECONDS = Gauge(
+    "ntpu_linebot_startup_seconds",
+    "Seconds from the start of the worker process to each startup phase, by phase",
+    ("phase",),
+)
+PROCESS_RSS = Gauge(
+    "ntpu_linebot_process_rss_bytes",
+    "Resident memory of the worker process at each startup phase, by phase",
+    ("phase",),
+)
+PROCESS_MEMORY = Gauge(
+    "ntpu_linebot_process_memory_bytes",
+    "Resident memory of the worker process shared with other processes or private to it, by kind",
+    ("kind",),
+)
+
+# Fallback start time where /proc is not available, when the package is imported
+__IMPORTED_AT = monotonic()
+
+
+def process_age() -> float:
+    """
+    Get the time since the worker process started, including the interpreter start and all imports.
+
+    Returns:
+        float: The age of the process in seconds.
+    """
+
+    try:
+        # The start time is the 22nd field, counted after the command name in parentheses
+        stat = Path("/proc/self/stat").read_text(encoding="utf-8")
+        fields = stat.rsplit(")", 1)[1].split()
+        uptime = float(Path("/proc/uptime").read_text(encoding="utf-8").split()[0])
+
+        return uptime - int(fields[19]) / sysconf("SC_CLK_TCK")
+
+    except (OSError, ValueError, IndexError):
+        return monotonic() - __IMPORTED_AT
+
+
+def process_rss() -> int:
+    """
+    Get the resident memory of the worker process.
+
+    Returns:
+        int: The resident memory in bytes, the peak if the current one is not available.
+    """
+
+    try:
+        pages = int(Path("/proc/self/statm").read_text(encoding="utf-8").split()[1])
+
+        return pages * resource.getpagesize()
+
+    except (OSError, ValueError, IndexError):
+        # Kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def mark_phase(phase: str) -> None:
+    """
+    Record the time and the resident memory of the worker process at a startup phase.
+
+    Args:
+        phase (str): The name of the phase.
+    """
+
+    STARTUP_SECONDS.set(phase, value=process_age())
+    PROCESS_RSS.set(phase, value=process_rss())
+
+
+def process_memory() -> dict[str, int]:
+    """
+    Get the resident memory of the worker process shared with the other workers,
+    such as the pages of the datasets preloaded before the fork, and the memory private to it.
+
+    Returns:
+        dict[str, int]: The shared and the private memory in bytes, empty if not available.
+    """
+
+    memory = {"shared": 0, "private": 0}
+
+    try:
+        smaps = Path("/proc/self/smaps_rollup").read_text(encoding="utf-8")
+        for line in smaps.splitlines():
+            # Shared_Clean, Shared_Dirty, Private_Clean and Private_Dirty, in kB
+            field, _, value = line.partition(":")
+            kind, _, state = field.partition("_")
+            if kind.lower() in memory and state in ("Clean", "Dirty"):
+                memory[kind.lower()] += int(value.split()[0]) * 1024
+
+    except (OSError, ValueError, IndexError):
+        return {}
+
+    for kind, value in memory.items():
+        PROCESS_MEMORY.set(kind, value=value)
+
+    return memory
@@ -1,9 +1,13 @@
 # -*- coding:utf-8 -*-
+import json
 from asyncio import gather
+from os import getenv
+from pathlib import Path
 
 from httpx import AsyncClient, HTTPError, Timeout
-from bs4 import BeautifulSoup as Bs4
-from fake_useragent import UserAgent
+
+from .file_util import write_atomic
+from .upstream_util import UpstreamClient, parse_html
 
 
 class StickerUtil:
@@ -17,8 +21,15 @@ class StickerUtil:
         "https://spy-family.net/tvseries/special/special3.php",
     ]
     __ICHIGO_PRODUCTION_URL = "https://ichigoproduction.com/special/present_icon.html"
-    __UA = UserAgent(min_percentage=0.01)
-    STICKER_LIST: list[str] = []
+    __CACHE_PATH = getenv("STICKER_CACHE_PATH")
+
+    def __init__(self) -> None:
+        self.__stickers = list[str]()
+
+    @property
+    def STICKER_LIST(self) -> list[str]:  # pylint: disable=invalid-name
+        """Getter for the sticker URLs"""
+        return self.__stickers
 
     async def _fetch_spy_family_stickers(
         self, client: AsyncClient, url: str
@@ -38,15 +49,14 @@ class StickerUtil:
         try:
             res = await client.get(url)
             if res.status_code == 200:
-                soup = Bs4(res.text, "lxml")
+                soup = parse_html(res.text, "sticker")
                 for i in soup.select("ul.icondlLists > li > a"):
                     if href := i.get("href"):
-                        stickers.append(
-                            f"https://spy-family.net/tvseries/{href[3:]}"
-                        )
+                        stickers.append(f"https://spy-family.net/tvseries/{href[3:]}")
 
-        except HTTPError as e:
-            print(f"Error fetching {url}: {str(e)}")
+        except HTTPError:
+            # Logged by the client, the other sites may still respond
+            pass
 
         return stickers
 
@@ -62,23 +72,38 @@ class StickerUtil:
         try:
             res = await client.get(self.__ICHIGO_PRODUCTION_URL)
             if res.status_code == 200:
-                soup = Bs4(res.text, "lxml")
+                soup = parse_html(res.text, "sticker")
                 for i in soup.select("ul.tp5 > li > div.ph > a"):
                     if href := i.get("href"):
                         stickers.append(f"https://ichigoproduction.com/{href[3:]}")
 
-        except HTTPError as e:
-            print(f"Error fetching Ichigo: {str(e)}")
+        except HTTPError:
+            # Logged by the client, the other sites may still respond
+            pass
 
         return stickers
 
+    def load_cache(self) -> bool:
+        """
+        Load the stickers saved by the previous run, if persistence is enabled.
+
+        Returns:
+            bool: True if any sticker is loaded.
+        """
+
+        if self.__CACHE_PATH and (path := Path(self.__CACHE_PATH)).is_file():
+            try:
+                self.__merge(json.loads(path.read_text(encoding="utf-8")))
+
+            except (OSError, ValueError):
+                pass
+
+        return len(self.__stickers) > 0
+
     async def load_stickers(self) -> bool:
-        """並行載入所有貼圖"""
+        """並行載入所有貼圖，與已載入的貼圖合併去重後存入快取"""
 
-        async with AsyncClient(
-            timeout=Timeout(10),
-            headers={"User-Agent": self.__UA.random},
-        ) as client:
+        async with UpstreamClient("sticker", timeout=Timeout(10)) as client:
             spy_family_tasks = [
                 self._fetch_spy_family_stickers(client, url)
                 for url in self.__SPY_FAMILY_URLS
@@ -88,11 +113,42 @@ class StickerUtil:
 
             results = await gather(*all_tasks, return_exceptions=True)
 
-            for result in results:
-                if isinstance(result, list):
-                    self.STICKER_LIST.extend(result)
+        stickers = [
+            sticker
+            for result in results
+            if isinstance(result, list)
+            for sticker in result
+        ]
+
+        if self.__merge(stickers):
+            self.__save_cache()
+
+        return len(self.__stickers) > 0
+
+    def __merge(self, stickers: list[str]) -> bool:
+        """
+        Add the stickers not loaded yet.
+
+        Args:
+            stickers (list[str]): The sticker URLs.
+
+        Returns:
+            bool: True if any sticker is added.
+        """
+
+        loaded = set(self.__stickers)
+        new_stickers = [s for s in dict.fromkeys(stickers) if s not in loaded]
+
+        # Replace the list at once, it is read while replying
+        self.__stickers = self.__stickers + new_stickers
+
+        return len(new_stickers) > 0
+
+    def __save_cache(self) -> None:
+        """Save the stickers for the next run, if persistence is enabled."""
 
-        return len(self.STICKER_LIST) > 0
+        if self.__CACHE_PATH:
+            write_atomic(Path(self.__CACHE_PATH), json.dumps(self.__stickers))
 
 
 STICKER = StickerUtil()
@@ -0,0 +1,345 @@
+# -*- coding:utf-8 -*-
+import json
+import random
+from asyncio import Task, create_task, gather, sleep
+from contextlib import contextmanager
+from contextvars import ContextVar
+from os import getenv
+from pathlib import Path
+from time import time_ns
+from typing import Any, Iterator, Optional
+
+from httpx import AsyncClient, HTTPError
+from sanic.log import error_logger
+
+from .metric_util import Counter
+
+TRACES_EXPORTED = Counter(
+    "ntpu_linebot_traces_exported_total",
+    "Sampled traces exported, by result",
+    ("result",),
+)
+
+
+class Span:
+    """A timed stage of a sampled trace, collected by its root span"""
+
+    # OpenTelemetry span kinds and status codes
+    __KIND_INTERNAL = 1
+    __KIND_SERVER = 2
+    __STATUS_ERROR = 2
+
+    __slots__ = (
+        "trace_id",
+        "span_id",
+        "parent",
+        "name",
+        "start",
+        "end",
+        "attributes",
+        "error",
+        "spans",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        parent: Optional["Span"] = None,
+        start: Optional[int] = None,
+        attributes: Optional[dict[str, Any]] = None,
+    ) -> None:
+        self.trace_id = parent.trace_id if parent else f"{random.getrandbits(128):032x}"
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent = parent
+        self.name = name
+        self.start = time_ns() if start is None else start
+        self.end: Optional[int] = None
+        self.attributes = attributes or {}
+        self.error: Optional[str] = None
+        # The finished spans of the trace, only kept by the root span
+        self.spans = list["Span"]()
+
+    @property
+    def root(self) -> "Span":
+        """The root span of the trace"""
+
+        span = self
+        while span.parent is not None:
+            span = span.parent
+
+        return span
+
+    def finish(self, end: Optional[int] = None) -> None:
+        """
+        End the span and hand it to its root span.
+
+        Args:
+            end (int, optional): The end time in nanoseconds since the epoch. Defaults to now.
+        """
+
+        self.end = time_ns() if end is None else end
+        self.root.spans.append(self)
+
+    def to_otlp(self) -> dict[str, Any]:
+        """
+        Convert the span to the OpenTelemetry (OTLP/JSON) format.
+
+        Returns:
+            dict[str, Any]: The span.
+        """
+
+        span: dict[str, Any] = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent.span_id if self.parent else "",
+            "name": self.name,
+            "kind": self.__KIND_INTERNAL if self.parent else self.__KIND_SERVER,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)}
+                for key, value in self.attributes.items()
+            ],
+        }
+
+        if self.error is not None:
+            span["status"] = {"code": self.__STATUS_ERROR, "message": self.error}
+
+        return span
+
+
+def _otlp_value(value: Any) -> dict[str, Any]:
+    """
+    Convert an attribute value to the OpenTelemetry (OTLP/JSON) format.
+
+    Args:
+        value (Any): The attribute value.
+
+    Returns:
+        dict[str, Any]: The typed value.
+    """
+
+    if isinstance(value, bool):
+        return {"boolValue": value}
+
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+
+    if isinstance(value, float):
+        return {"doubleValue": value}
+
+    return {"stringValue": str(value)}
+
+
+class Tracer:
+    """
+    Traces of webhook events, sampled at TRACE_SAMPLE_RATE,
+    exported in the OpenTelemetry (OTLP/JSON) format to a file (TRACE_PATH)
+    and/or a collector (TRACE_ENDPOINT, e.g. http://collector:4318/v1/traces).
+    Stages outside of a sampled trace cost one context variable lookup.
+    """
+
+    __SAMPLE_RATE = float(getenv("TRACE_SAMPLE_RATE", "0"))
+    __PATH = getenv("TRACE_PATH")
+    __ENDPOINT = getenv("TRACE_ENDPOINT")
+    __EXPORT_INTERVAL = float(getenv("TRACE_EXPORT_SECONDS", "5"))
+    __MAX_PENDING = 1000
+    __SERVICE_NAME = "ntpu-linebot"
+
+    def __init__(self) -> None:
+        self.__current = ContextVar[Optional[Span]]("span", default=None)
+        self.__pending = list[Span]()
+        self.__exporter: Optional[Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        """Whether traces are sampled and exported anywhere"""
+
+        return self.__SAMPLE_RATE > 0 and bool(self.__PATH or self.__ENDPOINT)
+
+    def start_trace(
+        self,
+        name: str,
+        start: Optional[int] = None,
+        **attributes: Any,
+    ) -> Optional[Span]:
+        """
+        Start the root span of a trace, if the trace is sampled.
+
+        Args:
+            name (str): The name of the root span.
+            start (int, optional): The start time in nanoseconds since the epoch. Defaults to now.
+            **attributes (Any): The attributes of the root span.
+
+        Returns:
+            Optional[Span]: The root span, None if the trace is not sampled.
+        """
+
+        if not self.enabled or random.random() >= self.__SAMPLE_RATE:
+            return None
+
+        return Span(name, start=start, attributes=attributes)
+
+    def record(
+        self,
+        parent: Optional[Span],
+        name: str,
+        start: int,
+        end: int,
+        **attributes: Any,
+    ) -> None:
+        """
+        Add a stage measured before its trace was started.
+
+        Args:
+            parent (Optional[Span]): The parent span, nothing is recorded if None.
+            name (str): The name of the span.
+            start (int): The start time in nanoseconds since the epoch.
+            end (int): The end time in nanoseconds since the epoch.
+            **attributes (Any): The attributes of the span.
+        """
+
+        if parent is not None:
+            Span(name, parent, start, attributes).finish(end)
+
+    @contextmanager
+    def activate(self, root: Optional[Span]) -> Iterator[None]:
+        """
+        Make the root span current for the stages of its trace, and export the trace when done.
+
+        Args:
+            root (Optional[Span]): The root span, nothing is traced if None.
+        """
+
+        if root is None:
+            yield
+            return
+
+        token = self.__current.set(root)
+        try:
+            yield
+
+        except BaseException as exc:
+            root.error = type(exc).__name__
+            raise
+
+        finally:
+            self.__current.reset(token)
+            root.finish()
+            self.__pending += root.spans
+            del self.__pending[: -self.__MAX_PENDING]
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+        """
+        Time a stage as a child of the current span, if the current event is traced.
+
+        Args:
+            name (str): The name of the span.
+            **attributes (Any): The attributes of the span.
+
+        Yields:
+            Optional[Span]: The span, to add attributes to, None if not traced.
+        """
+
+        if (parent := self.__current.get()) is None:
+            yield None
+            return
+
+        span = Span(name, parent, attributes=attributes)
+        token = self.__current.set(span)
+        try:
+            yield span
+
+        except BaseException as exc:
+            span.error = type(exc).__name__
+            raise
+
+        finally:
+            self.__current.reset(token)
+            span.finish()
+
+    def start_exporter(self) -> None:
+        """Start exporting the finished traces in the background."""
+
+        if self.enabled and self.__exporter is None:
+            self.__exporter = create_task(self.__export_loop(), name="trace_exporter")
+
+    async def stop_exporter(self) -> None:
+        """Stop the exporter and export the remaining traces."""
+
+        if self.__exporter is not None:
+            self.__exporter.cancel()
+            await gather(self.__exporter, return_exceptions=True)
+            self.__exporter = None
+
+        await self.__export()
+
+    async def __export_loop(self) -> None:
+        """Export the finished traces periodically."""
+
+        while True:
+            await sleep(self.__EXPORT_INTERVAL)
+            await self.__export()
+
+    async def __export(self) -> None:
+        """Export the finished traces as one OTLP/JSON request."""
+
+        if not self.__pending:
+            return
+
+        spans, self.__pending = self.__pending, []
+        traces = sum(1 for span in spans if span.parent is None)
+        payload = json.dumps(
+            {
+                "resourceSpans": [
+                    {
+                        "resource": {
+                            "attributes": [
+                                {
+                                    "key": "service.name",
+                                    "value": _otlp_value(self.__SERVICE_NAME),
+                                }
+                            ]
+                        },
+                        "scopeSpans": [
+                            {
+                                "scope": {"name": __package__},
+                                "spans": [span.to_otlp() for span in spans],
+                            }
+                        ],
+                    }
+                ]
+            },
+            ensure_ascii=False,
+        )
+
+        if self.__PATH:
+            try:
+                with Path(self.__PATH).open("a", encoding="utf-8") as file:
+                    file.write(payload + "\n")
+
+                TRACES_EXPORTED.inc("file", value=traces)
+
+            except OSError:
+                TRACES_EXPORTED.inc("error", value=traces)
+                error_logger.warning("Failed to write the traces to %s", self.__PATH)
+
+        if self.__ENDPOINT:
+            try:
+                async with AsyncClient(timeout=10) as client:
+                    res = await client.post(
+                        self.__ENDPOINT,
+                        content=payload.encode(),
+                        headers={"Content-Type": "application/json"},
+                    )
+                    res.raise_for_status()
+
+                TRACES_EXPORTED.inc("collector", value=traces)
+
+            except HTTPError:
+                TRACES_EXPORTED.inc("error", value=traces)
+                error_logger.warning("Failed to send the traces to %s", self.__ENDPOINT)
+
+
+TRACER = Tracer()
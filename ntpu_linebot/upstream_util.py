@@ -0,0 +1,133 @@
+# -*- coding:utf-8 -*-
+from time import monotonic
+from typing import Any
+
+from bs4 import BeautifulSoup as Bs4
+from httpx import AsyncClient, HTTPError, Request, Response
+
+from .crawl_util import CRAWLS
+from .log_util import LOGGER
+from .metric_util import Counter, Histogram
+from .trace_util import TRACER
+from .user_agent_util import random_user_agent
+
+UPSTREAM_LATENCY = Histogram(
+    "ntpu_linebot_upstream_request_seconds",
+    "Latency of upstream requests, by host and page",
+    ("host", "page"),
+)
+UPSTREAM_BYTES = Counter(
+    "ntpu_linebot_upstream_response_bytes_total",
+    "Decoded size of upstream responses, by host and page",
+    ("host", "page"),
+)
+UPSTREAM_ERRORS = Counter(
+    "ntpu_linebot_upstream_errors_total",
+    "Failed upstream requests, by host, page and status or error",
+    ("host", "page", "error"),
+)
+PARSE_LATENCY = Histogram(
+    "ntpu_linebot_parse_seconds",
+    "Time to parse upstream pages, by page",
+    ("page",),
+)
+
+
+class UpstreamClient(AsyncClient):
+    """
+    An HTTP client for the upstream sites, with a random user agent,
+    recording the latency, the size and the errors of each request by host and page.
+    """
+
+    def __init__(self, page: str, **kwargs: Any) -> None:
+        """
+        Args:
+            page (str): The type of the requested pages, used in the metrics.
+            **kwargs (Any): The arguments of `httpx.AsyncClient`.
+        """
+
+        kwargs["headers"] = {"User-Agent": random_user_agent()} | kwargs.get(
+            "headers", {}
+        )
+        super().__init__(**kwargs)
+        self.__page = page
+
+    async def send(self, request: Request, **kwargs: Any) -> Response:
+        host = request.url.host
+        start = monotonic()
+
+        try:
+            with TRACER.span(f"upstream.{self.__page}", host=host) as span:
+                response = await super().send(request, **kwargs)
+                if span is not None:
+                    span.attributes["status"] = response.status_code
+
+        except HTTPError as exc:
+            UPSTREAM_ERRORS.inc(host, self.__page, type(exc).__name__)
+            self.__log_error(request, type(exc).__name__, monotonic() - start)
+            raise
+
+        finally:
+            UPSTREAM_LATENCY.observe(host, self.__page, value=monotonic() - start)
+
+        if response.is_error:
+            UPSTREAM_ERRORS.inc(host, self.__page, str(response.status_code))
+            self.__log_error(request, str(response.status_code), monotonic() - start)
+
+        if not kwargs.get("stream"):
+            UPSTREAM_BYTES.inc(host, self.__page, value=len(response.content))
+            if crawl := CRAWLS.current:
+                crawl.record_page(len(response.content))
+
+        return response
+
+    def __log_error(self, request: Request, error: str, seconds: float) -> None:
+        """
+        Log a failed upstream request.
+
+        Args:
+            request (Request): The failed request.
+            error (str): The status code or the name of the error.
+            seconds (float): The time spent on the request.
+        """
+
+        if crawl := CRAWLS.current:
+            crawl.record_error(error, f"{request.url.host}{request.url.path}")
+
+        LOGGER.warning(
+            "upstream error",
+            extra={
+                "fields": {
+                    "host": request.url.host,
+                    "page": self.__page,
+                    "method": request.method,
+                    "path": request.url.path,
+                    "error": error,
+                    "latency_ms": round(seconds * 1000, 1),
+                }
+            },
+        )
+
+
+def parse_html(text: str, page: str) -> Bs4:
+    """
+    Parse an upstream page, recording the time spent.
+
+    Args:
+        text (str): The HTML of the page.
+        page (str): The type of the page, used in the metrics.
+
+    Returns:
+        Bs4: The parsed page.
+    """
+
+    start = monotonic()
+    with TRACER.span(f"parse.{page}", chars=len(text)):
+        soup = Bs4(text, "lxml")
+
+    seconds = monotonic() - start
+    PARSE_LATENCY.observe(page, value=seconds)
+    if crawl := CRAWLS.current:
+        crawl.record_parse(seconds)
+
+    return soup
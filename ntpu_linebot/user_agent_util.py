@@ -0,0 +1,35 @@
+# -*- coding:utf-8 -*-
+from functools import cache
+from random import choice
+
+__POOL_SIZE = 50
+
+
+@cache
+def user_agent_pool() -> tuple[str, ...]:
+    """
+    Get the user agents shared by all upstream requests.
+    fake_useragent and its browser data are loaded on the first call instead of at import time,
+    and only a sample of user agents is kept.
+
+    Returns:
+        tuple[str, ...]: The distinct user agents of the pool.
+    """
+
+    # Imported here, loading it and its browser data is what the first call defers
+    from fake_useragent import UserAgent  # pylint: disable=import-outside-toplevel
+
+    user_agent = UserAgent(min_percentage=0.01)
+
+    return tuple({user_agent.random: None for _ in range(__POOL_SIZE)})
+
+
+def random_user_agent() -> str:
+    """
+    Pick a user agent for an upstream request.
+
+    Returns:
+        str: A random user agent from the shared pool.
+    """
+
+    return choice(user_agent_pool())